@@ -28,6 +28,7 @@ from sqlalchemy.orm.exc import (
 )
 from model import (
     get_one,
+    CachedFeed,
     Complaint,
     Identifier,
     Patron,
@@ -36,6 +37,7 @@ from cdn import cdnify
 from classifier import Classifier
 from lane import (
     Facets,
+    KeysetPagination,
     Pagination,
 )
 from problem_details import *
@@ -65,30 +67,57 @@ def feed_response(feed, acquisition=True, cache_for=AcquisitionFeed.FEED_CACHE_T
         content_type = OPDSFeed.ACQUISITION_FEED_TYPE
     else:
         content_type = OPDSFeed.NAVIGATION_FEED_TYPE
+    if isinstance(feed, CachedFeed):
+        return _make_cached_feed_response(feed, content_type, cache_for)
     return _make_response(feed, content_type, cache_for)
 
 def entry_response(entry, cache_for=AcquisitionFeed.FEED_CACHE_TIME):
     content_type = OPDSFeed.ENTRY_TYPE
     return _make_response(entry, content_type, cache_for)
 
-def _make_response(content, content_type, cache_for):
-    if isinstance(content, etree._Element):
-        content = etree.tostring(content)
-    elif not isinstance(content, basestring):
-        content = unicode(content)
-
+def _cache_control(cache_for):
     if isinstance(cache_for, int):
         # A CDN should hold on to the cached representation only half
         # as long as the end-user.
         client_cache = cache_for
         cdn_cache = cache_for / 2
-        cache_control = "public, no-transform, max-age=%d, s-maxage=%d" % (
+        return "public, no-transform, max-age=%d, s-maxage=%d" % (
             client_cache, cdn_cache)
     else:
-        cache_control = "private, no-cache"
+        return "private, no-cache"
+
+def _make_response(content, content_type, cache_for):
+    if isinstance(content, etree._Element):
+        content = etree.tostring(content)
+    elif not isinstance(content, basestring):
+        content = unicode(content)
 
     return make_response(content, 200, {"Content-Type": content_type,
-                                        "Cache-Control": cache_control})
+                                        "Cache-Control": _cache_control(cache_for)})
+
+def _make_cached_feed_response(feed, content_type, cache_for):
+    """Serve a CachedFeed to the client making the current request.
+
+    If the client already has the current version of the feed, it
+    gets a 304 response. If the client accepts gzip encoding, it
+    gets the compressed content without it being re-encoded.
+    """
+    headers = {
+        "Content-Type": content_type,
+        "Cache-Control": _cache_control(cache_for),
+        "Vary": "Accept-Encoding",
+    }
+    if feed.etag:
+        headers["ETag"] = '"%s"' % feed.etag
+        if feed.etag in flask.request.if_none_match:
+            return make_response("", 304, headers)
+
+    if flask.request.accept_encodings.quality("gzip"):
+        content = feed.gzipped_content()
+        if content is not None:
+            headers["Content-Encoding"] = "gzip"
+            return make_response(content, 200, headers)
+    return make_response(feed.content or u"", 200, headers)
 
 def load_facets_from_request(facet_config=None):
     """Figure out which Facets object this request is asking for.
@@ -114,12 +143,17 @@ def load_facets_from_request(facet_config=None):
     return load_facets(library, order, availability, collection,
                        facet_config=facet_config)
 
-def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE):
-    """Figure out which Pagination object this request is asking for."""
+def load_pagination_from_request(default_size=Pagination.DEFAULT_SIZE,
+                                 keyset=False):
+    """Figure out which Pagination object this request is asking for.
+
+    :param keyset: If this is True, the first page of results will
+    use keyset pagination, and so will every subsequent page.
+    """
     arg = flask.request.args.get
     size = arg('size', default_size)
     offset = arg('after', 0)
-    return load_pagination(size, offset)
+    return load_pagination(size, offset, keyset=keyset)
 
 def load_facets(library, order, availability, collection, facet_config=None):
     """Turn user input into a Facets object."""
@@ -159,7 +193,7 @@ def load_facets(library, order, availability, collection, facet_config=None):
         order=order, enabled_facets=enabled_facets
     )
 
-def load_pagination(size, offset):
+def load_pagination(size, offset, keyset=False):
     """Turn user input into a Pagination object."""
     try:
         size = int(size)
@@ -170,7 +204,13 @@ def load_pagination(size, offset):
         try:
             offset = int(offset)
         except ValueError:
-            return INVALID_INPUT.detailed(_("Invalid offset: %(offset)s", offset=offset))
+            # This may be a token created by keyset pagination.
+            try:
+                return KeysetPagination.from_token(offset, size)
+            except ValueError:
+                return INVALID_INPUT.detailed(_("Invalid offset: %(offset)s", offset=offset))
+    if keyset and not offset:
+        return KeysetPagination(size)
     return Pagination(offset, size)
 
 def returns_problem_detail(f):
@@ -189,6 +189,12 @@ class BibliothecaAPI(object):
 
     def bibliographic_lookup(self, identifier, max_age=None):
         data = self.bibliographic_lookup_request(identifier, max_age)
+        return self.bibliographic_parse(data)
+
+    def bibliographic_parse(self, data):
+        """Turn the response to a bibliographic lookup request into a
+        Metadata object.
+        """
         response = list(self.item_list_parser.parse(data))
         if not response:
             return None
@@ -469,6 +475,15 @@ class BibliothecaBibliographicCoverageProvider(BibliographicCoverageProvider):
         # for an earlier failure (in which case the representation
         # in the cache might be wrong).
         metadata = self.api.bibliographic_lookup(identifier, max_age=0)
+        return self.process_fetched_item(identifier, metadata)
+
+    def fetch_item(self, identifier):
+        # Looking the item up directly, rather than through a cached
+        # Representation, keeps the database out of the worker thread.
+        response = self.api.request("/items/%s" % identifier.identifier)
+        return self.api.bibliographic_parse(response.content)
+
+    def process_fetched_item(self, identifier, metadata):
         if not metadata:
             return self.failure(
                 identifier, "Bibliotheca bibliographic lookup failed."
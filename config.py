@@ -100,6 +100,36 @@ class Configuration(object):
     NONGROUPED_MAX_AGE_POLICY = "default_nongrouped_feed_max_age" 
     GROUPED_MAX_AGE_POLICY = "default_grouped_feed_max_age" 
 
+    # The names of the site-wide configuration settings that determine
+    # how long an expired feed may still be served while a single
+    # request regenerates it.
+    NONGROUPED_STALE_GRACE_POLICY = "nongrouped_feed_stale_grace"
+    GROUPED_STALE_GRACE_POLICY = "grouped_feed_stale_grace"
+
+    # The names of the configuration file keys that control the
+    # in-process cache sitting in front of the cachedfeeds table.
+    CACHED_FEED_MEMORY_CACHE_MAX_ENTRIES = "cached_feed_memory_cache_max_entries"
+    CACHED_FEED_MEMORY_CACHE_MAX_BYTES = "cached_feed_memory_cache_max_bytes"
+    CACHED_FEED_MEMORY_CACHE_TTL = "cached_feed_memory_cache_ttl"
+
+    # The names of the configuration file keys that control the
+    # in-process cache of search results.
+    SEARCH_RESULT_CACHE_MAX_ENTRIES = "search_result_cache_max_entries"
+    SEARCH_RESULT_CACHE_TTL = "search_result_cache_ttl"
+
+    # The names of the configuration file keys that control search
+    # profiling. If search_profile is true, Elasticsearch reports how
+    # long each part of every query took; this needs Elasticsearch 2.2
+    # or later, and is ignored on older servers. Searches that take
+    # longer than search_slow_query_threshold seconds are logged.
+    SEARCH_PROFILE = "search_profile"
+    SEARCH_SLOW_QUERY_THRESHOLD = "search_slow_query_threshold"
+
+    # The name of the configuration file key that controls whether
+    # cached feeds are stored as text ("text"), as gzip-compressed
+    # bytes ("compressed", the default), or both ("both").
+    CACHED_FEED_STORAGE = "cached_feed_storage"
+
     # The name of the per-library configuration policy that controls whether
     # books may be put on hold.
     ALLOW_HOLDS = "allow_holds"
@@ -134,6 +164,14 @@ class Configuration(object):
             "key": GROUPED_MAX_AGE_POLICY,
             "label": _("Cache time for grouped OPDS feeds"),
         },
+        {
+            "key": NONGROUPED_STALE_GRACE_POLICY,
+            "label": _("Time an expired paginated OPDS feed may be served while it is regenerated"),
+        },
+        {
+            "key": GROUPED_STALE_GRACE_POLICY,
+            "label": _("Time an expired grouped OPDS feed may be served while it is regenerated"),
+        },
         {
             "key": BASE_URL_KEY,
             "label": _("Base url of the application"),
@@ -348,6 +386,18 @@ class Configuration(object):
     # The name of the service associated with a Timestamp that tracks
     # the last time the site's configuration changed in the database.
     SITE_CONFIGURATION_CHANGED = "Site Configuration Changed"
+
+    # Changes to the site configuration are announced to other
+    # processes on this Postgres NOTIFY channel.
+    SITE_CONFIGURATION_CHANNEL = "site_configuration_changed"
+
+    # This is set while a background thread is listening on
+    # SITE_CONFIGURATION_CHANNEL, so there's no need to poll the
+    # database for changes.
+    SITE_CONFIGURATION_WATCHED = "site_configuration_watched"
+
+    # The format of the timestamps sent on SITE_CONFIGURATION_CHANNEL.
+    SITE_CONFIGURATION_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
             
     @classmethod
     def last_checked_for_site_configuration_update(cls):
@@ -380,6 +430,12 @@ class Configuration(object):
         """
         now = datetime.datetime.utcnow()
 
+        if not known_value and cls.instance.get(cls.SITE_CONFIGURATION_WATCHED):
+            # Every change is pushed to us as it happens (see
+            # site_configuration_changed_elsewhere), so our
+            # record is already up to date.
+            return cls._site_configuration_last_update()
+
         last_check = cls.instance.get(
             cls.LAST_CHECKED_FOR_SITE_CONFIGURATION_UPDATE
         )
@@ -419,6 +475,29 @@ class Configuration(object):
 
         return last_update
 
+    @classmethod
+    def site_configuration_changed_elsewhere(cls, payload):
+        """Another process announced a change to the site configuration
+        on SITE_CONFIGURATION_CHANNEL.
+
+        :param payload: The timestamp of the change, formatted with
+        SITE_CONFIGURATION_TIMESTAMP_FORMAT.
+        """
+        try:
+            known_value = datetime.datetime.strptime(
+                payload, cls.SITE_CONFIGURATION_TIMESTAMP_FORMAT
+            )
+        except ValueError, e:
+            logging.error(
+                "Unrecognized site configuration notification: %r", payload
+            )
+            return
+        last_update = cls._site_configuration_last_update()
+        if last_update and last_update > known_value:
+            # We already know about a more recent change.
+            return
+        cls.site_configuration_last_update(None, known_value=known_value)
+
     @classmethod
     def _site_configuration_last_update(cls):
         """Get the raw SITE_CONFIGURATION_LAST_UPDATE value,
@@ -1,6 +1,11 @@
 from nose.tools import set_trace
 import datetime
 import logging
+from Queue import (
+    Empty,
+    Queue,
+)
+import threading
 
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
@@ -11,6 +16,7 @@ from model import (
     BaseCoverageRecord,
     Collection,
     CollectionMissing,
+    CoverageJob,
     CoverageRecord,
     DataSource,
     Edition,
@@ -47,6 +53,15 @@ class CoverageFailure(object):
             self.obj, data_source, self.transient, self.exception
         )
 
+    @property
+    def status(self):
+        """The status of a coverage record that memorializes this
+        failure.
+        """
+        if self.transient:
+            return BaseCoverageRecord.TRANSIENT_FAILURE
+        return BaseCoverageRecord.PERSISTENT_FAILURE
+
     def to_coverage_record(self, operation=None):
         """Convert this failure into a CoverageRecord."""
         if not self.data_source:
@@ -59,10 +74,7 @@ class CoverageFailure(object):
             collection=self.collection
         )
         record.exception = self.exception
-        if self.transient:
-            record.status = CoverageRecord.TRANSIENT_FAILURE
-        else:
-            record.status = CoverageRecord.PERSISTENT_FAILURE
+        record.status = self.status
         return record
 
     def to_work_coverage_record(self, operation):
@@ -71,10 +83,7 @@ class CoverageFailure(object):
             self.obj, operation=operation
         )
         record.exception = self.exception
-        if self.transient:
-            record.status = CoverageRecord.TRANSIENT_FAILURE
-        else:
-            record.status = CoverageRecord.PERSISTENT_FAILURE
+        record.status = self.status
         return record
 
 
@@ -111,8 +120,26 @@ class BaseCoverageProvider(object):
     # `batch_size` in the constructor, but generally nobody bothers
     # doing this.
     DEFAULT_BATCH_SIZE = 100
+
+    # The model class of the items this CoverageProvider covers. Items
+    # are covered in order by this class's `id` field. This is set
+    # in IdentifierCoverageProvider and WorkCoverageProvider.
+    MODEL_CLASS = None
+
+    # If this is set, the CoverageProvider only covers these items,
+    # rather than everything that needs coverage. This is set in
+    # IdentifierCoverageProvider.
+    input_identifiers = None
+
+    # If a subclass spends most of its time in process_item() waiting
+    # on the network, it can move the network request into
+    # fetch_item() and the rest into process_fetched_item(). Items in
+    # a batch will then be fetched this many at a time, in worker
+    # threads.
+    DEFAULT_CONCURRENCY = 1
     
-    def __init__(self, _db, batch_size=None, cutoff_time=None):
+    def __init__(self, _db, batch_size=None, cutoff_time=None,
+                 concurrency=None):
         """Constructor.
 
         :batch_size: The maximum number of objects that will be processed
@@ -120,6 +147,9 @@ class BaseCoverageProvider(object):
 
         :param cutoff_time: Coverage records created before this time
         will be treated as though they did not exist.
+
+        :param concurrency: The maximum number of items to fetch at
+        once, if this CoverageProvider implements fetch_item().
         """
         self._db = _db
         if not self.__class__.SERVICE_NAME:
@@ -137,6 +167,9 @@ class BaseCoverageProvider(object):
         self.batch_size = batch_size
         self.cutoff_time = cutoff_time
         self.collection_id = None
+        if not concurrency or concurrency < 1:
+            concurrency = self.DEFAULT_CONCURRENCY
+        self.concurrency = concurrency
         
     @property
     def log(self):
@@ -156,64 +189,83 @@ class BaseCoverageProvider(object):
     def run(self):
         self.run_once_and_update_timestamp()
 
+    def timestamp(self):
+        """Find or create the Timestamp for this CoverageProvider."""
+        timestamp, is_new = get_one_or_create(
+            self._db, Timestamp,
+            service=self.service_name,
+            collection=self.collection,
+        )
+        return timestamp
+
     def run_once_and_update_timestamp(self):
         # First cover items that have never had a coverage attempt
-        # before.
-        offset = 0
-        while offset is not None:
-            offset = self.run_once(
-                offset, count_as_covered=BaseCoverageRecord.ALL_STATUSES
+        # before. This is where most of the work happens, so the ID
+        # of the last item covered is kept in the Timestamp's
+        # counter. If this provider crashes, the next run will pick
+        # up where this one left off.
+        #
+        # A run over a handful of input identifiers neither uses the
+        # counter nor disturbs it, since it would mean nothing to a
+        # run over everything.
+        resumable = self.input_identifiers is None
+        timestamp = self.timestamp()
+        after = 0
+        if resumable:
+            after = timestamp.counter or 0
+        while after is not None:
+            after = self.run_once(
+                after, count_as_covered=BaseCoverageRecord.ALL_STATUSES
             )
+            if after is not None and resumable:
+                timestamp.counter = after
+        if resumable:
+            timestamp.counter = 0
 
         # Next, cover items that failed with a transient failure
         # on a previous attempt.
-        offset = 0
-        while offset is not None:
-            offset = self.run_once(
-                offset, 
+        after = 0
+        while after is not None:
+            after = self.run_once(
+                after, 
                 count_as_covered=BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
             )
         
         Timestamp.stamp(self._db, self.service_name, self.collection)
         self._db.commit()
 
-    def run_once(self, offset, count_as_covered=None):
+    def run_once(self, after, count_as_covered=None):
+        """Cover one batch of items, in order by ID.
+
+        :param after: Only items with IDs greater than this will be
+        covered.
+
+        :return: The ID of the last item in the batch, to be passed in
+        as `after` next time, or None if there was nothing left to
+        cover.
+        """
         count_as_covered = count_as_covered or BaseCoverageRecord.DEFAULT_COUNT_AS_COVERED
         # Make it clear which class of items we're covering on this
         # run.
         count_as_covered_message = '(counting %s as covered)' % (', '.join(count_as_covered))
 
+        # Walking the items in ID order means every batch costs the
+        # same, no matter how far into the table we are, and items
+        # that were just covered (or just failed) never come up again
+        # in the same pass.
+        id_column = self.MODEL_CLASS.id
         qu = self.items_that_need_coverage(count_as_covered=count_as_covered)
-        self.log.info("%d items need coverage%s", qu.count(), 
-                      count_as_covered_message)
-        batch = qu.limit(self.batch_size).offset(offset)
+        if after:
+            qu = qu.filter(id_column > after)
+        batch = qu.order_by(id_column).limit(self.batch_size).all()
 
-        if not batch.count():
+        if not batch:
             # The batch is empty. We're done.
             return None
-        (successes, transient_failures, persistent_failures), results = (
-            self.process_batch_and_handle_results(batch)
-        )
-
-        if BaseCoverageRecord.SUCCESS not in count_as_covered:
-            # If any successes happened in this batch, increase the
-            # offset to ignore them, or they will just show up again
-            # the next time we run this batch.
-            offset += successes
-
-        if BaseCoverageRecord.TRANSIENT_FAILURE not in count_as_covered:
-            # If any transient failures happened in this batch,
-            # increase the offset to ignore them, or they will
-            # just show up again the next time we run this batch.
-            offset += transient_failures
-
-        if BaseCoverageRecord.PERSISTENT_FAILURE not in count_as_covered:
-            # If any persistent failures happened in this batch,
-            # increase the offset to ignore them, or they will
-            # just show up again the next time we run this batch.
-            offset += persistent_failures
-        
-        return offset
+        self.log.info("Covering %d items after ID %s%s", len(batch), after,
+                      count_as_covered_message)
+        self.process_batch_and_handle_results(batch)
+        return batch[-1].id
 
     def process_batch_and_handle_results(self, batch):
         """:return: A 2-tuple (counts, records). 
@@ -237,28 +289,24 @@ class BaseCoverageProvider(object):
         transient_failures = 0
         persistent_failures = 0
         num_ignored = 0
-        records = []
 
         unhandled_items = set(batch)
+        handled = []
         for item in results:
             if isinstance(item, CoverageFailure):
                 if item.obj in unhandled_items:
                     unhandled_items.remove(item.obj)
-                record = self.record_failure_as_coverage_record(item)
                 if item.transient:
                     self.log.warn(
                         "Transient failure covering %r: %s", 
                         item.obj, item.exception
                     )
-
-                    record.status = BaseCoverageRecord.TRANSIENT_FAILURE
                     transient_failures += 1
                 else:
                     self.log.error(
                         "Persistent failure covering %r: %s", 
                         item.obj, item.exception
                     )
-                    record.status = BaseCoverageRecord.PERSISTENT_FAILURE
                     persistent_failures += 1
             else:
                 # Count this as a success and add a coverage record for
@@ -267,10 +315,7 @@ class BaseCoverageProvider(object):
                 if item in unhandled_items:
                     unhandled_items.remove(item)
                 successes += 1
-                record, ignore = self.add_coverage_record_for(item)
-                record.status = BaseCoverageRecord.SUCCESS
-                record.exception = None
-            records.append(record)
+            handled.append(item)
 
         # Perhaps some records were ignored--they neither succeeded nor
         # failed. Treat them as transient failures.
@@ -278,12 +323,11 @@ class BaseCoverageProvider(object):
             self.log.warn(
                 "%r was ignored by a coverage provider that was supposed to cover it.", item
             )
-            failure = self.failure_for_ignored_item(item)
-            record = self.record_failure_as_coverage_record(failure)
-            record.status = BaseCoverageRecord.TRANSIENT_FAILURE
-            records.append(record)
+            handled.append(self.failure_for_ignored_item(item))
             num_ignored += 1
 
+        records = self.add_coverage_records(handled)
+
         self.log.info(
             "Batch processed with %d successes, %d transient failures, %d persistent failures, %d ignored.",
             successes, transient_failures, persistent_failures, num_ignored
@@ -304,14 +348,67 @@ class BaseCoverageProvider(object):
 
         :return: A mixed list of coverage records and CoverageFailures.
         """
+        fetched = self.fetch_batch(batch)
         results = []
         for item in batch:
-            result = self.process_item(item)
+            if item in fetched:
+                result = self.process_fetched_item(item, fetched[item])
+            else:
+                result = self.process_item(item)
             if not isinstance(result, CoverageFailure):
                 self.handle_success(item)
             results.append(result)
         return results
 
+    @property
+    def fetches_items(self):
+        """Does this CoverageProvider implement fetch_item()?"""
+        return (self.fetch_item.__func__
+                is not BaseCoverageProvider.fetch_item.__func__)
+
+    def fetch_batch(self, batch):
+        """Call fetch_item() on every item in a batch, running up to
+        `self.concurrency` calls at once in worker threads.
+
+        Nothing is fetched if this CoverageProvider doesn't implement
+        fetch_item() or its concurrency is 1. process_batch() will
+        then call process_item() on each item, as usual.
+
+        :return: A dictionary mapping items to the results of
+        fetch_item(). If fetch_item() raised an exception for an item,
+        that item is left out, and process_batch() will give it to
+        process_item() instead.
+        """
+        fetched = {}
+        if self.concurrency <= 1 or not self.fetches_items or not batch:
+            return fetched
+
+        queue = Queue()
+        for item in batch:
+            queue.put(item)
+
+        def work():
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    break
+                try:
+                    fetched[item] = self.fetch_item(item)
+                except Exception, e:
+                    self.log.warn(
+                        "Error fetching %r, will try again in process_item: %s",
+                        item, e, exc_info=e
+                    )
+
+        workers = [threading.Thread(target=work)
+                   for i in range(min(self.concurrency, len(batch)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return fetched
+
     def handle_success(self, item):
         """Do something special to mark the successful coverage of the
         given item.
@@ -359,6 +456,28 @@ class BaseCoverageProvider(object):
         """
         raise NotImplementedError()
     
+    def add_coverage_records(self, results):
+        """Add coverage records for a batch of results.
+
+        IdentifierCoverageProvider and WorkCoverageProvider write all
+        the records with a single query.
+
+        :param results: A mixed list of covered items and
+           CoverageFailures.
+
+        :return: A list of coverage records, one for each result.
+        """
+        records = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                record = self.record_failure_as_coverage_record(result)
+            else:
+                record, ignore = self.add_coverage_record_for(result)
+                record.status = BaseCoverageRecord.SUCCESS
+                record.exception = None
+            records.append(record)
+        return records
+
     def add_coverage_record_for(self, item):
         """Add a coverage record for the given item.
 
@@ -391,6 +510,28 @@ class BaseCoverageProvider(object):
         """
         raise NotImplementedError()
 
+    #
+    # Subclasses may implement these virtual methods to fetch items
+    # concurrently.
+    #
+
+    def fetch_item(self, item):
+        """Get whatever process_item() would get from the network for
+        one specific item.
+
+        This may be called in a worker thread, so it must not use the
+        database session.
+        """
+        raise NotImplementedError()
+
+    def process_fetched_item(self, item, fetched):
+        """Give coverage to an item, using the return value of
+        fetch_item().
+
+        This is called on the database session's thread.
+        """
+        raise NotImplementedError()
+
 
 class IdentifierCoverageProvider(BaseCoverageProvider):
 
@@ -416,6 +557,8 @@ class IdentifierCoverageProvider(BaseCoverageProvider):
     # Identifier in the system, which is probably not what you want.
     NO_SPECIFIED_TYPES = object()
     INPUT_IDENTIFIER_TYPES = NO_SPECIFIED_TYPES
+
+    MODEL_CLASS = Identifier
     
     def __init__(self, _db, collection=None, input_identifiers=None,
                  replacement_policy=None, **kwargs):
@@ -656,6 +799,29 @@ class IdentifierCoverageProvider(BaseCoverageProvider):
 
         return qu
 
+    def add_coverage_records(self, results):
+        """Record the outcome of a batch as CoverageRecords, using a
+        single query.
+        """
+        values = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                if not result.data_source:
+                    raise Exception(
+                        "Cannot convert coverage failure to CoverageRecord because it has no output source."
+                    )
+                values.append((
+                    result.obj, result.data_source, self.operation,
+                    result.collection, result.status, result.exception,
+                    None
+                ))
+            else:
+                values.append((
+                    result, self.data_source, self.operation, None,
+                    CoverageRecord.SUCCESS, None, None
+                ))
+        return CoverageRecord.bulk_add(self._db, values)
+
     def add_coverage_record_for(self, item):
         """Record this CoverageProvider's coverage for the given
         Edition/Identifier, as a CoverageRecord.
@@ -728,6 +894,10 @@ class CollectionCoverageProvider(IdentifierCoverageProvider):
 
         :param collection: Will provide coverage to all Identifiers with
             a LicensePool licensed to the given Collection.
+
+        Unless `concurrency` is passed in, it's taken from the
+        COVERAGE_CONCURRENCY setting of the Collection's
+        ExternalIntegration.
         """
         if not isinstance(collection, Collection):
             raise CollectionMissing(
@@ -743,6 +913,11 @@ class CollectionCoverageProvider(IdentifierCoverageProvider):
                 )
             )
         _db = Session.object_session(collection)
+        if (kwargs.get('concurrency') is None
+            and collection.external_integration_id):
+            kwargs['concurrency'] = collection.external_integration.setting(
+                ExternalIntegration.COVERAGE_CONCURRENCY
+            ).int_value
         super(CollectionCoverageProvider, self).__init__(
             _db, collection, **kwargs
         )
@@ -983,6 +1158,8 @@ class BibliographicCoverageProvider(CollectionCoverageProvider):
 class WorkCoverageProvider(BaseCoverageProvider):
 
     """Perform coverage operations on Works rather than Identifiers."""
+
+    MODEL_CLASS = Work
     
     #
     # Implementation of BaseCoverageProvider virtual methods.
@@ -1021,6 +1198,24 @@ class WorkCoverageProvider(BaseCoverageProvider):
             work, "Was ignored by WorkCoverageProvider.", transient=True
         )
 
+    def add_coverage_records(self, results):
+        """Record the outcome of a batch as WorkCoverageRecords, using a
+        single query.
+        """
+        values = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                values.append((
+                    result.obj, self.operation, result.status,
+                    result.exception, None
+                ))
+            else:
+                values.append((
+                    result, self.operation, WorkCoverageRecord.SUCCESS,
+                    None, None
+                ))
+        return WorkCoverageRecord.bulk_add(self._db, values)
+
     def add_coverage_record_for(self, work):
         """Record this CoverageProvider's coverage for the given
         Edition/Identifier, as a WorkCoverageRecord.
@@ -1032,3 +1227,133 @@ class WorkCoverageProvider(BaseCoverageProvider):
     def record_failure_as_coverage_record(self, failure):
         """Turn a CoverageFailure into a WorkCoverageRecord object."""
         return failure.to_work_coverage_record(operation=self.operation)
+
+
+class CoverageScheduler(object):
+    """Give coverage to Identifiers from the shared queue of
+    CoverageJobs.
+
+    Any number of processes can run a CoverageScheduler against the
+    same queue at once. Each one only takes jobs meant for the
+    IdentifierCoverageProviders it was given, most urgent first.
+    """
+
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, _db, providers, batch_size=None):
+        self._db = _db
+        self.providers = dict()
+        for provider in providers:
+            if not isinstance(provider, IdentifierCoverageProvider):
+                raise ValueError(
+                    "%r does not cover Identifiers, so it can't take jobs from the queue." % provider
+                )
+            self.providers[self.key(provider)] = provider
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+
+    @property
+    def log(self):
+        if not hasattr(self, '_log'):
+            self._log = logging.getLogger("Coverage scheduler")
+        return self._log
+
+    @classmethod
+    def key(cls, provider):
+        """The service name and Collection ID that identify jobs meant
+        for the given provider.
+        """
+        return (provider.service_name, provider.collection_id)
+
+    @classmethod
+    def enqueue(cls, provider, identifiers, priority=None):
+        """Ask for the given provider to cover the given Identifiers.
+
+        :param priority: By default, the priority of each job is
+           decided by CoverageJob.priorities().
+        """
+        CoverageJob.enqueue(
+            provider._db, provider.service_name, provider.collection,
+            [identifier.id for identifier in identifiers], priority
+        )
+
+    def enqueue_items_that_need_coverage(self):
+        """Create jobs for everything our providers haven't covered
+        yet, including items that failed with a transient failure.
+
+        Jobs that already exist are left alone, so this doesn't
+        interfere with the backoff of a job that keeps failing.
+        """
+        for provider in self.providers.values():
+            after = 0
+            while True:
+                qu = provider.items_that_need_coverage().filter(
+                    Identifier.id > after
+                ).order_by(Identifier.id).limit(provider.batch_size)
+                identifiers = qu.all()
+                if not identifiers:
+                    break
+                self.enqueue(provider, identifiers)
+                after = identifiers[-1].id
+                self._db.commit()
+
+    def run(self):
+        """Keep processing jobs until there are none left."""
+        while self.run_once():
+            pass
+
+    def run_once(self):
+        """Claim and process one batch of jobs.
+
+        :return: The number of jobs claimed.
+        """
+        jobs = CoverageJob.claim(
+            self._db, self.providers.keys(), self.batch_size
+        )
+        # Commit the claim right away, so other processes know these
+        # jobs are taken.
+        self._db.commit()
+
+        jobs_by_provider = dict()
+        for job in jobs:
+            key = (job.service, job.collection_id)
+            jobs_by_provider.setdefault(key, []).append(job)
+        for key, provider_jobs in jobs_by_provider.items():
+            self.process_jobs(self.providers[key], provider_jobs)
+            self._db.commit()
+        return len(jobs)
+
+    def process_jobs(self, provider, jobs):
+        """Have a provider cover the Identifiers from some of its jobs.
+
+        A job that ends in transient failure is rescheduled. Any other
+        job is done, and is removed from the queue.
+        """
+        # Another process may have covered some of these Identifiers
+        # since their jobs were created.
+        identifiers = provider.items_that_need_coverage(
+            [job.identifier for job in jobs]
+        ).all()
+
+        failed = set()
+        if identifiers:
+            try:
+                counts, records = provider.process_batch_and_handle_results(
+                    identifiers
+                )
+                failed = set(
+                    record.identifier_id for record in records
+                    if record.status == CoverageRecord.TRANSIENT_FAILURE
+                )
+            except Exception, e:
+                self.log.error(
+                    "Error in %r, rescheduling %d jobs.",
+                    provider, len(jobs), exc_info=e
+                )
+                self._db.rollback()
+                failed = set(job.identifier_id for job in jobs)
+
+        for job in jobs:
+            if job.identifier_id in failed:
+                job.reschedule()
+            else:
+                self._db.delete(job)
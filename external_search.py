@@ -1,6 +1,11 @@
 from nose.tools import set_trace
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk as elasticsearch_bulk
+from sqlalchemy import (
+    and_,
+    or_,
+)
+from sqlalchemy.sql.functions import func
 from flask_babel import lazy_gettext as _
 from config import (
     Configuration,
@@ -11,10 +16,31 @@ from classifier import (
     GradeLevelClassifier,
     AgeClassifier,
 )
-from model import ExternalIntegration, Work
+from model import (
+    get_one,
+    ExternalIntegration,
+    SearchDocument,
+    Timestamp,
+    Work,
+    WorkCoverageRecord,
+)
+from coverage import (
+    CoverageFailure,
+    WorkCoverageProvider,
+)
+from util.lru import LRUCache
+from Queue import Queue, Empty
+from collections import (
+    Counter,
+    defaultdict,
+)
+import datetime
+import json
 import os
 import logging
+import random
 import re
+import threading
 import time
 
 class ExternalSearchIndex(object):
@@ -24,10 +50,22 @@ class ExternalSearchIndex(object):
     WORKS_INDEX_KEY = u'works_index'
     WORKS_ALIAS_KEY = u'works_alias'
 
+    # While the works index is being migrated to a new version, this
+    # setting holds the name of the new index.
+    WORKS_MIGRATION_INDEX_KEY = u'works_migration_index'
+
     DEFAULT_WORKS_INDEX = u'works'
     
     work_document_type = 'work-type'
     __client = None
+    _db = None
+    integration_id = None
+
+    # Elasticsearch can only profile queries as of version 2.2.
+    PROFILE_MINIMUM_VERSION = (2, 2)
+
+    # The version of the Elasticsearch server, once it's been looked up.
+    __server_version = None
 
     CURRENT_ALIAS_SUFFIX = '-current'
     VERSION_RE = re.compile('-v([0-9]+)$')
@@ -39,6 +77,84 @@ class ExternalSearchIndex(object):
 
     SITEWIDE = True
 
+    # The IDs of the works that matched recent searches are kept in an
+    # in-process cache. These are the default limits on that cache;
+    # they can be overridden in the configuration file. A time to live
+    # of zero turns the cache off.
+    SEARCH_RESULT_CACHE_MAX_ENTRIES = 5000
+    SEARCH_RESULT_CACHE_TTL = 300
+
+    _search_result_cache = None
+
+    # Searches that take longer than this many seconds are logged,
+    # unless the configuration file says otherwise.
+    DEFAULT_SLOW_QUERY_THRESHOLD = 2
+
+    # Documents that fail to upload with one of these statuses are
+    # retried, up to BULK_RETRIES times, waiting longer each time.
+    RETRYABLE_BULK_STATUSES = set([429, 503])
+    BULK_RETRIES = 4
+    BULK_BACKOFF = 0.5
+
+    # Whether several threads can upload documents at once.
+    CONCURRENT_UPLOADS = True
+
+    # Documents are uploaded in chunks, whose size is adjusted so
+    # that each chunk takes about TARGET_BULK_SECONDS to upload.
+    bulk_chunk_size = 500
+    MIN_BULK_CHUNK_SIZE = 50
+    MAX_BULK_CHUNK_SIZE = 2000
+    TARGET_BULK_SECONDS = 5
+
+    @classmethod
+    def search_result_cache(cls):
+        """The LRUCache of search results used by this process."""
+        if cls._search_result_cache is None:
+            max_entries = cls.SEARCH_RESULT_CACHE_MAX_ENTRIES
+            ttl = cls.SEARCH_RESULT_CACHE_TTL
+            if Configuration.instance is not None:
+                max_entries = int(Configuration.get(
+                    Configuration.SEARCH_RESULT_CACHE_MAX_ENTRIES,
+                    max_entries
+                ))
+                ttl = int(Configuration.get(
+                    Configuration.SEARCH_RESULT_CACHE_TTL, ttl
+                ))
+            if ttl <= 0:
+                max_entries = 0
+            # Subclasses share the same cache.
+            ExternalSearchIndex._search_result_cache = LRUCache(
+                max_entries, ttl=ttl
+            )
+        return ExternalSearchIndex._search_result_cache
+
+    @classmethod
+    def reset_search_result_cache(cls):
+        """Throw away the in-process cache of search results."""
+        ExternalSearchIndex._search_result_cache = None
+
+    @classmethod
+    def search_result_cache_stats(cls):
+        """Summarize the performance of the search result cache."""
+        stats = cls.search_result_cache().stats
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            stats['hit_rate'] = stats['hits'] / float(lookups)
+        else:
+            stats['hit_rate'] = 0.0
+        return stats
+
+    def __new__(cls, _db=None, *args, **kwargs):
+        """If the site is set up to search its own database rather than
+        Elasticsearch, create a PostgresSearchIndex instead.
+        """
+        if cls is ExternalSearchIndex and _db and ExternalIntegration.lookup(
+                _db, ExternalIntegration.POSTGRES_SEARCH,
+                goal=ExternalIntegration.SEARCH_GOAL
+        ):
+            cls = PostgresSearchIndex
+        return super(ExternalSearchIndex, cls).__new__(cls)
+
     @classmethod
     def reset(cls):
         """Resets the __client object to None so a new configuration
@@ -47,12 +163,14 @@ class ExternalSearchIndex(object):
         This method is only intended for use in testing.
         """
         cls.__client = None
+        cls.__server_version = None
 
     def __init__(self, _db, url=None, works_index=None):
     
         self.log = logging.getLogger("External search index")
         self.works_index = None
         self.works_alias = None
+        self._db = _db
         integration = None
 
         if not _db:
@@ -94,6 +212,9 @@ class ExternalSearchIndex(object):
         self.index = self.__client.index
         self.delete = self.__client.delete
         self.exists = self.__client.exists
+        self.get = self.__client.get
+        self.count = self.__client.count
+        self.info = self.__client.info
 
         # Sets self.works_index and self.works_alias values.
         # Document upload runs against the works_index.
@@ -101,6 +222,8 @@ class ExternalSearchIndex(object):
         if works_index and integration:
             self.set_works_index_and_alias(works_index)
             self.update_integration_settings(integration)
+        if integration:
+            self.integration_id = integration.id
 
         def bulk(docs, **kwargs):
             return elasticsearch_bulk(self.__client, docs, **kwargs)
@@ -208,6 +331,115 @@ class ExternalSearchIndex(object):
             return
         _set_works_alias(alias_name)
 
+    @property
+    def migration_index(self):
+        """The new index the works index is being migrated to, if any.
+
+        This is looked up every time, through the cached
+        ConfigurationSetting, so a process starts writing to the new
+        index once its cached setting is invalidated. Processes that
+        don't listen for changes may not notice for a while, which is
+        why MigrateSearchIndexScript refreshes every work that changed
+        during the migration before finishing it.
+        """
+        if not self._db or not self.integration_id:
+            return None
+        integration = ExternalIntegration.by_id(self._db, self.integration_id)
+        if not integration:
+            return None
+        return integration.setting(self.WORKS_MIGRATION_INDEX_KEY).value
+
+    @property
+    def write_indices(self):
+        """The indexes that new and updated documents are written to."""
+        indices = [self.works_index]
+        migration_index = self.migration_index
+        if migration_index and migration_index != self.works_index:
+            indices.append(migration_index)
+        return indices
+
+    def _migration_setting(self):
+        integration = ExternalIntegration.by_id(self._db, self.integration_id)
+        return integration.setting(self.WORKS_MIGRATION_INDEX_KEY)
+
+    def start_migration(self, new_index):
+        """Create a new index and start writing documents to it as
+        well as to the current index.
+
+        The new index still has to be backfilled with every work
+        before the migration can be finished.
+        """
+        if not self.integration_id:
+            raise CannotLoadConfiguration(
+                "Cannot migrate an index that wasn't loaded from an integration."
+            )
+        if not self.index_exists(new_index):
+            self.setup_index(new_index)
+        self._migration_setting().value = unicode(new_index)
+
+    def finish_migration(self):
+        """Point the -current alias at the new index and stop writing
+        to the old one.
+        """
+        new_index = self.migration_index
+        if not new_index:
+            raise ValueError("No index migration is in progress.")
+        self.transfer_current_alias(new_index)
+        integration = ExternalIntegration.by_id(self._db, self.integration_id)
+        self.update_integration_settings(integration, force=True)
+        self._migration_setting().value = None
+
+    def check_migration(self, sample_size=100):
+        """Compare the index being migrated to with the current index.
+
+        :param sample_size: The number of presentation-ready works
+        whose documents are compared.
+
+        :return: A list of problems. If it's empty, the new index is
+        ready to be used.
+        """
+        old_index = self.works_index
+        new_index = self.migration_index
+        if not new_index:
+            return ["No index migration is in progress."]
+        problems = []
+        doc_type = self.work_document_type
+
+        old_count = self.count(index=old_index, doc_type=doc_type)['count']
+        new_count = self.count(index=new_index, doc_type=doc_type)['count']
+        if old_count != new_count:
+            problems.append(
+                "%s has %d documents, but %s has %d." % (
+                    old_index, old_count, new_index, new_count
+                )
+            )
+
+        sample = self._db.query(Work.id).filter(
+            Work.presentation_ready==True
+        ).order_by(func.random()).limit(sample_size)
+        for [work_id] in sample:
+            old_doc = self._get_source(old_index, work_id)
+            new_doc = self._get_source(new_index, work_id)
+            if old_doc != new_doc:
+                problems.append(
+                    "Document for work %d differs between %s and %s." % (
+                        work_id, old_index, new_index
+                    )
+                )
+        return problems
+
+    def _get_source(self, index, id):
+        """Find the source of a document, without any metadata."""
+        args = dict(index=index, doc_type=self.work_document_type, id=id)
+        if not self.exists(**args):
+            return None
+        source = self.get(**args)['_source']
+        return dict((k, v) for k, v in source.items() if not k.startswith('_'))
+
+    def index_exists(self, index):
+        """Has the given index been created?"""
+        return self.indices.exists(index=index)
+
     def setup_index(self, new_index=None):
         """Create the search index with appropriate mapping.
 
@@ -271,7 +503,17 @@ class ExternalSearchIndex(object):
         return base_works_index
 
     def query_works(self, query_string, media, languages, exclude_languages, fiction, audience,
-                    age_range, in_any_of_these_genres=[], fields=None, size=30, offset=0):
+                    age_range, in_any_of_these_genres=[], fields=None, size=30, offset=0,
+                    lane_name=None):
+        """Run a search against the works index.
+
+        Results are cached for a short time. A cached result only
+        contains the _id of each matching work, and the requested
+        `fields`, if any.
+
+        :param lane_name: The name of the lane being searched. How
+        long the search took is recorded under this name.
+        """
         if not self.works_alias:
             return []
 
@@ -279,6 +521,14 @@ class ExternalSearchIndex(object):
             media, languages, exclude_languages, fiction, audience,
             age_range, in_any_of_these_genres
         )
+        cache = self.search_result_cache()
+        key = self.search_result_cache_key(
+            query_string, filter, size, offset, fields
+        )
+        hits = cache.get(key)
+        if hits is not None:
+            return dict(hits=dict(hits=hits))
+
         q = dict(
             filtered=dict(
                 query=self.make_query(query_string),
@@ -294,11 +544,112 @@ class ExternalSearchIndex(object):
         )
         if fields is not None:
             search_args['fields'] = fields
+        profile = self.search_profiling_enabled() and self.can_profile()
+        if profile:
+            search_args['body']['profile'] = True
         #print "Args looks like: %r" % args
+        a = time.time()
         results = self.search(**search_args)
+        b = time.time()
         #print "Results: %r" % results
+        self.record_search_timing(
+            lane_name, b-a, search_args['body'], results.get('profile')
+        )
+        hits = []
+        for hit in results['hits']['hits']:
+            cached = dict(_id=hit['_id'])
+            if fields is not None:
+                cached['fields'] = hit.get('fields', {})
+            hits.append(cached)
+        cache.set(key, hits)
         return results
 
+    @classmethod
+    def search_profiling_enabled(cls):
+        """Should Elasticsearch profile every query?"""
+        if Configuration.instance is None:
+            return False
+        return bool(Configuration.get(Configuration.SEARCH_PROFILE, False))
+
+    def server_version(self):
+        """Find the version of the Elasticsearch server.
+
+        :return: A tuple of integers, e.g. (2, 1, 0).
+        """
+        if ExternalSearchIndex.__server_version is None:
+            number = self.info()['version']['number']
+            version = []
+            for part in number.split('.'):
+                match = re.match('[0-9]+', part)
+                if not match:
+                    break
+                version.append(int(match.group()))
+            ExternalSearchIndex.__server_version = tuple(version)
+        return ExternalSearchIndex.__server_version
+
+    def can_profile(self):
+        """Can the Elasticsearch server profile queries?"""
+        try:
+            version = self.server_version()
+        except Exception, e:
+            self.log.error(
+                "Could not find the Elasticsearch version; not profiling.",
+                exc_info=e
+            )
+            return False
+        if version < self.PROFILE_MINIMUM_VERSION:
+            self.log.warn(
+                "Search profiling is turned on, but Elasticsearch %s can't profile queries; %s or later is required.",
+                ".".join(map(str, version)),
+                ".".join(map(str, self.PROFILE_MINIMUM_VERSION))
+            )
+            return False
+        return True
+
+    @classmethod
+    def slow_query_threshold(cls):
+        """How many seconds a search can take before it's logged."""
+        threshold = cls.DEFAULT_SLOW_QUERY_THRESHOLD
+        if Configuration.instance is not None:
+            threshold = float(Configuration.get(
+                Configuration.SEARCH_SLOW_QUERY_THRESHOLD, threshold
+            ))
+        return threshold
+
+    def record_search_timing(self, lane_name, elapsed, body, profile=None):
+        """Note how long a search took, and log it if it was slow.
+
+        :param elapsed: The number of seconds the search took.
+        :param body: The query that was sent to Elasticsearch.
+        :param profile: The profile Elasticsearch sent back, if any.
+        """
+        search_timings.record(lane_name, elapsed, profile)
+        if elapsed >= self.slow_query_threshold():
+            self.log.warn(
+                "Slow search in lane %s took %.2fsec: %s",
+                lane_name, elapsed, json.dumps(body)
+            )
+
+    def search_result_cache_key(self, query_string, filter, size, offset,
+                                fields=None):
+        """Find the key under which the results of a search are cached.
+
+        The key includes the version of the index the works alias
+        points to, so that results from an old index aren't used once
+        the alias has been moved to a new one.
+        """
+        generation = None
+        if self.works_index:
+            match = self.VERSION_RE.search(self.works_index)
+            if match:
+                generation = match.groups()[0]
+        normalized = u" ".join(query_string.lower().split())
+        return json.dumps(
+            [self.works_alias, generation, normalized, filter, size, offset,
+             fields],
+            sort_keys=True
+        )
+
     def make_query(self, query_string):
 
         def make_query_string_query(query_string, fields):
@@ -601,61 +952,721 @@ class ExternalSearchIndex(object):
             doc["_type"] = self.work_document_type
         time2 = time.time()
 
-        success_count, errors = self.bulk(
-            docs,
-            raise_on_error=False,
-            raise_on_exception=False,
-        )
+        # While the index is being migrated, documents are written to
+        # the new index as well as the current one.
+        uploads = list(docs)
+        for index in self.write_indices[1:]:
+            uploads.extend(dict(doc, _index=index) for doc in docs)
 
-        # If the entire update failed, try it one more time before giving up on the batch.
-        if retry_on_batch_failure and len(errors) == len(docs):
-            self.log.info("Elasticsearch bulk update timed out, trying again.")
-            return self.bulk_update(works, retry_on_batch_failure=False)
+        success_count, errors = self.bulk_upload(
+            uploads, retry_on_batch_failure=retry_on_batch_failure
+        )
 
         time3 = time.time()
         self.log.info("Created %i search documents in %.2f seconds" % (len(docs), time2 - time1))
         self.log.info("Uploaded %i search documents in  %.2f seconds" % (len(docs), time3 - time2))
         
-        doc_ids = [d['_id'] for d in docs]
-        
-        # We weren't able to create search documents for these works, maybe
-        # because they don't have presentation editions yet.
-        missing_works = [work for work in works if work.id not in doc_ids]
-            
-        error_ids = [
-            error.get('data', {}).get("_id", None) or
-            error.get('index', {}).get('_id', None)
-            for error in errors
-        ]
+        # Elasticsearch reports document IDs as strings.
+        doc_ids = set(unicode(d['_id']) for d in docs)
+        error_ids = set(self.bulk_error_id(error) for error in errors)
+        works_by_id = dict((unicode(work.id), work) for work in works)
 
-        successes = [work for work in works if work.id in doc_ids and work.id not in error_ids]
+        successes = [work for work in works
+                     if unicode(work.id) in doc_ids
+                     and unicode(work.id) not in error_ids]
 
+        # We weren't able to create search documents for these works, maybe
+        # because they don't have presentation editions yet.
         failures = []
-        for missing in missing_works:
+        for missing in works:
+            if unicode(missing.id) in doc_ids:
+                continue
             if not missing.presentation_ready:
-                failures.append((work, "Work not indexed because not presentation-ready."))
+                failures.append((missing, "Work not indexed because not presentation-ready."))
             else:
-                failures.append((work, "Work not indexed"))
+                failures.append((missing, "Work not indexed"))
 
         for error in errors:
-            error_id = error.get('data', {}).get('_id', None) or error.get('index', {}).get('_id', None)
-
-            work = None
-            works_with_error = [work for work in works if work.id == error_id]
-            if works_with_error:
-                work = works_with_error[0]
-
-            exception = error.get('exception', None)
+            work = works_by_id.get(self.bulk_error_id(error))
             error_message = error.get('error', None)
             if not error_message:
                 error_message = error.get('index', {}).get('error', None)
-
             failures.append((work, error_message))
 
         self.log.info("Successfully indexed %i documents, failed to index %i." % (success_count, len(failures)))
 
         return successes, failures
 
+    def bulk_upload(self, docs, retry_on_batch_failure=True):
+        """Upload search documents in chunks, retrying the ones that fail
+        for reasons that may not last.
+
+        The chunk size adapts to how long Elasticsearch takes to
+        respond.
+
+        :param retry_on_batch_failure: If every document in a chunk
+        fails, try the whole chunk one more time, whatever the reason.
+
+        :return: A 2-tuple (success_count, errors), where `errors`
+        holds the final error for each document that never made it.
+        """
+        success_count = 0
+        errors = []
+        position = 0
+        while position < len(docs):
+            chunk = docs[position:position+self.bulk_chunk_size]
+            position += len(chunk)
+            chunk_success_count, chunk_errors = self._bulk_upload_chunk(
+                chunk, retry_on_batch_failure
+            )
+            success_count += chunk_success_count
+            errors.extend(chunk_errors)
+        return success_count, errors
+
+    def _bulk_upload_chunk(self, docs, retry_on_batch_failure):
+        success_count = 0
+        final_errors = {}
+        unknown_errors = []
+        attempt = 0
+        while docs:
+            a = time.time()
+            count, errors = self.bulk(
+                docs,
+                raise_on_error=False,
+                raise_on_exception=False,
+            )
+            self.adapt_bulk_chunk_size(len(docs), time.time() - a)
+            success_count += count
+
+            # The same document may be uploaded to more than one
+            # index, so errors are matched to documents by index as
+            # well as ID, if the error says which index it's about.
+            errors_by_key = dict()
+            for error in errors:
+                key = self.bulk_error_key(error)
+                if key is None:
+                    unknown_errors.append(error)
+                else:
+                    errors_by_key[key] = error
+            batch_failed = errors and len(errors) == len(docs)
+
+            retry = []
+            for doc in docs:
+                key = (doc.get('_index', None), unicode(doc['_id']))
+                error = (errors_by_key.get(key)
+                         or errors_by_key.get((None, key[1])))
+                if error is None:
+                    final_errors.pop(key, None)
+                    continue
+                final_errors[key] = error
+                if (attempt < self.BULK_RETRIES
+                    and self.bulk_error_is_retryable(error)):
+                    retry.append(doc)
+                elif batch_failed and attempt == 0 and retry_on_batch_failure:
+                    retry.append(doc)
+
+            docs = retry
+            if docs:
+                delay = self.bulk_retry_delay(attempt)
+                self.log.info(
+                    "Retrying %d search documents in %.2f seconds.",
+                    len(docs), delay
+                )
+                self._sleep(delay)
+            attempt += 1
+        return success_count, final_errors.values() + unknown_errors
+
+    @classmethod
+    def bulk_error_key(cls, error):
+        """Find the index and ID of the document a bulk upload error
+        is about.
+
+        Elasticsearch reports IDs as strings whatever type they were
+        uploaded as, so the ID is always returned as a string.
+
+        :return: A 2-tuple (index, id), or None if the error doesn't
+        say which document it's about.
+        """
+        index = error.get('index', {})
+        for info in (error.get('data', {}), index, index.get('data', {}),
+                     index.get('index', {})):
+            if not isinstance(info, dict):
+                continue
+            if info.get('_id', None) is not None:
+                return info.get('_index', None), unicode(info['_id'])
+        return None
+
+    @classmethod
+    def bulk_error_id(cls, error):
+        """Find the ID of the document a bulk upload error is about,
+        as a string.
+        """
+        key = cls.bulk_error_key(error)
+        if key is None:
+            return None
+        return key[1]
+
+    @classmethod
+    def bulk_error_is_retryable(cls, error):
+        """Might the document succeed if it's uploaded again later?
+
+        True if Elasticsearch said it was overloaded or unavailable.
+        """
+        status = error.get('status', None) or error.get('index', {}).get('status', None)
+        try:
+            status = int(status)
+        except (TypeError, ValueError):
+            return False
+        return status in cls.RETRYABLE_BULK_STATUSES
+
+    def bulk_retry_delay(self, attempt):
+        """How long to wait before retrying, with full jitter."""
+        return random.uniform(0, self.BULK_BACKOFF * (2 ** attempt))
+
+    def adapt_bulk_chunk_size(self, size, elapsed):
+        """Make chunks smaller if Elasticsearch is struggling to keep
+        up, and bigger if it's handling them easily.
+        """
+        if elapsed > self.TARGET_BULK_SECONDS:
+            new_size = max(self.MIN_BULK_CHUNK_SIZE, size / 2)
+        elif (elapsed < self.TARGET_BULK_SECONDS / 4.0
+              and size >= self.bulk_chunk_size):
+            new_size = min(self.MAX_BULK_CHUNK_SIZE, int(size * 1.5))
+        else:
+            return
+        if new_size != self.bulk_chunk_size:
+            self.log.info("Bulk upload chunk size is now %d.", new_size)
+            self.bulk_chunk_size = new_size
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SearchTimings(object):
+    """Keep track of how long searches take, per lane.
+
+    For each lane there's a histogram of search times, and if
+    Elasticsearch is profiling queries, the total time spent in each
+    type of query clause.
+    """
+
+    # The upper bounds, in seconds, of the histogram buckets. Searches
+    # slower than the last bound go into an overflow bucket.
+    BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+    OVERFLOW = 'slower'
+
+    # Units Elasticsearch may use when reporting how long a clause took.
+    UNITS = dict(nanos=1e-9, micros=1e-6, ms=1e-3, s=1)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = defaultdict(Counter)
+            self.clause_times = defaultdict(Counter)
+
+    def bucket(self, elapsed):
+        for bound in self.BUCKETS:
+            if elapsed <= bound:
+                return bound
+        return self.OVERFLOW
+
+    def record(self, lane_name, elapsed, profile=None):
+        """Record one search.
+
+        :param elapsed: The number of seconds the search took.
+        :param profile: The 'profile' section of Elasticsearch's
+        response, if the query was profiled.
+        """
+        clauses = Counter()
+        if profile:
+            for shard in profile.get('shards', []):
+                for search in shard.get('searches', []):
+                    for query in search.get('query', []):
+                        self._add_clause_times(query, clauses)
+        with self.lock:
+            self.histograms[lane_name][self.bucket(elapsed)] += 1
+            self.clause_times[lane_name].update(clauses)
+
+    @classmethod
+    def _add_clause_times(cls, query, clauses):
+        """Add up the time spent in a profiled clause and the clauses
+        beneath it, in seconds, by type of clause.
+
+        The time of a clause includes the time of its children, so
+        only the time not accounted for by the children is counted
+        against the clause itself.
+        """
+        total = cls.clause_time(query)
+        children = query.get('children', [])
+        for child in children:
+            total -= cls.clause_time(child)
+            cls._add_clause_times(child, clauses)
+        clauses[query.get('query_type', query.get('type'))] += max(total, 0)
+
+    @classmethod
+    def clause_time(cls, query):
+        """How many seconds a profiled clause took, including its
+        children.
+
+        Depending on the version, Elasticsearch reports this either
+        as a number of nanoseconds or as a string like '1.2ms'.
+        """
+        if 'time_in_nanos' in query:
+            return query['time_in_nanos'] * 1e-9
+        value = query.get('time')
+        if not value:
+            return 0
+        match = re.match('([0-9.]+)([a-z]+)$', value)
+        if not match:
+            return 0
+        number, unit = match.groups()
+        return float(number) * cls.UNITS.get(unit, 0)
+
+    def summary(self):
+        """Summarize the searches recorded so far."""
+        with self.lock:
+            return dict(
+                (lane_name, dict(
+                    histogram=dict(histogram),
+                    clauses=dict(self.clause_times[lane_name]),
+                ))
+                for lane_name, histogram in self.histograms.items()
+            )
+
+# Search times are recorded here for the whole process.
+search_timings = SearchTimings()
+
+
+class SearchIndexCoverageProvider(WorkCoverageProvider):
+    """Bring the search documents for works up to date, in bulk.
+
+    Works are queued for this provider by
+    Work.external_index_needs_updating().
+    """
+
+    SERVICE_NAME = "Search index coverage provider"
+    OPERATION = WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+    DEFAULT_BATCH_SIZE = 500
+
+    def __init__(self, _db, *args, **kwargs):
+        search_index_client = kwargs.pop('search_index_client', None)
+        super(SearchIndexCoverageProvider, self).__init__(_db, *args, **kwargs)
+        self.search_index_client = (
+            search_index_client or ExternalSearchIndex(_db)
+        )
+        # How long, in seconds, the oldest work in the most recent
+        # batch had been waiting to be indexed.
+        self.lag = None
+
+        # The timestamp each work's queue record had when the current
+        # batch was claimed, by work ID.
+        self.claimed = {}
+
+    def process_batch(self, works):
+        self.lag = self.measure_lag(works)
+        self.claimed = self.claim(works)
+        if self.lag is not None:
+            self.log.info(
+                "Oldest search index update in this batch was queued %.2f sec ago.",
+                self.lag
+            )
+        results = []
+        ready = []
+        client = self.search_index_client
+        for work in works:
+            if work.presentation_ready:
+                ready.append(work)
+                continue
+            # This work shouldn't be in the index at all.
+            for index in client.write_indices:
+                args = dict(index=index,
+                            doc_type=client.work_document_type,
+                            id=work.id)
+                if client.exists(**args):
+                    client.delete(**args)
+            results.append(work)
+
+        if ready:
+            successes, failures = client.bulk_update(ready)
+            results.extend(successes)
+
+            # bulk_update has already retried these works. If other
+            # works went through, the problem is with these works
+            # rather than the search index, so their coverage records
+            # are kept as persistent failures until the works change
+            # again. Otherwise they'll be tried again next time.
+            transient = not successes
+            for work, error in failures:
+                if work:
+                    results.append(
+                        self.failure(work, error, transient=transient)
+                    )
+        return results
+
+    def claim(self, works):
+        """Note the timestamp on each work's queue record as of the
+        start of this batch.
+
+        No locks are taken. Anyone who queues one of the works again
+        while the batch is being indexed gives its record a new
+        timestamp, and `add_coverage_records` leaves such records
+        queued rather than marking them as indexed.
+
+        :return: A dictionary mapping work IDs to timestamps.
+        """
+        ids = [work.id for work in works]
+        if not ids:
+            return {}
+        claimed = dict(self._db.query(
+            WorkCoverageRecord.work_id, WorkCoverageRecord.timestamp
+        ).filter(
+            WorkCoverageRecord.work_id.in_(ids)
+        ).filter(
+            WorkCoverageRecord.operation==self.operation
+        ))
+        unqueued = [work for work in works if work.id not in claimed]
+        if unqueued:
+            # Give these works queue records of their own, so there's
+            # something to compare against when the batch is done.
+            records = WorkCoverageRecord.bulk_add(self._db, [
+                (work, self.operation, WorkCoverageRecord.REGISTERED,
+                 None, None)
+                for work in unqueued
+            ])
+            self._db.commit()
+            for record in records:
+                claimed[record.work_id] = record.timestamp
+        return claimed
+
+    def add_coverage_records(self, results):
+        """Record the outcome of the batch, but only for works that
+        haven't been queued again since the batch was claimed. Those
+        stay queued, so their latest changes get indexed next time.
+        """
+        rows = []
+        for result in results:
+            if isinstance(result, CoverageFailure):
+                work, status, exception = (
+                    result.obj, result.status, result.exception
+                )
+            else:
+                work, status, exception = (
+                    result, WorkCoverageRecord.SUCCESS, None
+                )
+            rows.append((work, self.claimed.get(work.id), status, exception))
+        return WorkCoverageRecord.bulk_update_if_unchanged(
+            self._db, self.operation, rows
+        )
+
+    def measure_lag(self, works):
+        """Find how long the longest-waiting of these works has been
+        waiting for its search document to be updated, since it was
+        last queued.
+
+        :return: A number of seconds, or None if none of the works
+        were queued.
+        """
+        ids = [work.id for work in works]
+        if not ids:
+            return None
+        [[oldest]] = self._db.query(
+            func.min(WorkCoverageRecord.timestamp)
+        ).filter(
+            WorkCoverageRecord.work_id.in_(ids)
+        ).filter(
+            WorkCoverageRecord.operation==self.operation
+        ).filter(
+            WorkCoverageRecord.status==WorkCoverageRecord.REGISTERED
+        )
+        if not oldest:
+            return None
+        return (datetime.datetime.utcnow() - oldest).total_seconds()
+
+
+class SearchIndexRebuild(object):
+    """Build search documents for every presentation-ready work and
+    upload them into an index, then point the -current alias at that
+    index.
+
+    Documents are read from the database through a server-side
+    cursor and uploaded by a pool of worker threads while the next
+    batches are being read, so memory use is bounded no matter how
+    many works there are. Progress is checkpointed in a Timestamp,
+    so an interrupted rebuild picks up where it left off.
+    """
+
+    SERVICE_NAME = "Search index rebuild"
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_WORKERS = 2
+
+    def __init__(self, _db, search_index_client, new_index,
+                 batch_size=None, workers=None):
+        self._db = _db
+        self.search_index_client = search_index_client
+        self.new_index = new_index
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.workers = workers or self.DEFAULT_WORKERS
+        self.log = logging.getLogger(self.SERVICE_NAME)
+        self.uploaded = 0
+        self.failures = 0
+
+    @property
+    def service_name(self):
+        return "%s: %s" % (self.SERVICE_NAME, self.new_index)
+
+    @property
+    def operation(self):
+        """Works whose documents couldn't be uploaded to the new index
+        get WorkCoverageRecords for this operation. It's kept separate
+        from the operation that queues works for
+        SearchIndexCoverageProvider, so a rebuild doesn't disturb the
+        live queue.
+        """
+        return u"%s %s" % (
+            WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION, self.new_index
+        )
+
+    def dead_letters(self):
+        """Find the works whose documents couldn't be uploaded to the
+        new index, in this run or an earlier one.
+        """
+        return self._db.query(WorkCoverageRecord).filter(
+            WorkCoverageRecord.operation==self.operation
+        ).filter(
+            WorkCoverageRecord.status==WorkCoverageRecord.PERSISTENT_FAILURE
+        )
+
+    def run(self, transfer_alias=True, force=False):
+        """Upload every document that hasn't been uploaded yet.
+
+        :param transfer_alias: If this is True, the -current alias is
+        moved to the new index once every document has been uploaded.
+
+        :param force: Move the alias even if some documents couldn't be
+        uploaded.
+
+        :return: The number of works whose documents couldn't be
+        uploaded to the new index, including any from earlier runs.
+        """
+        checkpoint = Timestamp.stamp(self._db, self.service_name, None)
+        if checkpoint.counter is None:
+            checkpoint.counter = 0
+        if checkpoint.counter:
+            self.log.info(
+                "Resuming rebuild of %s after work %d.",
+                self.new_index, checkpoint.counter
+            )
+        self._db.commit()
+
+        # The documents are read through a connection of their own, so
+        # that committing checkpoints doesn't close the cursor.
+        connection = self._db.get_bind().connect()
+        try:
+            docs = Work.stream_search_documents(
+                connection, after=checkpoint.counter
+            )
+            self.upload(docs, checkpoint)
+        finally:
+            connection.close()
+
+        self.log.info(
+            "Uploaded %d documents to %s, %d failed.",
+            self.uploaded, self.new_index, self.failures
+        )
+        failed = self.dead_letters().count()
+        if transfer_alias:
+            if failed and not force:
+                self.log.error(
+                    "Not moving the alias to %s: %d works are missing from it.",
+                    self.new_index, failed
+                )
+            else:
+                self.search_index_client.transfer_current_alias(
+                    self.new_index
+                )
+        return failed
+
+    def dead_letter(self, error):
+        """Record that a work's document couldn't be uploaded even
+        after being retried, so it isn't silently left out.
+        """
+        client = self.search_index_client
+        work = get_one(self._db, Work, id=client.bulk_error_id(error))
+        if not work:
+            return
+        record, is_new = WorkCoverageRecord.add_for(
+            work, operation=self.operation,
+            status=WorkCoverageRecord.PERSISTENT_FAILURE
+        )
+        message = error.get('error', None) or error.get('index', {}).get('error', None)
+        record.exception = unicode(message)
+
+    def refresh_changed_works(self, since=None):
+        """Upload fresh documents to the new index for every work that
+        was queued for a search index update at or after `since`.
+
+        The backfill reads documents from a snapshot, so it may have
+        overwritten newer documents that were written to the new
+        index while it ran. And a process that hadn't yet noticed the
+        migration may have updated a work in the current index only.
+
+        :param since: If this is None, every work that has ever been
+        queued is refreshed.
+
+        :return: The number of works refreshed.
+        """
+        client = self.search_index_client
+        changed = self._db.query(Work).join(
+            WorkCoverageRecord, WorkCoverageRecord.work_id==Work.id
+        ).filter(
+            WorkCoverageRecord.operation==WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        )
+        if since:
+            changed = changed.filter(WorkCoverageRecord.timestamp >= since)
+        refreshed = 0
+        after = 0
+        while True:
+            works = changed.filter(Work.id > after).order_by(Work.id).limit(
+                self.batch_size
+            ).all()
+            if not works:
+                break
+            after = works[-1].id
+            ready = []
+            for work in works:
+                if work.presentation_ready:
+                    ready.append(work)
+                    continue
+                # This work shouldn't be in the new index at all.
+                args = dict(index=self.new_index,
+                            doc_type=client.work_document_type,
+                            id=work.id)
+                if client.exists(**args):
+                    client.delete(**args)
+            docs = []
+            if ready:
+                docs = Work.to_search_documents(ready)
+            for doc in docs:
+                doc["_index"] = self.new_index
+                doc["_type"] = client.work_document_type
+            if docs:
+                success_count, errors = client.bulk_upload(docs)
+                for error in errors:
+                    self.log.error("Failed to upload document: %r", error)
+                    self.dead_letter(error)
+            self._db.commit()
+            refreshed += len(works)
+        return refreshed
+
+    def batches(self, docs):
+        """Group documents into batches for upload."""
+        batch = []
+        for doc in docs:
+            doc["_index"] = self.new_index
+            doc["_type"] = self.search_index_client.work_document_type
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def upload(self, docs, checkpoint):
+        """Hand batches of documents to the worker threads, and advance
+        the checkpoint as they're uploaded.
+
+        Batches may finish out of order, so the checkpoint only moves
+        past a batch once it and every batch before it are done.
+        """
+        # Only a few batches wait for a worker at any one time, so
+        # reading from the database can't get far ahead of uploading.
+        todo = Queue(maxsize=self.workers * 2)
+        done = Queue()
+        threads = []
+        workers = self.workers
+        if not self.search_index_client.CONCURRENT_UPLOADS:
+            # Upload each batch as soon as it's read.
+            workers = 0
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, args=(todo, done))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        # The last work ID in each batch that's been handed out but not
+        # yet checkpointed, keyed by the order the batches were read.
+        last_ids = {}
+        finished = set()
+        state = dict(next=0, error=None)
+
+        def record(result):
+            number, success_count, errors, exception = result
+            if exception:
+                state['error'] = state['error'] or exception
+                return
+            self.uploaded += success_count
+            self.failures += len(errors)
+            for error in errors:
+                self.log.error("Failed to upload document: %r", error)
+                self.dead_letter(error)
+            finished.add(number)
+            advanced = False
+            while state['next'] in finished:
+                finished.remove(state['next'])
+                checkpoint.counter = last_ids.pop(state['next'])
+                state['next'] += 1
+                advanced = True
+            if advanced:
+                self._db.commit()
+
+        def drain(block=False):
+            while True:
+                try:
+                    record(done.get(block=block))
+                except Empty:
+                    return
+                block = False
+
+        try:
+            for number, batch in enumerate(self.batches(docs)):
+                last_ids[number] = batch[-1]['_id']
+                if threads:
+                    todo.put((number, batch))
+                    drain()
+                else:
+                    record(self._upload(number, batch))
+                if state['error']:
+                    break
+        finally:
+            for thread in threads:
+                todo.put(None)
+            for thread in threads:
+                thread.join()
+            drain()
+        if state['error']:
+            raise state['error']
+
+    def _work(self, todo, done):
+        """Upload batches until told to stop."""
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            done.put(self._upload(*item))
+
+    def _upload(self, number, batch):
+        try:
+            success_count, errors = self.search_index_client.bulk_upload(
+                batch
+            )
+            return (number, success_count, errors, None)
+        except Exception, e:
+            self.log.error("Error uploading batch.", exc_info=e)
+            return (number, 0, [], e)
+
 
 class ExternalSearchIndexVersions(object):
 
@@ -742,13 +1753,252 @@ class ExternalSearchIndexVersions(object):
             version = 'v%s' % version
 
         versioned_index = base_index_name+'-'+version
-        if search_client.indices.exists(index=versioned_index):
+        if search_client.index_exists(versioned_index):
             return False
         else:
             search_client.setup_index(new_index=versioned_index)
             return True
 
 
+class PostgresSearchIndex(ExternalSearchIndex):
+    """Search the database's own full-text index instead of
+    Elasticsearch.
+
+    Search documents are stored in the searchdocuments table, with a
+    weighted tsvector over the fields that matter most for search.
+    This is good enough for a small library, and means there's no
+    separate search service to run.
+    """
+
+    NAME = ExternalIntegration.POSTGRES_SEARCH
+    SETTINGS = []
+
+    # Documents are written through the database session, which
+    # can't be shared between threads.
+    CONCURRENT_UPLOADS = False
+
+    # The text search configuration used to build and query the
+    # search vectors.
+    TEXT_SEARCH_CONFIG = 'english'
+
+    def __init__(self, _db, url=None, works_index=None):
+        self.log = logging.getLogger("Postgres search index")
+        self._db = _db
+        self.integration_id = None
+        integration = ExternalIntegration.lookup(
+            _db, ExternalIntegration.POSTGRES_SEARCH,
+            goal=ExternalIntegration.SEARCH_GOAL
+        )
+        if integration:
+            self.integration_id = integration.id
+            works_index = works_index or integration.setting(
+                self.WORKS_INDEX_KEY).value
+        self.works_index = works_index or self.DEFAULT_WORKS_INDEX
+        # There are no aliases; searches run against the index itself.
+        self.works_alias = self.works_index
+
+    def _documents(self, index):
+        return self._db.query(SearchDocument).filter(
+            SearchDocument.index_name==index
+        )
+
+    def _document(self, index, id):
+        return self._documents(index).filter(
+            SearchDocument.work_id==int(id)
+        ).first()
+
+    def index(self, index, doc_type, id, body):
+        document = self._document(index, id)
+        if not document:
+            document = SearchDocument(index_name=unicode(index), work_id=int(id))
+            self._db.add(document)
+        self._fill(document, body)
+
+    def delete(self, index, doc_type, id):
+        self._documents(index).filter(
+            SearchDocument.work_id==int(id)
+        ).delete(synchronize_session='fetch')
+
+    def exists(self, index, doc_type, id):
+        return self._document(index, id) is not None
+
+    def get(self, index, doc_type, id):
+        return dict(_source=self._document(index, id).document)
+
+    def count(self, index, doc_type):
+        return dict(count=self._documents(index).count())
+
+    def bulk(self, docs, **kwargs):
+        for doc in docs:
+            self.index(doc['_index'], doc['_type'], doc['_id'], doc)
+        return len(docs), []
+
+    def index_exists(self, index):
+        """An index is just a name on some rows, so it exists as soon
+        as it's in use.
+        """
+        if index in (self.works_index, self.migration_index):
+            return True
+        return self._db.query(self._documents(index).exists()).scalar()
+
+    def setup_index(self, new_index=None):
+        """Remove every document from an index."""
+        self._documents(new_index or self.works_index).delete(
+            synchronize_session=False
+        )
+
+    def transfer_current_alias(self, new_index):
+        """Start searching a different index, in this process and, once
+        the change is committed, every other one.
+        """
+        self.works_index = self.works_alias = new_index
+        if self.integration_id:
+            integration = ExternalIntegration.by_id(
+                self._db, self.integration_id
+            )
+            self.update_integration_settings(integration, force=True)
+
+    def update_integration_settings(self, integration, force=False):
+        if integration and force:
+            integration.setting(self.WORKS_INDEX_KEY).value = unicode(
+                self.works_index
+            )
+
+    def _fill(self, document, body):
+        """Copy a search document into a SearchDocument."""
+        def _f(s):
+            if not s:
+                return s
+            return s.lower().replace(" ", "")
+
+        document.document = dict(
+            (k, v) for k, v in body.items() if not k.startswith('_')
+        )
+        document.search_vector = self.search_vector(body)
+        document.medium = _f(body.get('medium'))
+        document.language = body.get('language')
+        document.audience = _f(body.get('audience'))
+        document.fiction = _f(body.get('fiction'))
+        target_age = body.get('target_age') or {}
+        document.target_age_lower = target_age.get('lower')
+        document.target_age_upper = target_age.get('upper')
+        document.genre_ids = [
+            int(genre['term']) for genre in body.get('genres') or []
+        ]
+        document.quality = body.get('quality')
+
+    @classmethod
+    def search_vector(cls, body):
+        """Build the SQL for a search document's weighted tsvector.
+
+        Titles and authors count the most, then subtitles and series,
+        then subjects and genres, then everything else.
+        """
+        def text(*values):
+            return u" ".join(unicode(v) for v in values if v)
+
+        contributors = [
+            c.get('sort_name') for c in body.get('contributors') or []
+        ]
+        subjects = (
+            [c.get('term') for c in body.get('classifications') or []]
+            + [g.get('name') for g in body.get('genres') or []]
+        )
+        weighted = [
+            ('A', text(body.get('title'), body.get('author'), *contributors)),
+            ('B', text(body.get('subtitle'), body.get('series'))),
+            ('C', text(*subjects)),
+            ('D', text(body.get('summary'), body.get('publisher'),
+                       body.get('imprint'))),
+        ]
+        vector = None
+        for weight, value in weighted:
+            part = func.setweight(
+                func.to_tsvector(cls.TEXT_SEARCH_CONFIG, value), weight
+            )
+            if vector is None:
+                vector = part
+            else:
+                vector = vector.op('||')(part)
+        return vector
+
+    def query_works(self, query_string, media, languages, exclude_languages, fiction, audience,
+                    age_range, in_any_of_these_genres=[], fields=None, size=30, offset=0,
+                    lane_name=None):
+        """Search the works index, best matches first.
+
+        The results look like the ones Elasticsearch returns, but each
+        hit only contains the work's _id.
+        """
+        tsquery = func.plainto_tsquery(self.TEXT_SEARCH_CONFIG, query_string)
+        rank = func.ts_rank_cd(SearchDocument.search_vector, tsquery)
+        qu = self._documents(self.works_index).with_entities(
+            SearchDocument.work_id
+        ).filter(
+            SearchDocument.search_vector.op('@@')(tsquery)
+        )
+        qu = self.apply_filter(
+            qu, media, languages, exclude_languages, fiction, audience,
+            age_range, in_any_of_these_genres
+        )
+        qu = qu.order_by(
+            rank.desc(), SearchDocument.quality.desc().nullslast(),
+            SearchDocument.work_id
+        ).offset(offset).limit(size)
+
+        a = time.time()
+        work_ids = [work_id for [work_id] in qu]
+        b = time.time()
+        self.record_search_timing(lane_name, b-a, dict(query=query_string))
+        return dict(hits=dict(hits=[dict(_id=unicode(x)) for x in work_ids]))
+
+    def apply_filter(self, qu, media, languages, exclude_languages, fiction,
+                     audience, age_range, genres):
+        """Restrict a query against SearchDocument the same way
+        make_filter restricts an Elasticsearch query.
+        """
+        def _f(s):
+            if not s:
+                return s
+            return s.lower().replace(" ", "")
+
+        if languages:
+            qu = qu.filter(SearchDocument.language.in_(list(languages)))
+        if exclude_languages:
+            qu = qu.filter(~SearchDocument.language.in_(list(exclude_languages)))
+        if genres:
+            if isinstance(genres[0], int):
+                genre_ids = genres
+            else:
+                genre_ids = [genre.id for genre in genres]
+            qu = qu.filter(SearchDocument.genre_ids.overlap(genre_ids))
+        if media:
+            qu = qu.filter(
+                SearchDocument.medium.in_([_f(medium) for medium in media])
+            )
+        if fiction == True:
+            qu = qu.filter(SearchDocument.fiction==u'fiction')
+        elif fiction == False:
+            qu = qu.filter(SearchDocument.fiction==u'nonfiction')
+        if audience:
+            if isinstance(audience, list) or isinstance(audience, set):
+                qu = qu.filter(
+                    SearchDocument.audience.in_([_f(aud) for aud in audience])
+                )
+        if age_range:
+            lower = age_range[0]
+            upper = age_range[-1]
+            qu = qu.filter(
+                and_(
+                    or_(SearchDocument.target_age_upper >= lower,
+                        SearchDocument.target_age_upper==None),
+                    or_(SearchDocument.target_age_lower <= upper,
+                        SearchDocument.target_age_lower==None),
+                )
+            )
+        return qu
+
+
 class DummyExternalSearchIndex(ExternalSearchIndex):
 
     work_document_type = 'work-type'
@@ -774,6 +2024,13 @@ class DummyExternalSearchIndex(ExternalSearchIndex):
     def exists(self, index, doc_type, id):
         return self._key(index, doc_type, id) in self.docs
 
+    def get(self, index, doc_type, id):
+        return dict(_source=self.docs[self._key(index, doc_type, id)])
+
+    def count(self, index, doc_type):
+        keys = [key for key in self.docs if key[:2] == (index, doc_type)]
+        return dict(count=len(keys))
+
     def query_works(self, *args, **kwargs):
         doc_ids = sorted([dict(_id=key[2]) for key in self.docs.keys()])
         if 'offset' in kwargs and 'size' in kwargs:
@@ -786,3 +2043,6 @@ class DummyExternalSearchIndex(ExternalSearchIndex):
         for doc in docs:
             self.index(doc['_index'], doc['_type'], doc['_id'], doc)
         return len(docs), []
+
+    def transfer_current_alias(self, new_index):
+        self.works_index = new_index
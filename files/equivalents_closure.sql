@@ -0,0 +1,174 @@
+-- A closure table over the equivalents graph, so that the identifiers
+-- equivalent to a given identifier can be found with an index scan
+-- instead of a recursive query.
+--
+-- For every pair of identifiers connected by a path of at most five
+-- equivalencies whose combined strength (the product of the strengths
+-- along the path) is above 0.5, there is a row giving the strength of
+-- the strongest such path at each depth where it beats every shorter
+-- path. Lookups that go deeper or accept weaker paths than that still
+-- use fn_recursive_equivalents.
+--
+-- Loading this file only sets up the table and keeps it current. The
+-- closure for equivalencies that already existed is filled in by a
+-- migration.
+
+CREATE TABLE IF NOT EXISTS equivalents_closure (
+        identifier_id INTEGER NOT NULL,
+        equivalent_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        strength DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (identifier_id, equivalent_id, depth)
+);
+
+CREATE INDEX IF NOT EXISTS ix_equivalents_closure_equivalent_id
+       ON equivalents_closure (equivalent_id);
+
+-- Recalculate the closure rows for the given identifiers.
+--
+-- The closure is built one level at a time, keeping only the
+-- strongest path to each equivalent at each depth, and only if it
+-- beats every shorter path. A path that doesn't beat a shorter one
+-- can't be extended into one that does, so nothing else needs to be
+-- followed, and the work done is bounded by the size of the closure
+-- rather than the number of paths through the graph. For the same
+-- reason, paths that loop back on themselves (strengths are at most
+-- 1) never make it into the table.
+CREATE OR REPLACE FUNCTION fn_refresh_equivalents_closure(identifier_ids INT[]) RETURNS VOID AS
+$$
+DECLARE
+        level INT;
+BEGIN
+        DELETE FROM equivalents_closure WHERE identifier_id = ANY(identifier_ids);
+
+        INSERT INTO equivalents_closure (identifier_id, equivalent_id, depth, strength)
+        SELECT i.id, e.next_id, 1, max(e.strength)
+        FROM (SELECT DISTINCT id FROM unnest(identifier_ids) AS id
+              WHERE id IS NOT NULL) AS i,
+        LATERAL (
+                SELECT output_id, strength FROM equivalents
+                WHERE input_id = i.id
+                UNION ALL
+                SELECT input_id, strength FROM equivalents
+                WHERE output_id = i.id
+        ) AS e(next_id, strength)
+        WHERE e.strength > 0.5
+                AND e.next_id <> i.id
+        GROUP BY i.id, e.next_id;
+
+        FOR level IN 2..5 LOOP
+                INSERT INTO equivalents_closure (identifier_id, equivalent_id, depth, strength)
+                SELECT c.identifier_id, e.next_id, level, max(c.strength * e.strength)
+                FROM equivalents_closure c,
+                LATERAL (
+                        SELECT output_id, strength FROM equivalents
+                        WHERE input_id = c.equivalent_id
+                        UNION ALL
+                        SELECT input_id, strength FROM equivalents
+                        WHERE output_id = c.equivalent_id
+                ) AS e(next_id, strength)
+                WHERE c.identifier_id = ANY(identifier_ids)
+                        AND c.depth = level - 1
+                        AND c.strength * e.strength > 0.5
+                        AND e.next_id <> c.identifier_id
+                GROUP BY c.identifier_id, e.next_id
+                HAVING max(c.strength * e.strength) > coalesce((
+                        SELECT max(shallower.strength)
+                        FROM equivalents_closure shallower
+                        WHERE shallower.identifier_id = c.identifier_id
+                                AND shallower.equivalent_id = e.next_id
+                ), 0);
+                EXIT WHEN NOT FOUND;
+        END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The closure table equivalent of fn_recursive_equivalents, for
+-- lookups within the limits described above.
+CREATE OR REPLACE FUNCTION fn_closure_equivalents(parent INT, recursion_depth INT, strength_threshold DOUBLE PRECISION)
+RETURNS TABLE
+        (
+        recursive_equivalent INT
+        )
+AS
+$$
+        SELECT $1
+        UNION
+        SELECT equivalent_id
+        FROM equivalents_closure
+        WHERE identifier_id = $1
+                AND depth <= $2
+                AND strength > $3
+$$
+LANGUAGE 'sql'
+STABLE;
+
+-- When an equivalency changes, every identifier that could reach
+-- either end of it may have gained or lost equivalents. The closure
+-- is symmetrical, so those identifiers are the ends themselves plus
+-- everything currently listed as equivalent to them.
+--
+-- A statement can change many equivalencies that share identifiers,
+-- so each row only notes its ends in a temporary table, and the
+-- closure is refreshed once, at the end of the statement.
+CREATE OR REPLACE FUNCTION fn_equivalencies_changing() RETURNS TRIGGER AS
+$$
+BEGIN
+        IF to_regclass('pg_temp.equivalency_changes') IS NULL THEN
+                CREATE TEMPORARY TABLE equivalency_changes (
+                        identifier_id INTEGER
+                ) ON COMMIT DELETE ROWS;
+        END IF;
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION fn_equivalency_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+        IF TG_OP <> 'INSERT' THEN
+                INSERT INTO equivalency_changes (identifier_id)
+                       VALUES (OLD.input_id), (OLD.output_id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+                INSERT INTO equivalency_changes (identifier_id)
+                       VALUES (NEW.input_id), (NEW.output_id);
+        END IF;
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION fn_equivalencies_changed() RETURNS TRIGGER AS
+$$
+DECLARE
+        changed INT[];
+BEGIN
+        changed := ARRAY(SELECT DISTINCT identifier_id FROM equivalency_changes);
+        DELETE FROM equivalency_changes;
+        IF array_length(changed, 1) IS NULL THEN
+                RETURN NULL;
+        END IF;
+        PERFORM fn_refresh_equivalents_closure(ARRAY(
+                SELECT unnest(changed)
+                UNION
+                SELECT identifier_id FROM equivalents_closure
+                WHERE equivalent_id = ANY(changed)
+        ));
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tr_equivalencies_changing ON equivalents;
+CREATE TRIGGER tr_equivalencies_changing
+       BEFORE INSERT OR DELETE OR UPDATE OF input_id, output_id, strength
+       ON equivalents FOR EACH STATEMENT EXECUTE PROCEDURE fn_equivalencies_changing();
+
+DROP TRIGGER IF EXISTS tr_equivalency_changed ON equivalents;
+CREATE TRIGGER tr_equivalency_changed
+       AFTER INSERT OR DELETE OR UPDATE OF input_id, output_id, strength
+       ON equivalents FOR EACH ROW EXECUTE PROCEDURE fn_equivalency_changed();
+
+DROP TRIGGER IF EXISTS tr_equivalencies_changed ON equivalents;
+CREATE TRIGGER tr_equivalencies_changed
+       AFTER INSERT OR DELETE OR UPDATE OF input_id, output_id, strength
+       ON equivalents FOR EACH STATEMENT EXECUTE PROCEDURE fn_equivalencies_changed();
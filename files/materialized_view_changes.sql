@@ -0,0 +1,81 @@
+-- Keep track of works whose rows in the works materialized views may
+-- have changed, so that the views can be maintained incrementally
+-- rather than refreshed wholesale.
+
+CREATE TABLE IF NOT EXISTS materialized_view_work_changes (
+        id SERIAL PRIMARY KEY,
+        work_id INTEGER NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION fn_work_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+        IF TG_OP = 'DELETE' THEN
+                INSERT INTO materialized_view_work_changes (work_id) VALUES (OLD.id);
+                RETURN OLD;
+        END IF;
+        INSERT INTO materialized_view_work_changes (work_id) VALUES (NEW.id);
+        RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION fn_edition_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+        INSERT INTO materialized_view_work_changes (work_id)
+               SELECT id FROM works WHERE presentation_edition_id = NEW.id;
+        RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION fn_licensepool_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+        IF TG_OP <> 'INSERT' THEN
+                INSERT INTO materialized_view_work_changes (work_id)
+                       SELECT id FROM works WHERE presentation_edition_id = OLD.presentation_edition_id;
+        END IF;
+        IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+        END IF;
+        INSERT INTO materialized_view_work_changes (work_id)
+               SELECT id FROM works WHERE presentation_edition_id = NEW.presentation_edition_id;
+        RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION fn_workgenre_changed() RETURNS TRIGGER AS
+$$
+BEGIN
+        IF TG_OP <> 'INSERT' THEN
+                INSERT INTO materialized_view_work_changes (work_id) VALUES (OLD.work_id);
+        END IF;
+        IF TG_OP = 'DELETE' THEN
+                RETURN OLD;
+        END IF;
+        INSERT INTO materialized_view_work_changes (work_id) VALUES (NEW.work_id);
+        RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only changes to columns that show up in the views are tracked.
+
+DROP TRIGGER IF EXISTS tr_materialized_view_work_changed ON works;
+CREATE TRIGGER tr_materialized_view_work_changed
+       AFTER INSERT OR DELETE OR UPDATE OF presentation_edition_id, presentation_ready, audience, target_age, fiction, quality, rating, popularity, random, last_update_time, simple_opds_entry, verbose_opds_entry
+       ON works FOR EACH ROW EXECUTE PROCEDURE fn_work_changed();
+
+DROP TRIGGER IF EXISTS tr_materialized_view_edition_changed ON editions;
+CREATE TRIGGER tr_materialized_view_edition_changed
+       AFTER UPDATE OF sort_title, permanent_work_id, sort_author, medium, language, cover_full_url, cover_thumbnail_url, series, series_position
+       ON editions FOR EACH ROW EXECUTE PROCEDURE fn_edition_changed();
+
+DROP TRIGGER IF EXISTS tr_materialized_view_licensepool_changed ON licensepools;
+CREATE TRIGGER tr_materialized_view_licensepool_changed
+       AFTER INSERT OR DELETE OR UPDATE OF presentation_edition_id, data_source_id, identifier_id, open_access_download_url, availability_time, collection_id
+       ON licensepools FOR EACH ROW EXECUTE PROCEDURE fn_licensepool_changed();
+
+DROP TRIGGER IF EXISTS tr_materialized_view_workgenre_changed ON workgenres;
+CREATE TRIGGER tr_materialized_view_workgenre_changed
+       AFTER INSERT OR DELETE OR UPDATE OF work_id, genre_id, affinity
+       ON workgenres FOR EACH ROW EXECUTE PROCEDURE fn_workgenre_changed();
@@ -1,6 +1,9 @@
 from collections import defaultdict
 from nose.tools import set_trace
+import base64
 import datetime
+from decimal import Decimal
+import json
 import logging
 import random
 import time
@@ -18,9 +21,17 @@ from classifier import (
 
 from sqlalchemy import (
     and_,
+    bindparam,
+    false,
+    Integer,
+    literal,
     or_,
     not_,
+    select,
+    text,
+    union_all,
 )
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import (
     contains_eager,
     defer,
@@ -334,6 +345,95 @@ class Facets(FacetConstants):
             order_by_sorted = [order_by[0].desc()] + [x.asc() for x in order_by[1:]]
         return order_by_sorted, order_by
 
+    def sort_key(self, item, work_model, edition_model):
+        """Find the values of the ORDER BY fields for one item that
+        came out of a query ordered by this Facets object.
+
+        :return: A list of values, one per field in the ORDER BY
+        clause.
+        """
+        order_by, order_fields = self.order_by(work_model, edition_model)
+        key = []
+        for i, field in enumerate(order_fields):
+            owner = getattr(field, 'class_', None)
+            if owner is work_model:
+                value = getattr(item, field.key)
+            elif owner is edition_model:
+                value = getattr(item.presentation_edition, field.key)
+            elif owner is LicensePool:
+                # A Work is found once for each of its LicensePools,
+                # and we can't tell which one this was. Use the value
+                # from the LicensePool that comes first in this order.
+                # (NULL comes last in ascending order and first in
+                # descending order.) This may include LicensePools the
+                # query filtered out, so KeysetPagination reads the
+                # value from the query instead.
+                values = [
+                    getattr(pool, field.key) for pool in item.license_pools
+                ]
+                known = [x for x in values if x is not None]
+                ascending = self.order_ascending or i > 0
+                if not known or (not ascending and len(known) < len(values)):
+                    value = None
+                elif ascending:
+                    value = min(known)
+                else:
+                    value = max(known)
+            else:
+                raise ValueError(
+                    "Cannot find the value of %s for %r" % (field, item)
+                )
+            key.append(value)
+        return key
+
+    def seek(self, work_model, edition_model, sort_key):
+        """Create a clause that matches only the items that come after
+        the item with the given sort key, in the order established by
+        this Facets object.
+
+        This lets a query jump directly to a position in the ordering
+        using an index, rather than reading and discarding every
+        earlier row with OFFSET.
+
+        :param sort_key: A list of values, as returned by sort_key().
+        """
+        order_by, order_fields = self.order_by(work_model, edition_model)
+        if len(sort_key) != len(order_fields):
+            raise ValueError(
+                "Expected a sort key with %d values, got %r" % (
+                    len(order_fields), sort_key
+                )
+            )
+        # order_ascending applies only to the first field in the sort
+        # order. Everything else is ordered ascending.
+        ascending = [self.order_ascending] + [True] * (len(order_fields)-1)
+
+        clauses = []
+        equal_so_far = []
+        for field, value, asc in zip(order_fields, sort_key, ascending):
+            # In Postgres, NULL sorts after every other value in
+            # ascending order, and before every other value in
+            # descending order.
+            if value is None:
+                if asc:
+                    after = None
+                else:
+                    after = field != None
+                equal = field == None
+            else:
+                if asc:
+                    after = or_(field > value, field == None)
+                else:
+                    after = field < value
+                equal = field == value
+            if after is not None:
+                clauses.append(and_(*(equal_so_far + [after])))
+            equal_so_far.append(equal)
+        if not clauses:
+            # Nothing can come after this item.
+            return false()
+        return or_(*clauses)
+
 
 class Pagination(object):
 
@@ -358,6 +458,10 @@ class Pagination(object):
     def query_string(self):
        return "&".join("=".join(map(str, x)) for x in self.items())
 
+    @property
+    def is_first_page(self):
+        return self.offset <= 0
+
     @property
     def first_page(self):
         return Pagination(0, self.size)
@@ -387,11 +491,153 @@ class Pagination(object):
             return False
         return self.offset + self.size < self.query_size
 
-    def apply(self, q):
+    def apply(self, q, facets=None, work_model=Work, edition_model=Edition):
         """Modify the given query with OFFSET and LIMIT."""
         self.query_size = fast_query_count(q)
         return q.offset(self.offset).limit(self.size)
 
+    def page_loaded(self, page):
+        """Take note of the items that were found on this page."""
+        pass
+
+
+class KeysetPagination(Pagination):
+    """Pagination that picks up where the previous page left off.
+
+    Instead of an offset, the `after` token holds the sort key of the
+    last item on the previous page. Facets.seek() turns that into a
+    WHERE clause that an index can satisfy directly, so a deep page
+    costs no more than the first page.
+
+    A KeysetPagination can only move forward, and it can't jump to an
+    arbitrary page.
+    """
+
+    @classmethod
+    def default(cls):
+        return KeysetPagination(cls.DEFAULT_SIZE)
+
+    def __init__(self, size=Pagination.DEFAULT_SIZE, last_item=None):
+        """Constructor.
+
+        :param last_item: The sort key of the last item on the
+        previous page, as returned by Facets.sort_key(). If this is
+        None, this is the first page.
+        """
+        super(KeysetPagination, self).__init__(0, size)
+        self.last_item = last_item
+        self.next_item = None
+        self.page_size = None
+        self._ordering = None
+        self._query = None
+
+    @classmethod
+    def encode_sort_key(cls, sort_key):
+        values = []
+        for value in sort_key:
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                # Keep the exact value, rather than turning it into a
+                # float.
+                value = str(value)
+            values.append(value)
+        return base64.urlsafe_b64encode(json.dumps(values))
+
+    @classmethod
+    def from_token(cls, token, size=Pagination.DEFAULT_SIZE):
+        """Turn the `after` token from a URL back into a
+        KeysetPagination.
+
+        :raise ValueError: If the token is not a valid sort key.
+        """
+        try:
+            last_item = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError), e:
+            raise ValueError("Invalid pagination token: %s" % token)
+        if not isinstance(last_item, list):
+            raise ValueError("Invalid pagination token: %s" % token)
+        return cls(size, last_item)
+
+    def items(self):
+        if self.last_item is None:
+            # The first page looks the same as the first page of an
+            # offset-based Pagination.
+            after = 0
+        else:
+            after = self.encode_sort_key(self.last_item)
+        yield("after", after)
+        yield("size", self.size)
+
+    @property
+    def is_first_page(self):
+        return self.last_item is None
+
+    @property
+    def first_page(self):
+        return KeysetPagination(self.size)
+
+    @property
+    def next_page(self):
+        if self.next_item is None:
+            return None
+        return KeysetPagination(self.size, self.next_item)
+
+    @property
+    def previous_page(self):
+        # We don't know where the previous page started.
+        return None
+
+    @property
+    def has_next_page(self):
+        """There's probably another page if this page was full.
+
+        This method only returns valid information _after_
+        self.page_loaded has been called.
+        """
+        if self.page_size is None:
+            return True
+        return self.page_size >= self.size and self.next_item is not None
+
+    def apply(self, q, facets=None, work_model=Work, edition_model=Edition):
+        """Modify the given query to seek past the last item on the
+        previous page, and LIMIT it to the size of one page.
+        """
+        if not facets:
+            raise ValueError("Keyset pagination requires a sort order.")
+        self._ordering = (facets, work_model, edition_model)
+        if self.last_item is not None:
+            q = q.filter(
+                facets.seek(work_model, edition_model, self.last_item)
+            )
+        self._query = q.limit(self.size)
+        return self._query
+
+    def page_loaded(self, page):
+        """Remember the sort key of the last item on this page, so the
+        next page can start right after it.
+        """
+        self.page_size = len(page)
+        if not page or not self._ordering:
+            return
+        facets, work_model, edition_model = self._ordering
+        order_by, order_fields = facets.order_by(work_model, edition_model)
+        if self._query is not None and any(
+                getattr(field, 'class_', None) is LicensePool
+                for field in order_fields
+        ):
+            # A Work is found once for each of its LicensePools that
+            # matches the query, and the Work itself doesn't say which
+            # one put it at the end of the page. Ask the database for
+            # the ORDER BY values of the last row instead.
+            rows = self._query.with_entities(*order_fields).all()
+            if rows:
+                self.next_item = list(rows[-1])
+                return
+        self.next_item = facets.sort_key(
+            page[-1], work_model, edition_model
+        )
+
 
 class UndefinedLane(Exception):
     """Cannot create a lane because its definition is contradictory
@@ -1089,11 +1335,27 @@ class Lane(object):
         )
         if self.genre_ids:
             mw =MaterializedWorkWithGenre
-            q = self._db.query(mw)
+            q = self._materialized_works_base_query(mw)
             q = q.filter(mw.genre_id.in_(self.genre_ids))
         else:
             mw = MaterializedWork
-            q = self._db.query(mw)
+            q = self._materialized_works_base_query(mw)
+
+        q = self.apply_filters(
+                q,
+                facets=facets, pagination=pagination,
+                work_model=mw, edition_model=mw
+            )
+        if not q:
+            # apply_filters may return None in subclasses of Lane
+            return None
+        return q
+
+    def _materialized_works_base_query(self, mw):
+        """Query a materialized view, loading each work's LicensePool
+        along with it.
+        """
+        q = self._db.query(mw)
 
         # Avoid eager loading of objects that are contained in the 
         # materialized view.
@@ -1106,14 +1368,6 @@ class Lane(object):
 
         q = q.join(LicensePool, LicensePool.id==mw.license_pool_id)
         q = q.options(contains_eager(mw.license_pool))
-        q = self.apply_filters(
-                q,
-                facets=facets, pagination=pagination,
-                work_model=mw, edition_model=mw
-            )
-        if not q:
-            # apply_filters may return None in subclasses of Lane
-            return None
         return q
 
     def apply_filters(self, q, facets=None, pagination=None, work_model=Work, edition_model=Edition):
@@ -1223,7 +1477,7 @@ class Lane(object):
             q = facets.apply(self._db, q, work_model, edition_model,
                              distinct=distinct)
         if pagination:
-            q = pagination.apply(q)
+            q = pagination.apply(q, facets, work_model, edition_model)
 
         return q
 
@@ -1290,6 +1544,7 @@ class Lane(object):
                     fields=["_id", "title", "author", "license_pool_id"],
                     size=pagination.size,
                     offset=pagination.offset,
+                    lane_name=search_lane.name,
                 )
             except elasticsearch.exceptions.ConnectionError, e:
                 logging.error(
@@ -1303,25 +1558,8 @@ class Lane(object):
                     int(x['_id']) for x in docs['hits']['hits']
                 ]
                 if doc_ids:
-                    from model import MaterializedWork as mw
-                    q = self._db.query(mw).join(
-                        LicensePool, mw.license_pool_id==LicensePool.id
-                    ).filter(
-                        mw.works_id.in_(doc_ids)
-                    )
-                    q = q.options(
-                        lazyload(mw.license_pool, LicensePool.data_source),
-                        lazyload(mw.license_pool, LicensePool.identifier),
-                        lazyload(mw.license_pool, LicensePool.presentation_edition),
-                    )
-                    q = self.only_show_ready_deliverable_works(q, mw)
-                    q = self._defer_unused_opds_entry(q, work_model=mw)
-                    work_by_id = dict()
                     a = time.time()
-                    works = q.all()
-                    for mw in works:
-                        work_by_id[mw.works_id] = mw
-                    results = [work_by_id[x] for x in doc_ids if x in work_by_id]
+                    results = self.works_for_search_results(doc_ids)
                     b = time.time()
                     logging.debug(
                         "Obtained %d MaterializedWork objects in %.2fsec",
@@ -1333,6 +1571,32 @@ class Lane(object):
             results = self._search_database(query).limit(pagination.size).offset(pagination.offset).all()
         return results
 
+    def works_for_search_results(self, work_ids):
+        """Load the MaterializedWorks for a page of search results.
+
+        Everything is loaded in a single query, which keeps the works
+        in the order the search index ranked them.
+
+        :param work_ids: The IDs of the matching works, in rank order.
+        """
+        from model import MaterializedWork as mw
+        # The view has one row per work, but the search index may
+        # return the same work more than once (for instance, while
+        # documents are being written to two indexes). Keep each
+        # work's best rank, so the join yields it only once.
+        ranked = text(
+            "SELECT work_id, min(position) AS position FROM unnest(:work_ids) "
+            "WITH ORDINALITY AS ranked(work_id, position) GROUP BY work_id"
+        ).bindparams(
+            bindparam('work_ids', work_ids, type_=ARRAY(Integer))
+        ).columns(
+            work_id=Integer, position=Integer
+        ).alias("ranked")
+        q = self._materialized_works_base_query(mw)
+        q = q.join(ranked, ranked.c.work_id==mw.works_id)
+        q = self.only_show_ready_deliverable_works(q, mw)
+        return q.order_by(ranked.c.position).all()
+
     def _search_database(self, query):
         """Do a really awful database search for a book using ILIKE.
 
@@ -1357,18 +1621,106 @@ class Lane(object):
 
     def sublane_samples(self, use_materialized_works=True):
         """Generates a list of samples from each sublane for a groups feed"""
+        sublanes = self.visible_sublanes
+        batched = {}
+        if use_materialized_works:
+            batched = self.batch_featured_works(sublanes)
 
         # This is a list rather than a dict because we want to
         # preserve the ordering of the lanes.
         works_and_lanes = []
-        for sublane in self.visible_sublanes:
-            works = sublane.featured_works(
-                use_materialized_works=use_materialized_works
-            )
+        for i, sublane in enumerate(sublanes):
+            if i in batched:
+                works = batched[i]
+            else:
+                works = sublane.featured_works(
+                    use_materialized_works=use_materialized_works
+                )
             for work in works:
                 works_and_lanes.append((work, sublane))
         return works_and_lanes
 
+    def batch_featured_works(self, lanes):
+        """Find featured works for many lanes at once.
+
+        This is equivalent to the first, most restrictive sample taken
+        by `featured_works` for each lane, but the work IDs for every
+        lane are found with a single UNION ALL query, and the
+        MaterializedWorks themselves are loaded with one query per
+        materialized view.
+
+        Lanes that customize `featured_works`, lanes with featured
+        CustomList entries, and lanes that can't be filled by the
+        restrictive sample are left out; the caller should fall back
+        to calling `featured_works` on them.
+
+        :return: A dictionary mapping the index of a lane in `lanes`
+        to a list of MaterializedWork or MaterializedWorkWithGenre
+        objects.
+        """
+        selects = []
+        lane_models = {}
+        for i, lane in enumerate(lanes):
+            if (type(lane).featured_works != Lane.featured_works
+                or lane.list_featured_works_query):
+                continue
+            facets = Facets(
+                lane.library, collection=Facets.COLLECTION_FEATURED,
+                availability=Facets.AVAILABLE_NOW,
+                order=Facets.ORDER_RANDOM
+            )
+            query = lane.materialized_works(facets=facets)
+            if not query:
+                continue
+            lane_models[i] = query.column_descriptions[0]['entity']
+            target_size = lane.library.featured_lane_size
+            for part, q in enumerate(
+                    lane.random_sample_queries(query, target_size)
+            ):
+                subquery = q.subquery()
+                selects.append(
+                    select([
+                        subquery.c.works_id,
+                        literal(i).label('lane_index'),
+                        literal(part).label('part'),
+                    ])
+                )
+        if not selects:
+            return {}
+
+        ids_by_lane = defaultdict(list)
+        rows = self._db.execute(union_all(*selects)).fetchall()
+        for works_id, lane_index, part in sorted(
+                rows, key=lambda row: (row.lane_index, row.part)
+        ):
+            ids = ids_by_lane[lane_index]
+            if works_id not in ids:
+                ids.append(works_id)
+
+        # Load all the works we need, one query per materialized view.
+        ids_by_model = defaultdict(set)
+        for lane_index, ids in ids_by_lane.items():
+            ids_by_model[lane_models[lane_index]].update(ids)
+        works_by_model = defaultdict(dict)
+        for work_model, ids in ids_by_model.items():
+            qu = self._materialized_works_base_query(work_model)
+            qu = qu.filter(work_model.works_id.in_(ids))
+            for work in qu:
+                works_by_model[work_model][work.works_id] = work
+
+        samples = {}
+        for lane_index, ids in ids_by_lane.items():
+            target_size = lanes[lane_index].library.featured_lane_size
+            works = works_by_model[lane_models[lane_index]]
+            sample = [works[x] for x in ids[:target_size] if x in works]
+            if len(sample) < target_size:
+                # featured_works would have degraded to a less
+                # restrictive sample. Let it do so.
+                continue
+            random.shuffle(sample)
+            samples[lane_index] = sample
+        return samples
+
     def featured_works(self, use_materialized_works=True):
         """Find a random sample of featured books.
 
@@ -1379,6 +1731,7 @@ class Lane(object):
         :return: A list of MaterializedWork or MaterializedWorkWithGenre
         objects.
         """
+        start_time = time.time()
         books = []
         featured_subquery = None
         target_size = self.library.featured_lane_size
@@ -1433,6 +1786,11 @@ class Lane(object):
             if books:
                 break
 
+        self.log.debug(
+            "Sampled %d featured works for %s in %.2fsec",
+            len(list_books) + len(books), self.display_name,
+            time.time()-start_time
+        )
         if list_books and books:
             # Combine any books from the CustomList with those that were
             # randomly generated.
@@ -1466,25 +1824,76 @@ class Lane(object):
         return books, work_id_column
 
     def randomized_sample_works(self, query, target_size=None, use_min_size=False):
-        """Find a random sample of works for a feed"""
-        offset = 0
+        """Find a random sample of works for a feed.
+
+        Rather than counting the query and picking a random offset
+        into it, this picks a random point in the range of
+        `Work.random` (which is regularly reshuffled by
+        WorkRandomnessUpdateMonitor) and takes the works that come
+        after that point, wrapping around to the start of the range if
+        necessary. Both steps are range scans on an indexed column.
+        """
         smallest_sample_size = target_size
 
         if use_min_size:
             smallest_sample_size = self.MINIMUM_SAMPLE_SIZE or (target_size-5)
-        total_size = fast_query_count(query)
 
-        if total_size < smallest_sample_size:
-            # There aren't enough works here. Ignore the lane.
-            return []
-        if total_size > target_size:
-            # We have enough results to randomly offset the selection.
-            offset = random.randint(0, total_size-target_size)
+        after, before = self.random_sample_queries(query, target_size)
+        works = after.all()
+        if len(works) < target_size:
+            works += before.limit(target_size - len(works)).all()
 
-        works = query.offset(offset).limit(target_size).all()
+        if len(works) < smallest_sample_size:
+            # There aren't enough works here. Ignore the lane.
+            works = []
         random.shuffle(works)
         return works
 
+    def random_sample_queries(self, query, target_size):
+        """Turn a query into two queries that find a random sample
+        of its results.
+
+        :return: A 2-tuple of queries. The first finds up to
+        `target_size` works at or after a random point in the range
+        of `Work.random`. The second wraps around to the beginning of
+        the range, for use if the first query doesn't find enough
+        works.
+        """
+        work_model = query.column_descriptions[0]['entity']
+        if work_model == Work:
+            edition_model = Edition
+        else:
+            edition_model = work_model
+        random_field = work_model.random
+
+        # Order the query randomly. The rest of the ORDER BY clause
+        # stays in sync with any DISTINCT clause applied by Facets.
+        facets = Facets(
+            self.library, None, None, order=Facets.ORDER_RANDOM
+        )
+        order_by, ignore = facets.order_by(work_model, edition_model)
+        query = query.order_by(None)
+
+        start = self.random_sample_start()
+        after = query.filter(random_field >= start).order_by(
+            *order_by
+        ).limit(target_size)
+
+        # Works that haven't been assigned a random value yet come
+        # at the very end.
+        before = query.filter(
+            or_(random_field < start, random_field == None)
+        ).order_by(
+            random_field.asc().nullslast(), *order_by[1:]
+        ).limit(target_size)
+        return after, before
+
+    def random_sample_start(self):
+        """Choose the point in the range of Work.random at which a
+        random sample will start.
+        """
+        return round(random.random(), 3)
+
     @property
     def visible_sublanes(self):
         visible_sublanes = []
@@ -1622,7 +2031,7 @@ class QueryGeneratedLane(Lane):
             qu = facets.apply(self._db, qu, work_model, edition_model)
 
         if pagination:
-            qu = pagination.apply(qu)
+            qu = pagination.apply(qu, facets, work_model, edition_model)
 
         return qu
 
@@ -0,0 +1,5 @@
+-- Cached feeds may be stored in gzip-compressed form, alongside or
+-- instead of the text.
+alter table cachedfeeds add column compressed_content bytea;
+alter table cachedfeeds add column content_length integer;
+alter table cachedfeeds add column etag varchar;
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""Add the 'registered' value to the coverage_status enum.
+
+ALTER TYPE ... ADD VALUE can't run inside a transaction block, so
+this can't be an ordinary SQL migration, which is always run inside
+one. Run it on a connection that uses autocommit instead.
+"""
+import os
+import sys
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from sqlalchemy import create_engine
+
+from config import Configuration
+
+url = Configuration.database_url()
+engine = create_engine(url, isolation_level="AUTOCOMMIT")
+connection = engine.connect()
+try:
+    connection.execute(
+        "ALTER TYPE coverage_status ADD VALUE IF NOT EXISTS 'registered'"
+    )
+finally:
+    connection.close()
+    engine.dispose()
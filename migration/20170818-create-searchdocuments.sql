@@ -0,0 +1,24 @@
+CREATE TABLE IF NOT EXISTS searchdocuments (
+    id serial PRIMARY KEY,
+    index_name varchar NOT NULL,
+    work_id integer NOT NULL REFERENCES works(id) ON DELETE CASCADE,
+    document json,
+    search_vector tsvector,
+    medium varchar,
+    language varchar,
+    audience varchar,
+    fiction varchar,
+    target_age_lower integer,
+    target_age_upper integer,
+    genre_ids integer[],
+    quality double precision,
+    UNIQUE (index_name, work_id)
+);
+
+CREATE INDEX ix_searchdocuments_index_name ON searchdocuments (index_name);
+CREATE INDEX ix_searchdocuments_work_id ON searchdocuments (work_id);
+CREATE INDEX ix_searchdocuments_medium ON searchdocuments (medium);
+CREATE INDEX ix_searchdocuments_language ON searchdocuments (language);
+CREATE INDEX ix_searchdocuments_audience ON searchdocuments (audience);
+CREATE INDEX ix_searchdocuments_fiction ON searchdocuments (fiction);
+CREATE INDEX ix_searchdocuments_search_vector ON searchdocuments USING gin (search_vector);
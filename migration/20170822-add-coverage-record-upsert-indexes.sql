@@ -0,0 +1,23 @@
+-- Coverage records with no operation or no collection used to be
+-- unique in name only, since NULLs never conflict. Keep the most
+-- recent of any duplicates so they can be made unique for real.
+DELETE FROM coveragerecords a
+    USING coveragerecords b
+    WHERE a.id < b.id
+        AND a.identifier_id = b.identifier_id
+        AND a.data_source_id = b.data_source_id
+        AND coalesce(a.operation, '') = coalesce(b.operation, '')
+        AND coalesce(a.collection_id, -1) = coalesce(b.collection_id, -1);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_coveragerecords_identifier_data_source_operation_collection
+    ON coveragerecords (identifier_id, data_source_id, (coalesce(operation, '')), (coalesce(collection_id, -1)));
+
+DELETE FROM workcoveragerecords a
+    USING workcoveragerecords b
+    WHERE a.id < b.id
+        AND a.work_id = b.work_id
+        AND a.operation IS NULL
+        AND b.operation IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_workcoveragerecords_work_id_operation
+    ON workcoveragerecords (work_id, (coalesce(operation, '')));
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS coveragejobs (
+    id serial PRIMARY KEY,
+    service varchar(255) NOT NULL,
+    collection_id integer REFERENCES collections(id),
+    identifier_id integer NOT NULL REFERENCES identifiers(id),
+    priority integer NOT NULL DEFAULT 0,
+    attempts integer NOT NULL DEFAULT 0,
+    available_at timestamp without time zone NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_coveragejobs_identifier_id
+    ON coveragejobs (identifier_id);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_coveragejobs_service_collection_id_identifier_id
+    ON coveragejobs (service, (coalesce(collection_id, -1)), identifier_id);
+CREATE INDEX IF NOT EXISTS ix_coveragejobs_priority_available_at
+    ON coveragejobs (priority DESC, available_at);
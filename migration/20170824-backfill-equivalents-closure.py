@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Fill in the equivalents closure for equivalencies that existed
+before the closure table did. New and changed equivalencies are
+taken care of by the triggers in files/equivalents_closure.sql.
+
+Identifiers are handled in batches, each committed on its own, so no
+one transaction has to hold the whole closure.
+"""
+import os
+import sys
+import logging
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from sqlalchemy.sql import text
+
+from model import production_session
+
+BATCH_SIZE = 10000
+
+log = logging.getLogger(name="Equivalents closure backfill")
+
+_db = production_session()
+
+ids_after = text(
+    "SELECT id FROM ("
+    " SELECT input_id AS id FROM equivalents"
+    " UNION"
+    " SELECT output_id FROM equivalents"
+    ") AS ids WHERE id > :after ORDER BY id LIMIT :limit"
+)
+after = 0
+while True:
+    batch = [id for [id] in _db.execute(
+        ids_after, dict(after=after, limit=BATCH_SIZE)
+    )]
+    if not batch:
+        break
+    _db.execute(
+        text("SELECT fn_refresh_equivalents_closure(:ids)"), dict(ids=batch)
+    )
+    _db.commit()
+    after = batch[-1]
+    log.info("Filled in the equivalents closure through identifier %d.", after)
@@ -0,0 +1,21 @@
+-- The triggers that record changed works used to be installed on
+-- every site, whether or not its materialized views were maintained
+-- incrementally. They're now installed by convert_to_incremental, so
+-- drop them wherever the views are still ordinary materialized views.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE relname IN (
+            'mv_works_editions_datasources_identifiers',
+            'mv_works_editions_workgenres_datasources_identifiers'
+        ) AND relkind = 'r'
+    ) THEN
+        DROP TRIGGER IF EXISTS tr_materialized_view_work_changed ON works;
+        DROP TRIGGER IF EXISTS tr_materialized_view_edition_changed ON editions;
+        DROP TRIGGER IF EXISTS tr_materialized_view_licensepool_changed ON licensepools;
+        DROP TRIGGER IF EXISTS tr_materialized_view_workgenre_changed ON workgenres;
+        DROP TABLE IF EXISTS materialized_view_work_changes;
+    END IF;
+END;
+$$;
@@ -0,0 +1,5 @@
+-- A work's search documents are deleted along with the work, for
+-- databases where searchdocuments was created without the cascade.
+ALTER TABLE searchdocuments DROP CONSTRAINT IF EXISTS searchdocuments_work_id_fkey;
+ALTER TABLE searchdocuments ADD CONSTRAINT searchdocuments_work_id_fkey
+    FOREIGN KEY (work_id) REFERENCES works(id) ON DELETE CASCADE;
@@ -19,18 +19,22 @@ import os
 import random
 import re
 import requests
+import select as io_select
+import threading
 import time
 import traceback
 import urllib
 import urlparse
 import uuid
 import warnings
+import zlib
 import bcrypt
 
 from PIL import (
     Image,
 )
 
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from psycopg2.extras import NumericRange
 from sqlalchemy.engine.base import Connection
 from sqlalchemy import exc as sa_exc
@@ -76,6 +80,7 @@ from sqlalchemy.sql.expression import (
     literal_column,
     case,
     table,
+    column,
 )
 from sqlalchemy.exc import (
     IntegrityError
@@ -121,10 +126,12 @@ from util.http import (
     HTTP,
     RemoteIntegrationException,
 )
+from util.lru import LRUCache
 from util.permanent_work_id import WorkIDCalculator
 from util.personal_names import display_name_to_sort_name
 from util.summary import SummaryEvaluator
 
+from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy.orm.session import (
     Session,
     make_transient,
@@ -136,18 +143,31 @@ from sqlalchemy.dialects.postgresql import (
     HSTORE,
     JSON,
     INT4RANGE,
+    TSVECTOR,
 )
 from s3 import S3Uploader
 
 
 DEBUG = False
 
-def production_session():
+def production_session(listen_for_changes=False):
+    """Connect to the production database.
+
+    :param listen_for_changes: Keep the full-table caches in sync with
+    other processes by starting a background listener, which holds an
+    extra database connection open. Only long-running processes, such
+    as the app server and the scripts that set
+    `Script.LISTEN_FOR_CHANGES`, need this; short-lived scripts and
+    worker processes should leave it off.
+    """
     url = Configuration.database_url()
     if url.startswith('"'):
         url = url[1:]
     logging.debug("Database url: %s", url)
-    return SessionManager.session(url)
+    session = SessionManager.session(url)
+    if listen_for_changes:
+        HasFullTableCache.listen_for_changes(url)
+    return session
 
 class PolicyException(Exception):
     pass
@@ -167,21 +187,219 @@ class BaseMaterializedWork(object):
 class HasFullTableCache(object):
     """A mixin class for ORM classes that maintain an in-memory cache of
     (hopefully) every item in the database table for performance reasons.
+
+    When a change to a row is committed, only that row is dropped from
+    the cache, and the change is broadcast to other processes with
+    Postgres NOTIFY. See `listen_for_changes`.
     """
     
     RESET = object()
 
+    # Changes to cached tables are announced on this channel.
+    NOTIFY_CHANNEL = 'hasfulltablecache'
+
+    # Rows changed in a transaction that hasn't finished yet are
+    # tracked under this key in the session's `info` dictionary.
+    PENDING_INVALIDATIONS = 'hasfulltablecache_pending'
+
     # You MUST define your own class-specific '_cache' and '_id_cache'
     # variables, like so:
     #
     # _cache = HasFullTableCache.RESET
     # _id_cache = HasFullTableCache.RESET
+
+    # Incremented every time the contents of a class's cache are
+    # invalidated. An object that was looked up in the database under
+    # an older generation may already be out of date, so it's not
+    # put into the cache.
+    _cache_generation = 0
+
+    _listeners = {}
+    _listener_lock = threading.Lock()
     
     @classmethod
     def reset_cache(cls):
+        cls._cache_generation += 1
         cls._cache = cls.RESET
         cls._id_cache = cls.RESET
-        
+        cls.cache_stats()['resets'] += 1
+
+    @classmethod
+    def cache_stats(cls):
+        """Counters that show how well this class's cache is working:
+        hits, misses, merges into a database session, full table
+        loads, resets, and invalidations of individual rows.
+        """
+        stats = cls.__dict__.get('_cache_stats')
+        if stats is None:
+            stats = Counter()
+            cls._cache_stats = stats
+        return stats
+
+    @classmethod
+    def invalidate_cache(cls, id):
+        """Drop one object from the cache, leaving the rest alone.
+
+        The next time someone looks for that object, it will be
+        reloaded from the database.
+        """
+        cls._cache_generation += 1
+        cls.cache_stats()['invalidations'] += 1
+        cache = cls._cache
+        id_cache = cls._id_cache
+        if id_cache is cls.RESET:
+            return
+        obj = id_cache.pop(id, None)
+        if obj is None or cache is cls.RESET:
+            return
+        for key, value in cache.items():
+            if value is obj:
+                cache.pop(key, None)
+
+    @classmethod
+    def cache_changed(cls, connection, target):
+        """A row in this class's table has changed. Once the change is
+        committed, invalidate it here and tell other processes to do
+        the same.
+
+        Until then, the change is only noted on the database session;
+        see `invalidate_pending`.
+        """
+        payload = "%s %s %s" % (os.getpid(), cls.__name__, target.id)
+        connection.execute(
+            text("select pg_notify(:channel, :payload)"),
+            channel=cls.NOTIFY_CHANNEL, payload=payload
+        )
+        _db = Session.object_session(target)
+        if _db is None:
+            cls.invalidate_cache(target.id)
+            return
+        _db.info.setdefault(cls.PENDING_INVALIDATIONS, set()).add(
+            (cls, target.id)
+        )
+
+    @classmethod
+    def invalidate_pending(cls, _db):
+        """Invalidate every row changed in a database session's
+        transaction, now that it has been committed or rolled back.
+
+        A rolled-back change is invalidated too, since the row may
+        have been cached in its uncommitted state.
+        """
+        pending = _db.info.pop(cls.PENDING_INVALIDATIONS, None)
+        for subclass, id in pending or []:
+            subclass.invalidate_cache(id)
+
+    @classmethod
+    def cached_classes(cls):
+        """Find every class that uses HasFullTableCache."""
+        classes = []
+        for subclass in cls.__subclasses__():
+            classes.append(subclass)
+            classes.extend(subclass.cached_classes())
+        return classes
+
+    @classmethod
+    def handle_notification(cls, payload, _db=None):
+        """Act on a change announced by another process.
+
+        :param _db: If provided, the changed row is reloaded into the
+        cache right away, so the next lookup doesn't have to wait for
+        the database.
+        """
+        try:
+            pid, class_name, id = payload.split(" ", 2)
+        except ValueError, e:
+            logging.error("Unrecognized cache notification: %r", payload)
+            return
+        if pid == str(os.getpid()):
+            # We already took care of this change.
+            return
+        for subclass in cls.cached_classes():
+            if subclass.__name__ != class_name:
+                continue
+            try:
+                id = int(id)
+            except ValueError, e:
+                subclass.reset_cache()
+                continue
+            subclass.invalidate_cache(id)
+            if _db:
+                try:
+                    subclass.by_id(_db, id)
+                finally:
+                    # Detach the reloaded object; it belongs to the
+                    # cache now.
+                    _db.close()
+
+    @classmethod
+    def listen_for_changes(cls, url):
+        """Start a background thread that keeps the caches in this
+        process, and its idea of when the site configuration last
+        changed, in sync with changes made by other processes.
+        """
+        with cls._listener_lock:
+            if url in cls._listeners:
+                return
+            thread = threading.Thread(target=cls._listen, args=(url,))
+            thread.daemon = True
+            cls._listeners[url] = thread
+            thread.start()
+
+    @classmethod
+    def _listen(cls, url, timeout=60, stop=None):
+        """Listen for changes until `stop` (a threading.Event) is set,
+        which is only ever done in tests.
+        """
+        log = logging.getLogger("Full table cache listener")
+        engine = create_engine(url)
+        stopped = lambda: stop is not None and stop.is_set()
+        while not stopped():
+            try:
+                connection = engine.raw_connection().connection
+                connection.set_isolation_level(
+                    ISOLATION_LEVEL_AUTOCOMMIT
+                )
+                cursor = connection.cursor()
+                for channel in (cls.NOTIFY_CHANNEL,
+                                Configuration.SITE_CONFIGURATION_CHANNEL):
+                    cursor.execute("LISTEN %s" % channel)
+                _db = Session(bind=engine)
+
+                # We may have missed some changes while we weren't
+                # listening.
+                for subclass in cls.cached_classes():
+                    subclass.reset_cache()
+                Configuration.site_configuration_last_update(_db, timeout=0)
+                _db.close()
+                Configuration.instance[
+                    Configuration.SITE_CONFIGURATION_WATCHED] = True
+
+                while not stopped():
+                    io_select.select([connection], [], [], timeout)
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        if (notification.channel ==
+                            Configuration.SITE_CONFIGURATION_CHANNEL):
+                            Configuration.site_configuration_changed_elsewhere(
+                                notification.payload
+                            )
+                        else:
+                            cls.handle_notification(notification.payload, _db)
+                connection.close()
+                Configuration.instance[
+                    Configuration.SITE_CONFIGURATION_WATCHED] = False
+            except Exception, e:
+                # Until we're listening again, go back to polling
+                # for site configuration changes.
+                Configuration.instance[
+                    Configuration.SITE_CONFIGURATION_WATCHED] = False
+                log.error(
+                    "Error listening for cache changes", exc_info=e
+                )
+                time.sleep(5)
+
     def cache_key(self):
         raise NotImplementedError()
         
@@ -210,8 +428,14 @@ class HasFullTableCache(object):
         """
         cache = {}
         id_cache = {}
+        generation = cls._cache_generation
         for obj in _db.query(cls):
             cls._cache_insert(obj, cache, id_cache)
+        cls.cache_stats()['loads'] += 1
+        if generation != cls._cache_generation:
+            # Something changed while we were loading the table.
+            # Leave the cache reset so the next lookup tries again.
+            return
         cls._cache = cache
         cls._id_cache = id_cache
         
@@ -224,6 +448,7 @@ class HasFullTableCache(object):
         """
         new = False
         obj = None
+        stats = cls.cache_stats()
         if cache == cls.RESET:
             # The cache has been reset. Populate it with the contents
             # of the table.
@@ -242,13 +467,17 @@ class HasFullTableCache(object):
                 # cache which passed the 'cache != cls.RESET' test.
                 pass
                 
-        if not obj:
+        if obj:
+            stats['hits'] += 1
+        else:
             # Either this object didn't exist when the cache was
             # populated, or the cache was reset while we were trying
             # to look it up.
             #
             # Give up on the cache and go direct to the database,
             # creating the object if necessary.
+            stats['misses'] += 1
+            generation = cls._cache_generation
             if lookup_hook:
                 obj, new = lookup_hook()
             else:
@@ -258,10 +487,13 @@ class HasFullTableCache(object):
                 return obj, new
 
             # Stick the object in the caches, assuming they're not
-            # currently in a reset state.
-            cls._cache_insert(obj, cls._cache, cls._id_cache)
+            # currently in a reset state and nothing has been
+            # invalidated in the meantime.
+            if generation == cls._cache_generation:
+                cls._cache_insert(obj, cls._cache, cls._id_cache)
             
         if obj and obj not in _db:
+            stats['merges'] += 1
             obj = _db.merge(obj, load=False)
         return obj, new
         
@@ -298,6 +530,21 @@ class SessionManager(object):
     # is also defined in SQL.
     RECURSIVE_EQUIVALENTS_FUNCTION = 'recursive_equivalents.sql'
 
+    # The closure table that makes most of those calculations
+    # unnecessary, and the triggers that keep it up to date.
+    EQUIVALENTS_CLOSURE = 'equivalents_closure.sql'
+    EQUIVALENTS_CLOSURE_TABLE = 'equivalents_closure'
+
+    # Triggers that record which works need to be updated in the
+    # materialized views are also defined in SQL.
+    MATERIALIZED_VIEW_CHANGES = 'materialized_view_changes.sql'
+    MATERIALIZED_VIEW_CHANGES_TABLE = 'materialized_view_work_changes'
+    CLAIMED_CHANGES_TABLE = 'claimed_materialized_view_work_changes'
+
+    # Recorded changes are applied to incrementally maintained views
+    # this many at a time, each batch in its own transaction.
+    MATERIALIZED_VIEW_CHANGES_CHUNK_SIZE = 1000
+
     engine_for_url = {}
 
     @classmethod
@@ -359,6 +606,24 @@ class SessionManager(object):
             sql = open(resource_file).read()
             connection.execute(sql)
 
+        # Likewise for the equivalents closure table. The check is for
+        # the function that was added most recently, so a database set
+        # up with an older version of the file gets the new triggers.
+        query = select(
+            [literal_column('proname')]
+        ).select_from(
+            table('pg_proc')
+        ).where(
+            literal_column('proname')=='fn_equivalencies_changed'
+        )
+        result = list(connection.execute(query))
+        if not result:
+            resource_file = os.path.join(resource_path, cls.EQUIVALENTS_CLOSURE)
+            if not os.path.exists(resource_file):
+                raise IOError("Could not load equivalents closure table from %s: file does not exist." % resource_file)
+            sql = open(resource_file).read()
+            connection.execute(sql)
+
         if connection:
             connection.close()
 
@@ -402,10 +667,169 @@ class SessionManager(object):
         return engine, engine.connect()
 
     @classmethod
-    def refresh_materialized_views(self, _db):
-        for view_name in self.MATERIALIZED_VIEWS.keys():
-            _db.execute("refresh materialized view %s;" % view_name)
+    def refresh_materialized_views(cls, _db, concurrently=False,
+                                   chunk_size=None):
+        """Bring all the materialized views up to date.
+
+        Views that have been converted with
+        `convert_to_incremental` are updated incrementally; the rest
+        are refreshed wholesale.
+
+        Recorded changes are claimed and applied `chunk_size` at a
+        time, and each chunk is committed on its own, so no single
+        transaction runs for long. Once a chunk comes back short the
+        refresh stops; anything that committed after that is left for
+        the next refresh rather than lost.
+
+        :return: The number of distinct works that had changed.
+        """
+        chunk_size = chunk_size or cls.MATERIALIZED_VIEW_CHANGES_CHUNK_SIZE
+        incremental = []
+        for view_name in cls.MATERIALIZED_VIEWS.keys():
+            if cls.is_incremental(_db, view_name):
+                incremental.append(view_name)
+            else:
+                _db.execute(
+                    "refresh materialized view %s %s;" % (
+                        'concurrently' if concurrently else '', view_name
+                    )
+                )
+                _db.commit()
+
+        works = 0
+        if not incremental:
+            # The change-tracking triggers are only installed once a
+            # view goes incremental, so there's nothing to claim.
+            return works
+        while True:
+            changes, changed_works = cls._claim_changes(_db, chunk_size)
+            for view_name in incremental:
+                cls._apply_changes(_db, view_name)
+            _db.execute("drop table %s" % cls.CLAIMED_CHANGES_TABLE)
+            _db.commit()
+            works += changed_works
+            if changes < chunk_size:
+                break
+        return works
+
+    @classmethod
+    def is_incremental(cls, _db, view_name):
+        """Has the given materialized view been replaced by an
+        incrementally maintained table?
+        """
+        [[relkind]] = _db.execute(
+            text("select relkind from pg_class where relname = :name"),
+            dict(name=view_name)
+        )
+        return relkind == 'r'
+
+    @classmethod
+    def convert_to_incremental(cls, _db, view_name):
+        """Replace a materialized view with a table of the same name,
+        shape and indexes, which can be maintained incrementally.
+
+        The view's query lives on as an ordinary view, "<name>_source",
+        which is used to calculate new rows for changed works.
+
+        The triggers that record changed works are installed first,
+        so nothing that changes during the conversion is missed.
+        """
+        cls.install_change_tracking(_db)
+        if cls.is_incremental(_db, view_name):
             _db.commit()
+            return
+        source_name = view_name + '_source'
+        [[definition]] = _db.execute(
+            text("select pg_get_viewdef(cast(:name as regclass))"), dict(name=view_name)
+        )
+        indexes = [
+            indexdef for [indexdef] in _db.execute(
+                text("select indexdef from pg_indexes where tablename = :name"),
+                dict(name=view_name)
+            )
+        ]
+        _db.execute("create view %s as %s" % (source_name, definition))
+        _db.execute(
+            "create table %s_incremental as select * from %s" % (
+                view_name, view_name
+            )
+        )
+        _db.execute("drop materialized view %s" % view_name)
+        _db.execute(
+            "alter table %s_incremental rename to %s" % (view_name, view_name)
+        )
+        for indexdef in indexes:
+            _db.execute(indexdef)
+        _db.commit()
+
+    @classmethod
+    def install_change_tracking(cls, _db):
+        """Create the table and triggers that record which works need
+        to be updated in incrementally maintained views.
+
+        Until a view is converted with `convert_to_incremental`, these
+        triggers are pure overhead on every write, so they aren't
+        installed by `initialize`.
+        """
+        base_path = os.path.split(__file__)[0]
+        resource_file = os.path.join(
+            base_path, "files", cls.MATERIALIZED_VIEW_CHANGES
+        )
+        if not os.path.exists(resource_file):
+            raise IOError("Could not load materialized view triggers from %s: file does not exist." % resource_file)
+        _db.execute(open(resource_file).read())
+
+    @classmethod
+    def _claim_changes(cls, _db, limit):
+        """Remove up to `limit` of the oldest recorded changes from the
+        changes table and stash the ids of the changed works in a
+        temporary table, where `_apply_changes` can find them.
+
+        Only the rows this statement actually deletes are claimed, and
+        nothing is committed, so if applying them fails the changes
+        are still there for next time.
+
+        :return: A 2-tuple (number of changes claimed, number of
+        distinct works that had changed).
+        """
+        _db.execute("drop table if exists %s" % cls.CLAIMED_CHANGES_TABLE)
+        _db.execute(
+            "create temporary table %s (work_id integer primary key) "
+            "on commit drop" % cls.CLAIMED_CHANGES_TABLE
+        )
+        [[changes, works]] = _db.execute(
+            text(
+                "with claimed as ("
+                " delete from %(changes)s where id in ("
+                "  select id from %(changes)s order by id limit :limit"
+                " ) returning work_id"
+                "), inserted as ("
+                " insert into %(claimed)s select distinct work_id from claimed"
+                " returning work_id"
+                ") select (select count(*) from claimed),"
+                " (select count(*) from inserted)" % dict(
+                    changes=cls.MATERIALIZED_VIEW_CHANGES_TABLE,
+                    claimed=cls.CLAIMED_CHANGES_TABLE,
+                )
+            ),
+            dict(limit=limit)
+        )
+        return changes, works
+
+    @classmethod
+    def _apply_changes(cls, _db, view_name):
+        """Replace the rows for every claimed work in an incrementally
+        maintained view with fresh rows from its source view.
+        """
+        changed = "select work_id from %s" % cls.CLAIMED_CHANGES_TABLE
+        _db.execute(
+            "delete from %s where works_id in (%s)" % (view_name, changed)
+        )
+        _db.execute(
+            "insert into %s select * from %s_source where works_id in (%s)" % (
+                view_name, view_name, changed
+            )
+        )
 
     @classmethod
     def session(cls, url):
@@ -1226,6 +1650,25 @@ class DataSource(Base, HasFullTableCache):
 
             yield obj
 
+
+def _values_clause(columns, rows):
+    """Turn a list of tuples into the body of a VALUES list, for
+    writing many rows with a single statement.
+
+    :return: A 2-tuple (sql, params) suitable for use with text().
+    """
+    params = dict()
+    values = []
+    for i, row in enumerate(rows):
+        placeholders = []
+        for column_name, value in zip(columns, row):
+            name = '%s_%d' % (column_name, i)
+            params[name] = value
+            placeholders.append(':' + name)
+        values.append('(%s)' % ', '.join(placeholders))
+    return ', '.join(values), params
+
+
 class BaseCoverageRecord(object):
     """Contains useful constants used by both CoverageRecord and 
     WorkCoverageRecord.
@@ -1235,15 +1678,19 @@ class BaseCoverageRecord(object):
     TRANSIENT_FAILURE = u'transient failure'
     PERSISTENT_FAILURE = u'persistent failure'
 
-    ALL_STATUSES = [SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE]
+    # The item has been registered as needing coverage, but nobody
+    # has tried to cover it yet.
+    REGISTERED = u'registered'
+
+    ALL_STATUSES = [REGISTERED, SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE]
 
     # By default, count coverage as present if it ended in
     # success or in persistent failure. Do not count coverage
     # as present if it ended in transient failure.
     DEFAULT_COUNT_AS_COVERED = [SUCCESS, PERSISTENT_FAILURE]
 
-    status_enum = Enum(SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE, 
-                       name='coverage_status')
+    status_enum = Enum(SUCCESS, TRANSIENT_FAILURE, PERSISTENT_FAILURE,
+                       REGISTERED, name='coverage_status')
 
     @classmethod
     def not_covered(cls, count_as_covered=None, 
@@ -1285,6 +1732,58 @@ class BaseCoverageRecord(object):
 
         return missing
 
+    @classmethod
+    def _bulk_upsert(cls, _db, key_columns, conflict_target, rows):
+        """Create or update many coverage records with a single
+        INSERT ... ON CONFLICT DO UPDATE statement.
+
+        :param key_columns: The names of the columns that identify a
+           coverage record.
+
+        :param conflict_target: The expressions of the unique index
+           over `key_columns`, as SQL.
+
+        :param rows: A list of tuples, each containing values for
+           `key_columns` followed by a status, an exception and a
+           timestamp.
+
+        :return: A list of coverage records, one for each row.
+        """
+        if not rows:
+            return []
+        columns = list(key_columns) + ['status', 'exception', 'timestamp']
+
+        # A single statement can't update the same record twice, so
+        # if a record shows up more than once, the last one wins.
+        by_key = dict()
+        for row in rows:
+            by_key[tuple(row[:len(key_columns)])] = row
+
+        values, params = _values_clause(columns, by_key.values())
+        sql = ("INSERT INTO %(table)s (%(columns)s) VALUES %(values)s "
+               "ON CONFLICT (%(conflict_target)s) DO UPDATE SET "
+               "status = excluded.status, exception = excluded.exception, "
+               "timestamp = excluded.timestamp "
+               "RETURNING id, %(key_columns)s") % dict(
+                   table=cls.__tablename__,
+                   columns=', '.join(columns),
+                   values=values,
+                   conflict_target=conflict_target,
+                   key_columns=', '.join(key_columns),
+               )
+        id_for_key = dict()
+        for result in _db.execute(text(sql), params):
+            id_for_key[tuple(result[1:])] = result[0]
+
+        # Load the records through the session, replacing any stale
+        # copies it was already holding on to.
+        records = _db.query(cls).filter(
+            cls.id.in_(id_for_key.values())
+        ).populate_existing()
+        by_id = dict((record.id, record) for record in records)
+        return [by_id[id_for_key[tuple(row[:len(key_columns)])]]
+                for row in rows]
+
 
 class CoverageRecord(Base, BaseCoverageRecord):
     """A record of a Identifier being used as input into some process."""
@@ -1333,6 +1832,18 @@ class CoverageRecord(Base, BaseCoverageRecord):
         ),
     )
 
+    # bulk_add() finds existing records through the unique index
+    # defined after this class. Unlike the indexes above, it treats a
+    # missing operation or collection as a value, the same way
+    # add_for() does.
+    BULK_KEY_COLUMNS = [
+        'identifier_id', 'data_source_id', 'operation', 'collection_id'
+    ]
+    BULK_CONFLICT_TARGET = (
+        "identifier_id, data_source_id, (coalesce(operation, '')), "
+        "(coalesce(collection_id, -1))"
+    )
+
     def __repr__(self):
         if self.operation:
             operation = ' operation="%s"' % self.operation
@@ -1394,7 +1905,44 @@ class CoverageRecord(Base, BaseCoverageRecord):
         coverage_record.timestamp = timestamp
         return coverage_record, is_new
 
+    @classmethod
+    def bulk_add(cls, _db, records):
+        """Create or update many CoverageRecords at once.
+
+        :param records: A list of 7-tuples (identifier, data_source,
+           operation, collection, status, exception, timestamp).
+           `identifier` may also be an Edition, as with add_for().
+
+        :return: A list of CoverageRecords, one for each tuple.
+        """
+        # The identifiers may not have been given IDs yet.
+        _db.flush()
+        rows = []
+        for (identifier, data_source, operation, collection,
+             status, exception, timestamp) in records:
+            if isinstance(identifier, Edition):
+                identifier = identifier.primary_identifier
+            elif not isinstance(identifier, Identifier):
+                raise ValueError(
+                    "Cannot create a coverage record for %r." % identifier)
+            rows.append((
+                identifier.id, data_source.id, operation,
+                collection.id if collection else None,
+                status, exception,
+                timestamp or datetime.datetime.utcnow()
+            ))
+        return cls._bulk_upsert(
+            _db, cls.BULK_KEY_COLUMNS, cls.BULK_CONFLICT_TARGET, rows
+        )
+
 Index("ix_coveragerecords_data_source_id_operation_identifier_id", CoverageRecord.data_source_id, CoverageRecord.operation, CoverageRecord.identifier_id)
+Index(
+    "ix_coveragerecords_identifier_data_source_operation_collection",
+    CoverageRecord.identifier_id, CoverageRecord.data_source_id,
+    func.coalesce(CoverageRecord.operation, ''),
+    func.coalesce(CoverageRecord.collection_id, -1),
+    unique=True
+)
 
 class WorkCoverageRecord(Base, BaseCoverageRecord):
     """A record of some operation that was performed on a Work.
@@ -1463,7 +2011,256 @@ class WorkCoverageRecord(Base, BaseCoverageRecord):
         coverage_record.status = status
         coverage_record.timestamp = timestamp
         return coverage_record, is_new
+
+    @classmethod
+    def bulk_add(cls, _db, records):
+        """Create or update many WorkCoverageRecords at once. As with
+        add_for(), a missing operation is treated as a value.
+
+        :param records: A list of 5-tuples (work, operation, status,
+           exception, timestamp).
+
+        :return: A list of WorkCoverageRecords, one for each tuple.
+        """
+        _db.flush()
+        rows = [
+            (work.id, operation, status, exception,
+             timestamp or datetime.datetime.utcnow())
+            for work, operation, status, exception, timestamp in records
+        ]
+        return cls._bulk_upsert(
+            _db, ['work_id', 'operation'],
+            "work_id, (coalesce(operation, ''))", rows
+        )
+
+    @classmethod
+    def bulk_update_if_unchanged(cls, _db, operation, rows):
+        """Record the outcome of an operation on many works at once,
+        but only for the works whose records haven't been touched
+        since the operation began.
+
+        :param rows: A list of 4-tuples (work, the record's timestamp
+           when the operation began, status, exception).
+
+        :return: A list of the WorkCoverageRecords that were updated.
+        """
+        if not rows:
+            return []
+        _db.flush()
+        values, params = _values_clause(
+            ['work_id', 'claimed', 'status', 'exception'],
+            [(work.id, claimed, status, exception)
+             for work, claimed, status, exception in rows]
+        )
+        params['operation'] = operation
+        params['now'] = datetime.datetime.utcnow()
+        sql = ("UPDATE %(table)s AS r SET "
+               "status = cast(v.status as coverage_status), "
+               "exception = v.exception, timestamp = :now "
+               "FROM (VALUES %(values)s) AS v "
+               "(work_id, claimed, status, exception) "
+               "WHERE r.work_id = v.work_id AND r.operation = :operation "
+               "AND r.timestamp = v.claimed "
+               "RETURNING r.id") % dict(
+                   table=cls.__tablename__, values=values
+               )
+        ids = [id for [id] in _db.execute(text(sql), params)]
+        if not ids:
+            return []
+        return _db.query(cls).filter(cls.id.in_(ids)).populate_existing().all()
+
 Index("ix_workcoveragerecords_operation_work_id", WorkCoverageRecord.operation, WorkCoverageRecord.work_id)
+Index(
+    "ix_workcoveragerecords_work_id_operation",
+    WorkCoverageRecord.work_id,
+    func.coalesce(WorkCoverageRecord.operation, ''),
+    unique=True
+)
+
+class CoverageJob(Base):
+    """A request that a CoverageProvider give coverage to an Identifier.
+
+    CoverageJobs make up a queue that any number of processes, on any
+    number of machines, can take work from. As with a Timestamp, the
+    CoverageProvider is identified by its service name and its
+    Collection, if it has one.
+    """
+    __tablename__ = 'coveragejobs'
+
+    # Jobs with higher priorities are handed out first.
+    PATRON_REQUEST_PRIORITY = 100
+    NEW_LICENSE_PRIORITY = 50
+    DEFAULT_PRIORITY = 0
+
+    # A title counts as newly licensed for this long after it
+    # became available.
+    NEW_LICENSE_PERIOD = datetime.timedelta(days=7)
+
+    # A job that ends in transient failure is tried again after
+    # BACKOFF, then after twice that, and so on, up to MAX_BACKOFF.
+    BACKOFF = datetime.timedelta(minutes=5)
+    MAX_BACKOFF = datetime.timedelta(days=1)
+
+    # A process that claims a job has this long to finish it before
+    # the job is handed out to someone else.
+    LEASE = datetime.timedelta(minutes=30)
+
+    id = Column(Integer, primary_key=True)
+    service = Column(String(255), nullable=False)
+    collection_id = Column(
+        Integer, ForeignKey('collections.id'), nullable=True
+    )
+    identifier_id = Column(
+        Integer, ForeignKey('identifiers.id'), index=True, nullable=False
+    )
+    identifier = relationship("Identifier")
+    priority = Column(Integer, default=DEFAULT_PRIORITY, nullable=False)
+
+    # The number of times this job has ended in transient failure.
+    attempts = Column(Integer, default=0, nullable=False)
+
+    # The job won't be handed out before this time.
+    available_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<CoverageJob: service="%s" collection_id=%s identifier_id=%s priority=%d attempts=%d>' % (
+            self.service, self.collection_id, self.identifier_id,
+            self.priority, self.attempts
+        )
+
+    @classmethod
+    def priorities(cls, _db, identifier_ids):
+        """Decide how urgently each of the given Identifiers needs
+        coverage.
+
+        :return: A dictionary mapping Identifier IDs to priorities.
+        """
+        priorities = dict((id, cls.DEFAULT_PRIORITY) for id in identifier_ids)
+        if not priorities:
+            return priorities
+        newly_licensed = _db.query(LicensePool.identifier_id).filter(
+            LicensePool.identifier_id.in_(priorities.keys())
+        ).filter(
+            LicensePool.availability_time >= (
+                datetime.datetime.utcnow() - cls.NEW_LICENSE_PERIOD
+            )
+        )
+        for [identifier_id] in newly_licensed:
+            priorities[identifier_id] = cls.NEW_LICENSE_PRIORITY
+
+        on_hold = _db.query(LicensePool.identifier_id).join(
+            Hold, Hold.license_pool_id==LicensePool.id
+        ).filter(
+            LicensePool.identifier_id.in_(priorities.keys())
+        )
+        for [identifier_id] in on_hold:
+            priorities[identifier_id] = cls.PATRON_REQUEST_PRIORITY
+        return priorities
+
+    @classmethod
+    def enqueue(cls, _db, service, collection, identifier_ids, priority=None):
+        """Make sure there's a job for each of the given Identifiers.
+
+        If a job already exists, its priority can go up but never
+        down. A job whose priority goes up becomes available
+        immediately, even if it was waiting to be retried.
+
+        :param priority: The priority of the jobs. By default, this is
+           decided by priorities().
+        """
+        if priority is None:
+            priorities = cls.priorities(_db, identifier_ids)
+        else:
+            priorities = dict((id, priority) for id in identifier_ids)
+        if not priorities:
+            return
+        # Make sure the database sees any changes to existing jobs.
+        _db.flush()
+        collection_id = None
+        if collection:
+            collection_id = collection.id
+        now = datetime.datetime.utcnow()
+        columns = [
+            'service', 'collection_id', 'identifier_id', 'priority',
+            'attempts', 'available_at'
+        ]
+        values, params = _values_clause(
+            columns, [(service, collection_id, identifier_id, job_priority, 0, now)
+                      for identifier_id, job_priority in priorities.items()]
+        )
+        sql = ("INSERT INTO coveragejobs (%(columns)s) VALUES %(values)s "
+               "ON CONFLICT (service, (coalesce(collection_id, -1)), identifier_id) "
+               "DO UPDATE SET "
+               "available_at = CASE WHEN excluded.priority > coveragejobs.priority "
+               "THEN least(excluded.available_at, coveragejobs.available_at) "
+               "ELSE coveragejobs.available_at END, "
+               "priority = greatest(excluded.priority, coveragejobs.priority)") % dict(
+                   columns=', '.join(columns), values=values
+               )
+        _db.execute(text(sql), params)
+
+    @classmethod
+    def claim(cls, _db, services, limit):
+        """Take the most urgent available jobs for the given services.
+
+        The jobs won't be available to anyone else until LEASE has
+        passed, but that's only visible to other processes once the
+        transaction is committed. Jobs that other processes are
+        in the middle of claiming are skipped rather than waited on.
+
+        :param services: A list of 2-tuples (service, collection_id).
+        :return: A list of CoverageJobs.
+        """
+        if not services:
+            return []
+        _db.flush()
+        now = datetime.datetime.utcnow()
+        params = dict(now=now, lease_expires=now + cls.LEASE, limit=limit)
+        clauses = []
+        for i, (service, collection_id) in enumerate(services):
+            clauses.append(
+                "(service = :service_%d AND coalesce(collection_id, -1) = :collection_id_%d)" % (i, i)
+            )
+            params['service_%d' % i] = service
+            if collection_id is None:
+                collection_id = -1
+            params['collection_id_%d' % i] = collection_id
+        sql = ("UPDATE coveragejobs SET available_at = :lease_expires "
+               "WHERE id IN (SELECT id FROM coveragejobs "
+               "WHERE available_at <= :now AND (%s) "
+               "ORDER BY priority DESC, available_at "
+               "LIMIT :limit FOR UPDATE SKIP LOCKED) "
+               "RETURNING id") % " OR ".join(clauses)
+        ids = [id for [id] in _db.execute(text(sql), params)]
+        if not ids:
+            return []
+        return _db.query(CoverageJob).filter(
+            CoverageJob.id.in_(ids)
+        ).order_by(
+            CoverageJob.priority.desc(), CoverageJob.id
+        ).populate_existing().all()
+
+    def reschedule(self):
+        """Put this job back in the queue after a transient failure,
+        to be retried once enough time has passed.
+        """
+        self.attempts = (self.attempts or 0) + 1
+        # Keep the multiplier from growing without bound; it's
+        # capped by MAX_BACKOFF long before this.
+        backoff = self.BACKOFF * (2 ** min(self.attempts - 1, 16))
+        self.available_at = (
+            datetime.datetime.utcnow() + min(backoff, self.MAX_BACKOFF)
+        )
+
+Index(
+    "ix_coveragejobs_service_collection_id_identifier_id",
+    CoverageJob.service, func.coalesce(CoverageJob.collection_id, -1),
+    CoverageJob.identifier_id, unique=True
+)
+Index(
+    "ix_coveragejobs_priority_available_at",
+    CoverageJob.priority.desc(), CoverageJob.available_at
+)
 
 class Equivalency(Base):
     """An assertion that two Identifiers identify the same work.
@@ -1812,6 +2609,20 @@ class Identifier(Base):
             )
         return eq
 
+    # The limits of the equivalents closure table defined in
+    # files/equivalents_closure.sql. Lookups within these limits are
+    # answered from the closure table.
+    EQUIVALENTS_CLOSURE_MAX_LEVELS = 5
+    EQUIVALENTS_CLOSURE_MIN_THRESHOLD = 0.5
+
+    @classmethod
+    def equivalents_closure_covers(cls, levels, threshold):
+        """Can the closure table answer an equivalence lookup with
+        these parameters?
+        """
+        return (levels <= cls.EQUIVALENTS_CLOSURE_MAX_LEVELS
+                and threshold >= cls.EQUIVALENTS_CLOSURE_MIN_THRESHOLD)
+
     @classmethod
     def recursively_equivalent_identifier_ids_query(
             cls, identifier_id_column, levels=5, threshold=0.50):
@@ -1822,9 +2633,14 @@ class Identifier(Base):
         like `Edition.primary_identifier_id` if the query will be used as
         a subquery.
 
-        This uses the function defined in files/recursive_equivalents.sql.
+        This uses the functions defined in files/equivalents_closure.sql
+        and files/recursive_equivalents.sql.
         """
-        return select([func.fn_recursive_equivalents(identifier_id_column, levels, threshold)])
+        if cls.equivalents_closure_covers(levels, threshold):
+            function = func.fn_closure_equivalents
+        else:
+            function = func.fn_recursive_equivalents
+        return select([function(identifier_id_column, levels, threshold)])
 
     @classmethod
     def recursively_equivalent_identifier_ids(
@@ -1832,7 +2648,10 @@ class Identifier(Base):
         """All Identifier IDs equivalent to the given set of Identifier
         IDs at the given confidence threshold.
 
-        This uses the function defined in files/recursive_equivalents.sql.
+        When possible, all the IDs are looked up at once in the
+        closure table defined in files/equivalents_closure.sql.
+        Otherwise this uses the function defined in
+        files/recursive_equivalents.sql.
 
         Four levels is enough to go from a Gutenberg text to an ISBN.
         Gutenberg ID -> OCLC Work IS -> OCLC Number -> ISBN
@@ -1840,14 +2659,37 @@ class Identifier(Base):
         Returns a dictionary mapping each ID in the original to a
         list of equivalent IDs.
         """
-
-        query = select([Identifier.id, func.fn_recursive_equivalents(Identifier.id, levels, threshold)],
-                       Identifier.id.in_(identifier_ids))
-        results = _db.execute(query)
         equivalents = defaultdict(list)
-        for r in results:
-            original = r[0]
-            equivalent = r[1]
+        if not cls.equivalents_closure_covers(levels, threshold):
+            query = select([Identifier.id, func.fn_recursive_equivalents(Identifier.id, levels, threshold)],
+                           Identifier.id.in_(identifier_ids))
+            for original, equivalent in _db.execute(query):
+                equivalents[original].append(equivalent)
+            return equivalents
+
+        identifier_ids = set(identifier_ids)
+        if not identifier_ids:
+            return equivalents
+
+        closure = table(
+            SessionManager.EQUIVALENTS_CLOSURE_TABLE,
+            column('identifier_id'), column('equivalent_id'),
+            column('depth'), column('strength')
+        )
+        query = select(
+            [closure.c.identifier_id, closure.c.equivalent_id]
+        ).where(
+            closure.c.identifier_id.in_(identifier_ids)
+        ).where(
+            closure.c.depth <= levels
+        ).where(
+            closure.c.strength > threshold
+        ).distinct()
+
+        # Every identifier is equivalent to itself.
+        for identifier_id in identifier_ids:
+            equivalents[identifier_id].append(identifier_id)
+        for original, equivalent in _db.execute(query):
             equivalents[original].append(equivalent)
         return equivalents
         
@@ -1999,6 +2841,25 @@ class Identifier(Base):
         resources = resources.options(joinedload('representation'))
         return resources
 
+    @classmethod
+    def resources_for_links(cls, links, data_source=None):
+        """Find the Resources at the other end of some Hyperlinks that
+        have already been loaded.
+
+        This does the same filtering as resources_for_identifier_ids,
+        without going to the database.
+        """
+        if data_source:
+            if isinstance(data_source, DataSource):
+                data_source = [data_source]
+            data_source_ids = set([d.id for d in data_source])
+            links = [l for l in links if l.data_source_id in data_source_ids]
+        resources = []
+        for link in links:
+            if link.resource not in resources:
+                resources.append(link.resource)
+        return resources
+
     @classmethod
     def classifications_for_identifier_ids(self, _db, identifier_ids):
         classifications = _db.query(Classification).filter(
@@ -2010,15 +2871,26 @@ class Identifier(Base):
     IDEAL_IMAGE_WIDTH = 160
 
     @classmethod
-    def best_cover_for(cls, _db, identifier_ids):
+    def best_cover_for(cls, _db, identifier_ids, inputs=None):
         # Find all image resources associated with any of
         # these identifiers.
-        images = cls.resources_for_identifier_ids(
-            _db, identifier_ids, Hyperlink.IMAGE)
-        images = images.join(Resource.representation)
-        images = images.filter(Representation.mirrored_at != None).\
-            filter(Representation.mirror_url != None)
-        images = images.all()
+        links = None
+        if inputs:
+            links = inputs.links_for(list(identifier_ids), [Hyperlink.IMAGE])
+        if links is not None:
+            images = [
+                r for r in cls.resources_for_links(links)
+                if r.representation
+                and r.representation.mirrored_at != None
+                and r.representation.mirror_url != None
+            ]
+        else:
+            images = cls.resources_for_identifier_ids(
+                _db, identifier_ids, Hyperlink.IMAGE)
+            images = images.join(Resource.representation)
+            images = images.filter(Representation.mirrored_at != None).\
+                filter(Representation.mirror_url != None)
+            images = images.all()
 
         champions = Resource.best_covers_among(images)
         if not champions:
@@ -2030,9 +2902,16 @@ class Identifier(Base):
 
         return champion, images
 
+    @classmethod
+    def summary_rels(cls):
+        """The link relations of the Resources that might be chosen as
+        a Work's summary.
+        """
+        return [Hyperlink.DESCRIPTION, Hyperlink.SHORT_DESCRIPTION]
+
     @classmethod
     def evaluate_summary_quality(cls, _db, identifier_ids,
-                                 privileged_data_sources=None):
+                                 privileged_data_sources=None, inputs=None):
         """Evaluate the summaries for the given group of Identifier IDs.
 
         This is an automatic evaluation based solely on the content of
@@ -2048,6 +2927,9 @@ class Identifier(Base):
         of these data source will be instantly chosen, short-circuiting the
         decision process. Data sources are in order of priority.
 
+        :param inputs: A PresentationCalculationInputs that may already
+        have the relevant Hyperlinks loaded.
+
         :return: The single highest-rated summary Resource.
 
         """
@@ -2060,9 +2942,16 @@ class Identifier(Base):
 
         # Find all rel="description" resources associated with any of
         # these records.
-        rels = [Hyperlink.DESCRIPTION, Hyperlink.SHORT_DESCRIPTION]
-        descriptions = cls.resources_for_identifier_ids(
-            _db, identifier_ids, rels, privileged_data_source).all()
+        rels = cls.summary_rels()
+        links = None
+        if inputs:
+            links = inputs.links_for(identifier_ids, rels)
+        if links is not None:
+            descriptions = cls.resources_for_links(
+                links, privileged_data_source)
+        else:
+            descriptions = cls.resources_for_identifier_ids(
+                _db, identifier_ids, rels, privileged_data_source).all()
 
         champion = None
         # Add each resource's content to the evaluator's corpus.
@@ -2083,7 +2972,9 @@ class Identifier(Base):
         if privileged_data_source and not champion:
             # We could not find any descriptions from the privileged
             # data source. Try relaxing that restriction.
-            return cls.evaluate_summary_quality(_db, identifier_ids, privileged_data_sources[1:])
+            return cls.evaluate_summary_quality(
+                _db, identifier_ids, privileged_data_sources[1:], inputs
+            )
         return champion, descriptions
 
     @classmethod
@@ -3054,14 +3945,15 @@ class Edition(Base):
                 if similarity >= threshold:
                     yield candidate
 
-    def best_cover_within_distance(self, distance, threshold=0.5):
+    def best_cover_within_distance(self, distance, threshold=0.5,
+                                   inputs=None):
         _db = Session.object_session(self)
         identifier_ids = [self.primary_identifier.id]
         if distance > 0:
             identifier_ids = Identifier.recursively_equivalent_identifier_ids(
                 _db, identifier_ids, distance, threshold=threshold)
 
-        return Identifier.best_cover_for(_db, identifier_ids)
+        return Identifier.best_cover_for(_db, identifier_ids, inputs=inputs)
 
     @property
     def title_for_permanent_work_id(self):
@@ -3134,8 +4026,12 @@ class Edition(Base):
 
 
 
-    def calculate_presentation(self, policy=None):
-        """Make sure the presentation of this Edition is up-to-date."""
+    def calculate_presentation(self, policy=None, inputs=None):
+        """Make sure the presentation of this Edition is up-to-date.
+
+        :param inputs: A PresentationCalculationInputs that may already
+        have this Edition's covers loaded.
+        """
         _db = Session.object_session(self)
         changed = False
         if policy is None:
@@ -3160,7 +4056,7 @@ class Edition(Base):
             )
 
         if policy.choose_cover:
-            self.choose_cover()
+            self.choose_cover(inputs=inputs)
 
         if (self.author != old_author 
             or self.sort_author != old_sort_author
@@ -3216,13 +4112,15 @@ class Edition(Base):
             sort_author = self.UNKNOWN_AUTHOR
         return author, sort_author
 
-    def choose_cover(self):
+    def choose_cover(self, inputs=None):
         """Try to find a cover that can be used for this Edition."""
         for distance in (0, 5):
             # If there's a cover directly associated with the
             # Edition's primary ID, use it. Otherwise, find the
             # best cover associated with any related identifier.
-            best_cover, covers = self.best_cover_within_distance(distance)
+            best_cover, covers = self.best_cover_within_distance(
+                distance, inputs=inputs
+            )
 
             if best_cover:
                 if not best_cover.representation:
@@ -3278,6 +4176,42 @@ class WorkGenre(Base):
         return "%s (%d%%)" % (self.genre.name, self.affinity*100)
 
 
+class SearchDocument(Base):
+    """A work's search document, kept in the database for sites that
+    search with PostgresSearchIndex instead of Elasticsearch.
+
+    The columns that searches are filtered on are copied out of the
+    document and normalized the same way the Elasticsearch mapping
+    normalizes them.
+    """
+
+    __tablename__ = 'searchdocuments'
+    id = Column(Integer, primary_key=True)
+
+    # The name of the index this document belongs to, so that an index
+    # can be rebuilt or migrated alongside the one in use.
+    index_name = Column(Unicode, nullable=False, index=True)
+    work_id = Column(Integer, ForeignKey('works.id', ondelete='CASCADE'),
+                     index=True, nullable=False)
+    document = Column(JSON)
+    search_vector = Column(TSVECTOR)
+
+    medium = Column(Unicode, index=True)
+    language = Column(Unicode, index=True)
+    audience = Column(Unicode, index=True)
+    fiction = Column(Unicode, index=True)
+    target_age_lower = Column(Integer)
+    target_age_upper = Column(Integer)
+    genre_ids = Column(ARRAY(Integer))
+    quality = Column(Float)
+
+    __table_args__ = (
+        UniqueConstraint('index_name', 'work_id'),
+        Index('ix_searchdocuments_search_vector', 'search_vector',
+              postgresql_using='gin'),
+    )
+
+
 class PresentationCalculationPolicy(object):
     """Which parts of the Work or Edition's presentation
     are we actually looking to update?
@@ -3337,6 +4271,120 @@ class PresentationCalculationPolicy(object):
         )
 
 
+class PresentationCalculationInputs(object):
+    """The data needed to calculate presentation for a batch of Works,
+    loaded up front in a few queries.
+
+    Calculating presentation for a Work means looking up its equivalent
+    Identifiers, then the classifications, measurements, descriptions
+    and covers associated with them. Done one Work at a time, that's
+    several queries per Work. Pass one of these objects into
+    Work.calculate_presentation and the data will be looked up here
+    instead. Anything that wasn't loaded is still looked up in the
+    database, so the results are the same either way.
+    """
+
+    def __init__(self, _db, works, policy=None):
+        self._db = _db
+        policy = policy or PresentationCalculationPolicy()
+
+        self.identifier_ids_by_work = {}
+        self.identifier_ids = set()
+        self.classifications = None
+        self.measurements = None
+        self.links = None
+        self.rels = set()
+
+        work_ids = [work.id for work in works]
+        if not work_ids:
+            return
+
+        # Find each Work's identifiers and everything equivalent to them.
+        primary_identifier_ids = defaultdict(list)
+        qu = _db.query(LicensePool.work_id, LicensePool.identifier_id).filter(
+            LicensePool.work_id.in_(work_ids)).filter(
+                LicensePool.identifier_id != None)
+        for work_id, identifier_id in qu:
+            primary_identifier_ids[work_id].append(identifier_id)
+
+        equivalents = Identifier.recursively_equivalent_identifier_ids(
+            _db, set([x for ids in primary_identifier_ids.values() for x in ids])
+        )
+        for work_id in work_ids:
+            identifier_ids = set()
+            for primary_identifier_id in primary_identifier_ids[work_id]:
+                identifier_ids.update(equivalents[primary_identifier_id])
+            self.identifier_ids_by_work[work_id] = identifier_ids
+            self.identifier_ids.update(identifier_ids)
+        if not self.identifier_ids:
+            return
+
+        if policy.classify:
+            self.classifications = defaultdict(list)
+            for classification in Identifier.classifications_for_identifier_ids(
+                    _db, self.identifier_ids):
+                self.classifications[classification.identifier_id].append(
+                    classification
+                )
+
+        if policy.calculate_quality:
+            self.measurements = defaultdict(list)
+            for measurement in Work.quality_measurements(
+                    _db, self.identifier_ids):
+                self.measurements[measurement.identifier_id].append(measurement)
+
+        if policy.choose_summary:
+            self.rels.update(Identifier.summary_rels())
+        if policy.choose_cover:
+            self.rels.add(Hyperlink.IMAGE)
+        if self.rels:
+            self.links = defaultdict(list)
+            qu = _db.query(Hyperlink).filter(
+                Hyperlink.identifier_id.in_(self.identifier_ids)).filter(
+                    Hyperlink.rel.in_(self.rels)).options(
+                        joinedload('resource').joinedload('representation'))
+            for link in qu:
+                self.links[link.identifier_id].append(link)
+
+    def _covers(self, identifier_ids):
+        return all(x in self.identifier_ids for x in identifier_ids)
+
+    def identifier_ids_for(self, work):
+        """The IDs of all Identifiers equivalent to the Work's
+        LicensePools' Identifiers, or None if the Work isn't part of
+        this batch.
+        """
+        return self.identifier_ids_by_work.get(work.id)
+
+    def classifications_for(self, identifier_ids):
+        """All Classifications of the given Identifiers, or None if
+        they weren't loaded.
+        """
+        if self.classifications is None or not self._covers(identifier_ids):
+            return None
+        return [classification for x in identifier_ids
+                for classification in self.classifications[x]]
+
+    def measurements_for(self, identifier_ids):
+        """The most recent quality-related Measurements of the given
+        Identifiers, or None if they weren't loaded.
+        """
+        if self.measurements is None or not self._covers(identifier_ids):
+            return None
+        return [measurement for x in identifier_ids
+                for measurement in self.measurements[x]]
+
+    def links_for(self, identifier_ids, rels):
+        """The Hyperlinks from the given Identifiers with the given
+        link relations, or None if they weren't loaded.
+        """
+        if (self.links is None or not self.rels.issuperset(rels)
+            or not self._covers(identifier_ids)):
+            return None
+        return [link for x in identifier_ids for link in self.links[x]
+                if link.rel in rels]
+
+
 class Work(Base):
 
     APPEALS_URI = "http://librarysimplified.org/terms/appeals/"
@@ -4041,7 +5089,8 @@ class Work(Base):
 
 
     def calculate_presentation(
-        self, policy=None, search_index_client=None, exclude_search=False
+        self, policy=None, search_index_client=None, exclude_search=False,
+        inputs=None
     ):
         """Make a Work ready to show to patrons.
 
@@ -4055,6 +5104,10 @@ class Work(Base):
         * The intended audience for the work.
         * The best available summary for the work.
         * The overall popularity of the work.
+
+        :param inputs: A PresentationCalculationInputs for a batch of
+        Works including this one. The data it has already loaded will
+        be used instead of querying the database.
         """
         
         # Gather information up front so we can see if anything
@@ -4068,7 +5121,9 @@ class Work(Base):
         edition_changed = self.calculate_presentation_edition(policy)
 
         if policy.choose_cover:
-            cover_changed = self.presentation_edition.calculate_presentation(policy)
+            cover_changed = self.presentation_edition.calculate_presentation(
+                policy, inputs=inputs
+            )
             edition_changed = edition_changed or cover_changed
 
         summary = self.summary
@@ -4091,12 +5146,18 @@ class Work(Base):
             # classifications, or measurements.
             _db = Session.object_session(self)
 
-            identifier_ids = self.all_identifier_ids()
+            identifier_ids = None
+            if inputs:
+                identifier_ids = inputs.identifier_ids_for(self)
+            if identifier_ids is None:
+                identifier_ids = self.all_identifier_ids()
         else:
             identifier_ids = []
 
         if policy.classify:
-            classification_changed = self.assign_genres(identifier_ids)
+            classification_changed = self.assign_genres(
+                identifier_ids, inputs=inputs
+            )
             WorkCoverageRecord.add_for(
                 self, operation=WorkCoverageRecord.CLASSIFY_OPERATION
             )
@@ -4104,7 +5165,8 @@ class Work(Base):
         if policy.choose_summary:
             staff_data_source = DataSource.lookup(_db, DataSource.LIBRARY_STAFF)
             summary, summaries = Identifier.evaluate_summary_quality(
-                _db, identifier_ids, [staff_data_source, licensed_data_sources]
+                _db, identifier_ids, [staff_data_source, licensed_data_sources],
+                inputs=inputs
             )
             # TODO: clean up the content
             self.set_summary(summary)      
@@ -4129,7 +5191,9 @@ class Work(Base):
                 # if we still haven't found anything of a quality measurement, 
                 # then at least make it an integer zero, not none.
                 default_quality = 0
-            self.calculate_quality(identifier_ids, default_quality)
+            self.calculate_quality(
+                identifier_ids, default_quality, inputs=inputs
+            )
 
         if self.summary_text:
             if isinstance(self.summary_text, unicode):
@@ -4157,10 +5221,7 @@ class Work(Base):
             self.calculate_opds_entries()
 
         if (changed or policy.update_search_index) and not exclude_search:
-            # Ensure new changes are reflected in database queries
-            _db = Session.object_session(self)
-            _db.flush()
-            self.update_external_index(search_index_client)
+            self.update_or_queue_external_index(search_index_client)
 
         # Now that everything's calculated, print it out.
         if policy.verbose:            
@@ -4263,29 +5324,68 @@ class Work(Base):
         )
 
 
+    def update_or_queue_external_index(self, client=None):
+        """Bring this work's search document up to date.
+
+        :param client: If an ExternalSearchIndex is provided, the
+        document is updated right away. Otherwise the work is queued
+        for SearchIndexCoverageProvider, which updates documents in
+        bulk without holding up whoever changed the work.
+        """
+        if client:
+            # Ensure new changes are reflected in database queries
+            _db = Session.object_session(self)
+            _db.flush()
+            return self.update_external_index(client)
+        self.external_index_needs_updating()
+
+    def external_index_needs_updating(self):
+        """Queue this work to have its search document updated.
+
+        The queue is the work's WorkCoverageRecord for
+        UPDATE_SEARCH_INDEX_OPERATION, so it's written in the same
+        transaction as the change that made it necessary, and a work
+        that's queued several times is still only updated once.
+        """
+        operation = WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        record, is_new = WorkCoverageRecord.add_for(
+            self, operation=operation, status=WorkCoverageRecord.REGISTERED
+        )
+        # Even if the work looks like it's already queued, the record
+        # is always written with a new timestamp.
+        # SearchIndexCoverageProvider may be indexing the work right
+        # now, and it only marks the work as indexed if the timestamp
+        # hasn't changed since it started. The session may also have
+        # missed the provider marking the work as indexed, so the
+        # status is written even if it looks unchanged.
+        flag_modified(record, 'status')
+        return record
+
     def update_external_index(self, client, add_coverage_record=True):
         if not client:
             from external_search import ExternalSearchIndex
             _db = Session.object_session(self)
             client = ExternalSearchIndex(_db)
-        args = dict(index=client.works_index,
-                    doc_type=client.work_document_type,
-                    id=self.id)
         if not client.works_index:
             # There is no index set up on this instance.
             return
         present_in_index = False
+        # While the index is being migrated, documents are written to
+        # the new index as well as the current one.
+        indices = client.write_indices
         if self.presentation_ready:
             doc = self.to_search_document()
             if doc:
-                args['body'] = doc
                 if logging.getLogger().level == logging.DEBUG:
                     logging.debug(
                         "Indexed work %d (%s): %r", self.id, self.title, doc
                     )
                 else:
                     logging.info("Indexed work %d (%s)", self.id, self.title)
-                client.index(**args)
+                for index in indices:
+                    client.index(index=index,
+                                 doc_type=client.work_document_type,
+                                 id=self.id, body=doc)
                 present_in_index = True
             else:
                 logging.warn(
@@ -4293,8 +5393,12 @@ class Work(Base):
                     self.id, self.title
                 )
         else:
-            if client.exists(**args):
-                client.delete(**args)
+            for index in indices:
+                args = dict(index=index,
+                            doc_type=client.work_document_type,
+                            id=self.id)
+                if client.exists(**args):
+                    client.delete(**args)
         if add_coverage_record and present_in_index:
             WorkCoverageRecord.add_for(
                 self, operation=(WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION + "-" + client.works_index)
@@ -4310,7 +5414,7 @@ class Work(Base):
         self.presentation_ready_attempt = as_of
         self.random = random.random()
         if not exclude_search:
-            self.update_external_index(search_index_client)
+            self.update_or_queue_external_index(search_index_client)
 
     def set_presentation_ready_based_on_content(self, search_index_client=None):
         """Set this work as presentation ready, if it appears to
@@ -4333,18 +5437,31 @@ class Work(Base):
         ):
             self.presentation_ready = False
             # This will remove the work from the search index.
-            self.update_external_index(search_index_client)
+            self.update_or_queue_external_index(search_index_client)
         else:
             self.set_presentation_ready(search_index_client=search_index_client)
 
-    def calculate_quality(self, identifier_ids, default_quality=0):
-        _db = Session.object_session(self)
+    @classmethod
+    def quality_measurements(cls, _db, identifier_ids):
+        """Find the Measurements of the given Identifiers that go into
+        a Work's quality.
+        """
         quantities = [Measurement.POPULARITY, Measurement.RATING,
                       Measurement.DOWNLOADS, Measurement.QUALITY]
-        measurements = _db.query(Measurement).filter(
+        return _db.query(Measurement).filter(
             Measurement.identifier_id.in_(identifier_ids)).filter(
                 Measurement.is_most_recent==True).filter(
-                    Measurement.quantity_measured.in_(quantities)).all()
+                    Measurement.quantity_measured.in_(quantities))
+
+    def calculate_quality(self, identifier_ids, default_quality=0,
+                          inputs=None):
+        _db = Session.object_session(self)
+        measurements = None
+        if inputs:
+            measurements = inputs.measurements_for(identifier_ids)
+        if measurements is None:
+            measurements = self.quality_measurements(
+                _db, identifier_ids).all()
 
         self.quality = Measurement.overall_quality(
             measurements, default_value=default_quality)
@@ -4352,10 +5469,13 @@ class Work(Base):
             self, operation=WorkCoverageRecord.QUALITY_OPERATION
         )
 
-    def assign_genres(self, identifier_ids):
+    def assign_genres(self, identifier_ids, inputs=None):
         """Set classification information for this work based on the
         subquery to get equivalent identifiers.
 
+        :param inputs: A PresentationCalculationInputs that may already
+        have the relevant Classifications loaded.
+
         :return: A boolean explaining whether or not any data actually
         changed.
         """
@@ -4366,9 +5486,13 @@ class Work(Base):
         old_target_age = self.target_age
 
         _db = Session.object_session(self)
-        classifications = Identifier.classifications_for_identifier_ids(
-            _db, identifier_ids
-        )
+        classifications = None
+        if inputs:
+            classifications = inputs.classifications_for(identifier_ids)
+        if classifications is None:
+            classifications = Identifier.classifications_for_identifier_ids(
+                _db, identifier_ids
+            )
         for classification in classifications:
             classifier.add(classification)
 
@@ -4471,9 +5595,55 @@ class Work(Base):
 
         # If this is a batch of search documents, postgres needs extra working
         # memory to process the query quickly.
+        # The setting only lasts until the end of the transaction.
         if len(works) > 50:
-            _db.execute("set work_mem='200MB'")
+            _db.execute("set local work_mem='200MB'")
+
+        search_json = cls.search_documents_query(
+            Work.id.in_((w.id for w in works))
+        )
+        result = _db.execute(search_json)
+        if result:
+            return [r[0] for r in result]
+
+    @classmethod
+    def stream_search_documents(cls, connection, after=None):
+        """Generate search documents for every presentation-ready Work,
+        in order by ID.
+
+        The documents are read through a server-side cursor, so only a
+        few of them are in memory at any one time, no matter how many
+        Works there are.
+
+        :param connection: The Connection to read from. The cursor
+        lives in this connection's transaction, so it shouldn't be
+        committed until the generator has been exhausted.
+
+        :param after: Only generate documents for Works whose IDs are
+        greater than this.
+        """
+        connection.execute("set local work_mem='200MB'")
+        clause = Work.presentation_ready==True
+        if after:
+            clause = and_(clause, Work.id > after)
+        query = cls.search_documents_query(clause, order_by_id=True)
+        result = connection.execution_options(stream_results=True).execute(
+            query
+        )
+        for row in result:
+            yield row[0]
+
+    @classmethod
+    def search_documents_query(cls, works_clause, order_by_id=False):
+        """Build the query used by to_search_documents and
+        stream_search_documents.
 
+        :param works_clause: A clause against Work that picks out
+        the Works to generate documents for.
+
+        :param order_by_id: If this is True, the documents will be
+        generated in order by Work ID.
+        """
         # This query gets relevant columns from Work and Edition for the Works we're
         # interested in. The work_id, edition_id, and identifier_id columns are used
         # by other subqueries to filter, and the remaining columns are used directly
@@ -4500,7 +5670,7 @@ class Work(Base):
              Work.rating,
              Work.popularity,
             ],
-            Work.id.in_((w.id for w in works))
+            works_clause
         ).select_from(
             join(
                 Work, Edition,
@@ -4669,10 +5839,9 @@ class Work(Base):
                     literal_column(search_data.name)
                 )]
         ).select_from(search_data)
-
-        result = _db.execute(search_json)
-        if result:
-            return [r[0] for r in result]
+        if order_by_id:
+            search_json = search_json.order_by(search_data.c._id)
+        return search_json
 
     def to_search_document(self):
         """Generate a search document for this Work."""
@@ -5971,8 +7140,17 @@ class CachedFeed(Base):
     # A 'page' feed is associated with a set of values for pagination.
     pagination = Column(Unicode, nullable=False)
 
-    # The content of the feed.
-    content = Column(Unicode, nullable=True)
+    # The content of the feed. Depending on the site configuration,
+    # this is stored as text, as gzip-compressed UTF-8, or both. Use
+    # the `content` hybrid property rather than these columns.
+    _content = Column('content', Unicode, nullable=True)
+    compressed_content = Column(Binary, nullable=True)
+
+    # The size, in bytes, of the UTF-8 encoded content.
+    content_length = Column(Integer, nullable=True)
+
+    # A hash of the content, suitable for use as an HTTP ETag.
+    etag = Column(Unicode, nullable=True)
 
     # Every feed is associated with a Library.
     library_id = Column(
@@ -5991,6 +7169,231 @@ class CachedFeed(Base):
 
     log = logging.getLogger("CachedFeed")
 
+    # Ways of storing the content of a feed.
+    STORE_TEXT = u'text'
+    STORE_COMPRESSED = u'compressed'
+    STORE_BOTH = u'both'
+    DEFAULT_STORAGE = STORE_COMPRESSED
+
+    @classmethod
+    def storage(cls):
+        """Decide how feed content should be stored, based on the
+        site configuration.
+        """
+        storage = None
+        if Configuration.instance is not None:
+            storage = Configuration.get(Configuration.CACHED_FEED_STORAGE)
+        if storage not in (cls.STORE_TEXT, cls.STORE_COMPRESSED, cls.STORE_BOTH):
+            storage = cls.DEFAULT_STORAGE
+        return storage
+
+    @classmethod
+    def compress(cls, data):
+        """Compress a bytestring into gzip format."""
+        compressor = zlib.compressobj(
+            zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+        return compressor.compress(data) + compressor.flush()
+
+    @classmethod
+    def decompress(cls, data):
+        """Decompress gzip-format data into a bytestring."""
+        return zlib.decompress(str(data), 16 + zlib.MAX_WBITS)
+
+    @hybrid_property
+    def content(self):
+        if self.compressed_content is not None:
+            return self.decompress(self.compressed_content).decode("utf8")
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        if value is None:
+            self._content = None
+            self.compressed_content = None
+            self.content_length = None
+            self.etag = None
+            return
+        if isinstance(value, unicode):
+            encoded = value.encode("utf8")
+        else:
+            encoded = value
+            value = value.decode("utf8")
+        self.content_length = len(encoded)
+        self.etag = unicode(md5.new(encoded).hexdigest())
+
+        storage = self.storage()
+        if storage == self.STORE_COMPRESSED:
+            self._content = None
+        else:
+            self._content = value
+        if storage == self.STORE_TEXT:
+            self.compressed_content = None
+        else:
+            self.compressed_content = self.compress(encoded)
+
+    @content.expression
+    def content(cls):
+        # This SQL expression is only good for checking whether or
+        # not a feed has content; its value is not the content itself.
+        return func.coalesce(
+            cls._content,
+            case([(cls.compressed_content != None, literal_column("''"))])
+        )
+
+    @property
+    def has_content(self):
+        """Does this feed have content, without decompressing it?"""
+        return bool(self._content) or bool(self.compressed_content)
+
+    def gzipped_content(self):
+        """The content of this feed, compressed in gzip format."""
+        if self.compressed_content is not None:
+            return str(self.compressed_content)
+        if self._content is not None:
+            return self.compress(self._content.encode("utf8"))
+        return None
+
+    # Fresh feeds are kept in an in-process cache so that most
+    # requests can be served without going to the database. These
+    # are the default limits on that cache; they can be overridden
+    # in the configuration file.
+    MEMORY_CACHE_MAX_ENTRIES = 500
+    MEMORY_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+    # A feed may be regenerated by some other process, and only this
+    # process's copy is thrown out when a feed is updated. So no copy
+    # is kept in memory for longer than this many seconds, even if
+    # the feed itself is meant to be cached forever.
+    MEMORY_CACHE_TTL = 60
+
+    _memory_cache = None
+
+    @classmethod
+    def memory_cache(cls):
+        """The LRUCache of CachedFeed snapshots used by this process."""
+        if cls._memory_cache is None:
+            max_entries = cls.MEMORY_CACHE_MAX_ENTRIES
+            max_bytes = cls.MEMORY_CACHE_MAX_BYTES
+            ttl = cls.MEMORY_CACHE_TTL
+            if Configuration.instance is not None:
+                max_entries = int(Configuration.get(
+                    Configuration.CACHED_FEED_MEMORY_CACHE_MAX_ENTRIES,
+                    max_entries
+                ))
+                max_bytes = int(Configuration.get(
+                    Configuration.CACHED_FEED_MEMORY_CACHE_MAX_BYTES,
+                    max_bytes
+                ))
+                ttl = int(Configuration.get(
+                    Configuration.CACHED_FEED_MEMORY_CACHE_TTL, ttl
+                ))
+            cls._memory_cache = LRUCache(
+                max_entries, max_bytes, sizeof=cls._snapshot_size, ttl=ttl
+            )
+        return cls._memory_cache
+
+    @classmethod
+    def reset_cache(cls):
+        """Throw away the in-process cache of feeds."""
+        cls._memory_cache = None
+
+    @classmethod
+    def _snapshot_size(cls, feed):
+        size = 0
+        if feed._content is not None:
+            size += len(feed._content)
+        if feed.compressed_content is not None:
+            size += len(feed.compressed_content)
+        return size
+
+    @classmethod
+    def memory_cache_key(cls, library_id, lane_name, work_id, type,
+                         languages, facets, pagination):
+        return (library_id, lane_name, work_id, type, languages,
+                facets, pagination)
+
+    @property
+    def _memory_cache_key(self):
+        return self.memory_cache_key(
+            self.library_id, self.lane_name, self.work_id, self.type,
+            self.languages, self.facets, self.pagination
+        )
+
+    def snapshot(self):
+        """Create a detached copy of this CachedFeed that can be kept
+        in memory and later merged into any database session.
+        """
+        snapshot = CachedFeed(
+            id=self.id, lane_name=self.lane_name, languages=self.languages,
+            timestamp=self.timestamp, type=self.type, facets=self.facets,
+            pagination=self.pagination, _content=self._content,
+            compressed_content=self.compressed_content,
+            content_length=self.content_length, etag=self.etag,
+            library_id=self.library_id, work_id=self.work_id
+        )
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    @classmethod
+    def is_fresh(cls, feed, max_age):
+        """Is the given feed's content fresh enough to be served?"""
+        from opds import AcquisitionFeed
+        if not feed.has_content:
+            return False
+        if max_age is AcquisitionFeed.CACHE_FOREVER:
+            return True
+        if not feed.timestamp:
+            return False
+        cutoff = datetime.datetime.utcnow() - max_age
+        return feed.timestamp >= cutoff
+
+    # Once a feed expires, one request regenerates it while all
+    # other requests continue to be served the stale content--but
+    # only for this many seconds past the expiration time. The
+    # grace period can be set per feed type with a sitewide
+    # ConfigurationSetting.
+    DEFAULT_STALE_GRACE = 300
+    STALE_GRACE_POLICIES = {
+        GROUPS_TYPE : Configuration.GROUPED_STALE_GRACE_POLICY,
+    }
+    DEFAULT_STALE_GRACE_POLICY = Configuration.NONGROUPED_STALE_GRACE_POLICY
+
+    # The first key of the two-key Postgres advisory lock held while a
+    # feed is being regenerated; the second key is the feed's ID.
+    REGENERATION_LOCK_NAMESPACE = 0x0fee
+
+    @classmethod
+    def stale_grace(cls, _db, type):
+        """How long past its expiration may a feed of the given type
+        be served while it's being regenerated?
+
+        :return: A timedelta.
+        """
+        key = cls.STALE_GRACE_POLICIES.get(
+            type, cls.DEFAULT_STALE_GRACE_POLICY
+        )
+        value = ConfigurationSetting.sitewide(_db, key).int_value
+        if value is None:
+            value = cls.DEFAULT_STALE_GRACE
+        return datetime.timedelta(seconds=value)
+
+    def acquire_regeneration_lock(self, _db):
+        """Try to become the only client regenerating this feed.
+
+        The lock is a Postgres advisory lock, so it works across
+        processes, and it's released automatically when the current
+        transaction ends.
+
+        :return: True if the lock was acquired; False if some other
+        transaction is already regenerating this feed.
+        """
+        sql = text("select pg_try_advisory_xact_lock(:namespace, :id)")
+        [[acquired]] = _db.execute(
+            sql, dict(namespace=self.REGENERATION_LOCK_NAMESPACE, id=self.id)
+        )
+        return acquired
+
     @classmethod
     def fetch(cls, _db, lane, type, facets, pagination, annotator,
               force_refresh=False, max_age=None):
@@ -6026,6 +7429,22 @@ class CachedFeed(Base):
         else:
             pagination_key = u""
 
+        library = lane.library
+        memory_cache = cls.memory_cache()
+        memory_cache_key = cls.memory_cache_key(
+            library.id, lane_name, work.id if work else None, type,
+            languages_key, facets_key, pagination_key
+        )
+
+        if force_refresh is not True:
+            # If a fresh copy of this feed is in memory, we don't need
+            # to go to the database at all.
+            snapshot = memory_cache.get(memory_cache_key)
+            if snapshot is not None:
+                if cls.is_fresh(snapshot, max_age):
+                    return _db.merge(snapshot, load=False), True
+                memory_cache.remove(memory_cache_key)
+
         # Get a CachedFeed object. We will either return its .content,
         # or update its .content.
         constraint_clause = and_(cls.content!=None, cls.timestamp!=None)
@@ -6034,7 +7453,7 @@ class CachedFeed(Base):
             on_multiple='interchangeable',
             constraint=constraint_clause,
             lane_name=lane_name,
-            library=lane.library,
+            library=library,
             work=work,
             type=type,
             languages=languages_key,
@@ -6049,8 +7468,9 @@ class CachedFeed(Base):
         if max_age is AcquisitionFeed.CACHE_FOREVER:
             # This feed is so expensive to generate that it must be cached
             # forever (unless force_refresh is True).
-            if not is_new and feed.content:
+            if not is_new and feed.has_content:
                 # Cacheable!
+                memory_cache.set(memory_cache_key, feed.snapshot())
                 return feed, True
             else:
                 # We're supposed to generate this feed, but as a group
@@ -6069,11 +7489,16 @@ class CachedFeed(Base):
                 )
         else:
             # This feed is cheap enough to generate on the fly.
-            cutoff = datetime.datetime.utcnow() - max_age
-            fresh = False
-            if feed.timestamp and feed.content:
-                if feed.timestamp >= cutoff:
-                    fresh = True
+            fresh = cls.is_fresh(feed, max_age)
+            if fresh:
+                memory_cache.set(memory_cache_key, feed.snapshot())
+            elif (cls.is_fresh(feed, max_age + cls.stale_grace(_db, type))
+                  and not feed.acquire_regeneration_lock(_db)):
+                # The feed has expired, but only recently, and
+                # another request is already regenerating it. Rather
+                # than regenerate the same feed in parallel, serve the
+                # stale content.
+                fresh = True
             return feed, fresh
 
         # Either there is no cached feed or it's time to update it.
@@ -6084,8 +7509,15 @@ class CachedFeed(Base):
         self.timestamp = datetime.datetime.utcnow()
         _db.flush()
 
+        # Whatever copy of this feed was in memory is now out of
+        # date. The new content will be cached the next time it's
+        # fetched.
+        self.memory_cache().remove(self._memory_cache_key)
+
     def __repr__(self):
-        if self.content:
+        if self.content_length is not None:
+            length = self.content_length
+        elif self.has_content:
             length = len(self.content)
         else:
             length = "No content"
@@ -9388,6 +10820,7 @@ class ExternalIntegration(Base, HasFullTableCache):
 
     # Integrations with SEARCH_GOAL
     ELASTICSEARCH = u'Elasticsearch'
+    POSTGRES_SEARCH = u'Postgres'
 
     # Integrations with DRM_GOAL
     ADOBE_VENDOR_ID = u'Adobe Vendor ID'
@@ -9417,6 +10850,10 @@ class ExternalIntegration(Base, HasFullTableCache):
     USERNAME = u"username"
     PASSWORD = u"password"
 
+    # The number of network requests a CoverageProvider for this
+    # integration may make at once.
+    COVERAGE_CONCURRENCY = u"coverage_concurrency"
+
     _cache = HasFullTableCache.RESET
     _id_cache = HasFullTableCache.RESET
     
@@ -10417,6 +11854,15 @@ def site_configuration_has_changed(_db, timeout=1):
             dict(service=Configuration.SITE_CONFIGURATION_CHANGED,
                  timestamp=now)
         )
+
+        # Tell other processes about the change once it's committed.
+        _db.execute(
+            text("select pg_notify(:channel, :payload)"),
+            dict(channel=Configuration.SITE_CONFIGURATION_CHANNEL,
+                 payload=now.strftime(
+                     Configuration.SITE_CONFIGURATION_TIMESTAMP_FORMAT
+                 ))
+        )
         
         # Update the Configuration's record of when the configuration
         # was updated. This will update our local record immediately
@@ -10463,61 +11909,68 @@ def configuration_relevant_collection_change(target, value, initiator):
 def configuration_relevant_lifecycle_event(mapper, connection, target):
     site_configuration_has_changed(target)
 
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def invalidate_changed_cache_rows(session):
+    # Rows of cached tables that changed in the transaction that just
+    # ended will be reloaded the next time someone needs them.
+    HasFullTableCache.invalidate_pending(session)
+
 @event.listens_for(Collection, 'after_insert')
 @event.listens_for(Collection, 'after_delete')
 @event.listens_for(Collection, 'after_update')
 def refresh_collection_cache(mapper, connection, target):
-    # The next time someone tries to access a Collection,
-    # the cache will be repopulated.
-    Collection.reset_cache()
+    # The next time someone tries to access this Collection,
+    # it will be reloaded.
+    Collection.cache_changed(connection, target)
 
 @event.listens_for(ConfigurationSetting, 'after_insert')
 @event.listens_for(ConfigurationSetting, 'after_delete')
 @event.listens_for(ConfigurationSetting, 'after_update')
 def refresh_configuration_settings(mapper, connection, target):
-    # The next time someone tries to access a configuration setting,
-    # the cache will be repopulated.
-    ConfigurationSetting.reset_cache()
+    # The next time someone tries to access this configuration
+    # setting, it will be reloaded.
+    ConfigurationSetting.cache_changed(connection, target)
     
 @event.listens_for(DataSource, 'after_insert')
 @event.listens_for(DataSource, 'after_delete')
 @event.listens_for(DataSource, 'after_update')
 def refresh_datasource_cache(mapper, connection, target):
-    # The next time someone tries to access a DataSource,
-    # the cache will be repopulated.
-    DataSource.reset_cache()
+    # The next time someone tries to access this DataSource,
+    # it will be reloaded.
+    DataSource.cache_changed(connection, target)
 
 @event.listens_for(DeliveryMechanism, 'after_insert')
 @event.listens_for(DeliveryMechanism, 'after_delete')
 @event.listens_for(DeliveryMechanism, 'after_update')
 def refresh_datasource_cache(mapper, connection, target):
-    # The next time someone tries to access a DeliveryMechanism,
-    # the cache will be repopulated.
-    DeliveryMechanism.reset_cache()
+    # The next time someone tries to access this DeliveryMechanism,
+    # it will be reloaded.
+    DeliveryMechanism.cache_changed(connection, target)
     
 @event.listens_for(ExternalIntegration, 'after_insert')
 @event.listens_for(ExternalIntegration, 'after_delete')
 @event.listens_for(ExternalIntegration, 'after_update')
 def refresh_datasource_cache(mapper, connection, target):
-    # The next time someone tries to access an ExternalIntegration,
-    # the cache will be repopulated.
-    ExternalIntegration.reset_cache()
+    # The next time someone tries to access this ExternalIntegration,
+    # it will be reloaded.
+    ExternalIntegration.cache_changed(connection, target)
     
 @event.listens_for(Library, 'after_insert')
 @event.listens_for(Library, 'after_delete')
 @event.listens_for(Library, 'after_update')
 def refresh_library_cache(mapper, connection, target):
-    # The next time someone tries to access a library,
-    # the cache will be repopulated.
-    Library.reset_cache()
+    # The next time someone tries to access this library,
+    # it will be reloaded.
+    Library.cache_changed(connection, target)
     
 @event.listens_for(Genre, 'after_insert')
 @event.listens_for(Genre, 'after_delete')
 @event.listens_for(Genre, 'after_update')
 def refresh_genre_cache(mapper, connection, target):
-    # The next time someone tries to access a genre,
-    # the cache will be repopulated.
+    # The next time someone tries to access this genre,
+    # it will be reloaded.
     #
     # The only time this should really happen is the very first time a
     # site is brought up, but just in case.
-    Genre.reset_cache()
+    Genre.cache_changed(connection, target)
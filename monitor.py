@@ -1,13 +1,22 @@
 from nose.tools import set_trace
+from collections import Counter
 import datetime
 import os
 import logging
+import multiprocessing
+from Queue import (
+    Empty,
+    Queue,
+)
+import threading
 import time
 import traceback
+from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.functions import func
 from sqlalchemy.sql.expression import (
     or_,
     and_,
+    not_,
 )
 
 import log # This sets the appropriate log format and level.
@@ -16,6 +25,9 @@ from coverage import CoverageFailure
 from model import (
     get_one,
     get_one_or_create,
+    production_session,
+    CachedFeed,
+    HasFullTableCache,
     Collection,
     CollectionMissing,
     CoverageRecord,
@@ -23,8 +35,10 @@ from model import (
     ExternalIntegration,
     CustomListEntry,
     Identifier,
+    Library,
     LicensePool,
     PresentationCalculationPolicy,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
@@ -278,6 +292,9 @@ class SweepMonitor(CollectionMonitor):
         if not cls.MODEL_CLASS:
             raise ValueError("%s must define MODEL_CLASS" % cls.__name__)
         self.model_class = cls.MODEL_CLASS
+        # When this Monitor is sweeping one shard of the table, only
+        # items with IDs up to this one are processed.
+        self.upper_bound = None
         super(SweepMonitor, self).__init__(_db, collection=collection)
 
     def run(self):        
@@ -312,6 +329,156 @@ class SweepMonitor(CollectionMonitor):
                 self.cleanup()
                 break
 
+    def run_sharded(self, shards=None):
+        """Split the table into ranges of IDs and sweep them all at
+        once, each in its own process.
+
+        Each shard keeps track of its progress in a Timestamp of its
+        own, so if some of them crash, the next run picks up where
+        they left off. The workers create their Monitors with just a
+        database session, a Collection and a batch size, so this
+        doesn't work for Monitors whose constructors need anything
+        else.
+
+        :param shards: The number of shards. By default, there's one
+           for each CPU.
+        """
+        shards = shards or multiprocessing.cpu_count()
+        shard_args = [
+            (self.__class__, self.collection_id, self.batch_size,
+             shard, shards, lower, upper)
+            for shard, (lower, upper) in enumerate(self.shard_bounds(shards))
+        ]
+        # The workers open their own database sessions, and they need
+        # to see the sweep's bounds.
+        self._db.commit()
+
+        completed = self.run_shards(shard_args)
+        if all(completed):
+            self.finish_sharded_sweep(shards)
+        else:
+            self.log.error(
+                "%d of %d shards failed; they'll resume on the next run.",
+                completed.count(False), shards
+            )
+
+    def run_shards(self, shard_args):
+        """Run each shard in a separate process.
+
+        :return: A list of booleans indicating whether each shard
+           finished.
+        """
+        # The workers are forked from this process. Empty its pool of
+        # idle database connections first, so that no worker inherits
+        # a connection this process might hand out again.
+        self._db.get_bind().engine.dispose()
+        pool = multiprocessing.Pool(
+            len(shard_args), initializer=_init_sweep_worker
+        )
+        try:
+            return pool.map(_run_sweep_shard, shard_args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def sharded_sweep_timestamp(self):
+        """Find or create the Timestamp that holds the highest ID
+        covered by a sharded sweep, while the sweep is in progress.
+        """
+        timestamp, is_new = get_one_or_create(
+            self._db, Timestamp,
+            service="%s (sharded sweep)" % self.service_name,
+            collection=self.collection,
+            create_method_kwargs=dict(counter=0)
+        )
+        return timestamp
+
+    def shard_timestamp(self, shard, shards):
+        """Find or create the Timestamp that keeps track of one shard's
+        progress.
+        """
+        timestamp, is_new = get_one_or_create(
+            self._db, Timestamp,
+            service="%s (shard %d of %d)" % (
+                self.service_name, shard + 1, shards
+            ),
+            collection=self.collection,
+            create_method_kwargs=dict(counter=0)
+        )
+        return timestamp
+
+    def shard_bounds(self, shards):
+        """Split the table into ranges of IDs, one for each shard.
+
+        The ranges are based on the highest ID in the table when the
+        sweep started, so that a sweep that gets interrupted is
+        resumed with the same ranges.
+
+        :return: A list of 2-tuples (lower, upper). A shard covers the
+           IDs above `lower`, up to and including `upper`. The last
+           shard's `upper` is None, so that it also covers items
+           created during the sweep.
+        """
+        sweep = self.sharded_sweep_timestamp()
+        if not sweep.counter:
+            [[max_id]] = self._db.query(func.max(self.model_class.id))
+            sweep.counter = max_id or 0
+        top = sweep.counter
+        bounds = []
+        for shard in range(shards):
+            upper = top * (shard + 1) // shards
+            if shard == shards - 1:
+                upper = None
+            bounds.append((top * shard // shards, upper))
+        return bounds
+
+    def run_shard(self, shard, shards, lower, upper):
+        """Sweep the items with IDs above `lower` and up to `upper`.
+
+        :return: True if the shard was finished, False if an error
+           stopped it.
+        """
+        timestamp = self.shard_timestamp(shard, shards)
+        offset = max(timestamp.counter or 0, lower)
+        self.upper_bound = upper
+        try:
+            while upper is None or offset < upper:
+                try:
+                    new_offset = self.process_batch(offset)
+                except Exception, e:
+                    self.log.error(
+                        "Error during run of shard %d: %s", shard + 1, e,
+                        exc_info=e
+                    )
+                    self._db.rollback()
+                    return False
+                if not new_offset:
+                    # There's nothing left in this shard.
+                    break
+                offset = new_offset
+                timestamp.counter = offset
+                self._db.commit()
+        finally:
+            self.upper_bound = None
+
+        # A shard with an upper bound is done for the rest of the
+        # sweep. The last shard stays where it is, so that it won't
+        # cover the same items again if it has to be resumed.
+        if upper is not None:
+            timestamp.counter = upper
+        self._db.commit()
+        return True
+
+    def finish_sharded_sweep(self, shards):
+        """Every shard is finished, so the next sharded sweep starts
+        over from the beginning.
+        """
+        self.sharded_sweep_timestamp().counter = 0
+        for shard in range(shards):
+            self.shard_timestamp(shard, shards).counter = 0
+        self.cleanup()
+        self._db.commit()
+
     def process_batch(self, offset):
         """Process one batch of work."""
         items = self.fetch_batch(offset).all()
@@ -329,8 +496,10 @@ class SweepMonitor(CollectionMonitor):
 
     def fetch_batch(self, offset):
         """Retrieve one batch of work from the database."""
-        q = self.item_query().filter(self.model_class.id > offset).order_by(
-            self.model_class.id).limit(self.batch_size)
+        q = self.item_query().filter(self.model_class.id > offset)
+        if self.upper_bound is not None:
+            q = q.filter(self.model_class.id <= self.upper_bound)
+        q = q.order_by(self.model_class.id).limit(self.batch_size)
         return q
         
     def item_query(self):
@@ -361,6 +530,47 @@ class SweepMonitor(CollectionMonitor):
         raise NotImplementedError()
 
 
+# Database engines a sweep worker inherited from the process that
+# forked it. They're kept here, unused, because closing their
+# connections from the worker would close them for the parent too.
+_inherited_engines = []
+
+def _init_sweep_worker():
+    """Prepare a newly forked worker process to run shards of a sweep.
+
+    The worker inherits the parent's database engines, whose
+    connections belong to the parent, and the full-table caches,
+    whose objects are attached to the parent's sessions. Set both
+    aside, so the worker connects and loads everything afresh.
+    """
+    _inherited_engines.extend(SessionManager.engine_for_url.values())
+    SessionManager.engine_for_url.clear()
+    for cls in HasFullTableCache.cached_classes():
+        cls.reset_cache()
+
+
+def _run_sweep_shard(args):
+    """Run one shard of a SweepMonitor's sweep, in a worker process
+    with its own database session.
+
+    This is a module-level function so that it can be handed to a
+    multiprocessing.Pool.
+    """
+    (monitor_class, collection_id, batch_size, shard, shards,
+     lower, upper) = args
+    _db = production_session()
+    try:
+        collection = None
+        if collection_id:
+            collection = get_one(_db, Collection, id=collection_id)
+        monitor = monitor_class(
+            _db, collection=collection, batch_size=batch_size
+        )
+        return monitor.run_shard(shard, shards, lower, upper)
+    finally:
+        _db.close()
+
+
 class IdentifierSweepMonitor(SweepMonitor):
     """A Monitor that does some work for every Identifier."""
     MODEL_CLASS = Identifier    
@@ -629,3 +839,310 @@ class CustomListEntryWorkUpdateMonitor(CustomListEntrySweepMonitor):
     
     def process_item(self, item):
         item.set_work()
+
+
+class CachedFeedPrewarmMonitor(Monitor):
+    """Rebuild a library's groups feeds and first-page feeds in the
+    background, so that patrons rarely need to wait for one to be
+    generated, and never get a page feed where they expected a
+    groups feed.
+
+    Every lane in the library's lane tree is considered. Feeds that
+    don't exist at all are rebuilt first. After that, feeds that are
+    close to expiring are rebuilt in order of how stale they are and
+    how much demand there is for their lane.
+
+    This class is designed to be subclassed rather than instantiated
+    directly. Subclasses must implement annotator().
+    """
+    SERVICE_NAME = "Cached Feed Prewarm Monitor"
+    INTERVAL_SECONDS = 300
+
+    # At most this many feeds will be rebuilt each time the monitor
+    # runs. This spreads the cost of rebuilding feeds over time.
+    DEFAULT_MAX_FEEDS = 50
+
+    # At most this many feeds will be rebuilt simultaneously. Each
+    # concurrent worker uses its own database session.
+    DEFAULT_CONCURRENCY = 1
+
+    # A feed becomes a candidate for rebuilding once it has used up
+    # this proportion of its maximum age.
+    STALENESS_THRESHOLD = 0.75
+
+    # Groups feeds are usually cached forever, but they should still
+    # be rebuilt this often so that they pick up new books.
+    GROUPS_FEED_REFRESH_INTERVAL = datetime.timedelta(days=1)
+
+    # Page feeds are only regenerated when a patron asks for them, so
+    # the number of a lane's feeds regenerated within this span of
+    # time is a good estimate of demand for that lane.
+    DEMAND_WINDOW = datetime.timedelta(days=1)
+
+    def __init__(self, _db, library, max_feeds=None, concurrency=None):
+        super(CachedFeedPrewarmMonitor, self).__init__(_db)
+        self.library_id = library.id
+
+        # Each library's monitor keeps track of its own progress.
+        self.service_name = "%s (%s)" % (
+            self.service_name, library.short_name
+        )
+        self.max_feeds = max_feeds or self.DEFAULT_MAX_FEEDS
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+
+    def library(self, _db):
+        return Library.by_id(_db, self.library_id)
+
+    def annotator(self, lane):
+        """Create an Annotator to be used when building a feed for
+        the given lane.
+        """
+        raise NotImplementedError()
+
+    def make_lanes(self, _db):
+        """Create the tree of lanes whose feeds should be kept warm.
+
+        :return: A LaneList.
+        """
+        from lane import make_lanes
+        return make_lanes(_db, self.library(_db))
+
+    def all_lanes(self, _db):
+        """Yield every lane in the lane tree, parents before children."""
+        def walk(lanes):
+            for lane in lanes or []:
+                yield lane
+                for sublane in walk(lane.sublanes):
+                    yield sublane
+        seen = set()
+        for lane in walk(self.make_lanes(_db)):
+            key = self.lane_key(lane)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield lane
+
+    @classmethod
+    def lane_key(cls, lane):
+        return (lane.language_key, lane.name)
+
+    @classmethod
+    def languages_key(cls, lane):
+        """Identify a lane's languages the way CachedFeed does."""
+        if not lane.languages:
+            return None
+        return unicode(",".join(lane.languages))
+
+    def page_feed_keys(self):
+        """The facets and pagination keys of the page feeds this
+        monitor rebuilds.
+        """
+        from lane import (
+            Facets,
+            Pagination,
+        )
+        facets = Facets.default(self.library(self._db))
+        return (unicode(facets.query_string),
+                unicode(Pagination.default().query_string))
+
+    def max_ages(self):
+        """Find the effective maximum age of each type of feed."""
+        from opds import AcquisitionFeed
+        groups_max_age = AcquisitionFeed.grouped_max_age(self._db)
+        if groups_max_age is AcquisitionFeed.CACHE_FOREVER:
+            groups_max_age = self.GROUPS_FEED_REFRESH_INTERVAL
+        page_max_age = AcquisitionFeed.nongrouped_max_age(self._db)
+        max_ages = {}
+        for type, max_age in (
+                (CachedFeed.GROUPS_TYPE, groups_max_age),
+                (CachedFeed.PAGE_TYPE, page_max_age)
+        ):
+            if isinstance(max_age, int):
+                max_age = datetime.timedelta(seconds=max_age)
+            max_ages[type] = max_age
+        return max_ages
+
+    def existing_feeds(self):
+        """Find the timestamps of the feeds this monitor might rebuild.
+
+        :return: A dictionary mapping (lane_name, languages, type)
+        to a timestamp.
+        """
+        page_facets, page_pagination = self.page_feed_keys()
+        is_page_feed = and_(
+            CachedFeed.type==CachedFeed.PAGE_TYPE,
+            CachedFeed.facets==page_facets,
+            CachedFeed.pagination==page_pagination,
+        )
+        # A lane's groups feed may have been filed with any facets and
+        # pagination, if it had to fall back to being a page feed.
+        is_groups_feed = CachedFeed.type==CachedFeed.GROUPS_TYPE
+        qu = self._db.query(
+            CachedFeed.lane_name, CachedFeed.languages, CachedFeed.type,
+            func.max(CachedFeed.timestamp)
+        ).filter(
+            CachedFeed.library_id==self.library_id
+        ).filter(
+            CachedFeed.content!=None
+        ).filter(
+            CachedFeed.work_id==None
+        ).filter(
+            or_(is_page_feed, is_groups_feed)
+        ).group_by(
+            CachedFeed.lane_name, CachedFeed.languages, CachedFeed.type
+        )
+        return dict(
+            ((lane_name, languages, type), timestamp)
+            for lane_name, languages, type, timestamp in qu
+        )
+
+    def demand(self, now):
+        """Estimate recent demand for each lane.
+
+        Feeds rebuilt by this monitor are not counted, since they
+        weren't requested by patrons.
+
+        :return: A Counter mapping (lane_name, languages) to the
+        number of feeds recently generated for that lane.
+        """
+        page_facets, page_pagination = self.page_feed_keys()
+        prewarmed = and_(
+            CachedFeed.type==CachedFeed.PAGE_TYPE,
+            CachedFeed.facets==page_facets,
+            CachedFeed.pagination==page_pagination,
+        )
+        qu = self._db.query(
+            CachedFeed.lane_name, CachedFeed.languages, func.count(CachedFeed.id)
+        ).filter(
+            CachedFeed.library_id==self.library_id
+        ).filter(
+            CachedFeed.type!=CachedFeed.GROUPS_TYPE
+        ).filter(
+            not_(prewarmed)
+        ).filter(
+            CachedFeed.timestamp >= now - self.DEMAND_WINDOW
+        ).group_by(
+            CachedFeed.lane_name, CachedFeed.languages
+        )
+        return Counter(
+            dict(((lane_name, languages), count)
+                 for lane_name, languages, count in qu)
+        )
+
+    def prioritize(self, lanes, now):
+        """Decide which feeds need to be rebuilt, and in what order.
+
+        :return: A list of (lane, feed type) 2-tuples, most urgent
+        first, containing no more than self.max_feeds items.
+        """
+        existing = self.existing_feeds()
+        demand = self.demand(now)
+        max_ages = self.max_ages()
+
+        candidates = []
+        for lane in lanes:
+            languages = self.languages_key(lane)
+            lane_demand = demand[(lane.name, languages)]
+            types = [CachedFeed.PAGE_TYPE]
+            if lane.visible_sublanes:
+                types.insert(0, CachedFeed.GROUPS_TYPE)
+            for type in types:
+                timestamp = existing.get((lane.name, languages, type))
+                if not timestamp:
+                    # A missing feed is the most urgent kind, especially
+                    # a missing groups feed.
+                    missing = 2 if type == CachedFeed.GROUPS_TYPE else 1
+                    staleness = None
+                else:
+                    missing = 0
+                    age = (now - timestamp).total_seconds()
+                    max_age = max_ages[type].total_seconds() or 1
+                    staleness = age / max_age
+                    if staleness < self.STALENESS_THRESHOLD:
+                        continue
+                priority = (missing, (1 + lane_demand) * (staleness or 1))
+                candidates.append((priority, lane, type))
+
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        return [(lane, type) for ignore, lane, type
+                in candidates[:self.max_feeds]]
+
+    def run_once(self, start, cutoff):
+        lanes = list(self.all_lanes(self._db))
+        jobs = self.prioritize(lanes, cutoff)
+        self.log.info(
+            "%d feeds for %d lanes need to be rebuilt.", len(jobs), len(lanes)
+        )
+        if self.concurrency <= 1:
+            for lane, type in jobs:
+                self.rebuild_and_commit(self._db, lane, type)
+        else:
+            self.rebuild_concurrently(jobs)
+
+    def rebuild_concurrently(self, jobs):
+        """Rebuild feeds in a number of worker threads, each with its
+        own database session and its own copy of the lane tree.
+        """
+        queue = Queue()
+        for lane, type in jobs:
+            queue.put((self.lane_key(lane), type))
+        bind = self._db.get_bind()
+
+        def work():
+            _db = Session(bind=bind)
+            try:
+                lanes = dict(
+                    (self.lane_key(lane), lane)
+                    for lane in self.all_lanes(_db)
+                )
+                while True:
+                    try:
+                        lane_key, type = queue.get_nowait()
+                    except Empty:
+                        break
+                    lane = lanes.get(lane_key)
+                    if lane:
+                        self.rebuild_and_commit(_db, lane, type)
+            finally:
+                _db.close()
+
+        workers = [threading.Thread(target=work)
+                   for i in range(min(self.concurrency, len(jobs)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def rebuild_and_commit(self, _db, lane, type):
+        a = time.time()
+        try:
+            self.rebuild(_db, lane, type)
+            _db.commit()
+        except Exception, e:
+            _db.rollback()
+            self.log.error(
+                "Error rebuilding %s feed for %s: %s", type, lane.name, e,
+                exc_info=e
+            )
+            return
+        b = time.time()
+        self.log.info(
+            "Rebuilt %s feed for %s in %.2f sec.", type, lane.name, b-a
+        )
+
+    def rebuild(self, _db, lane, type):
+        """Rebuild a single feed and store it in the cachedfeeds table."""
+        from opds import AcquisitionFeed
+        annotator = self.annotator(lane)
+        if type == CachedFeed.GROUPS_TYPE:
+            url = annotator.groups_url(lane)
+            AcquisitionFeed.groups(
+                _db, lane.display_name, url, lane, annotator,
+                force_refresh=True
+            )
+        else:
+            url = annotator.feed_url(lane)
+            AcquisitionFeed.page(
+                _db, lane.display_name, url, lane, annotator,
+                force_refresh=True
+            )
@@ -557,6 +557,7 @@ class AcquisitionFeed(OPDSFeed):
             works = []
         else:
             works = works_q.all()
+        pagination.page_loaded(works)
         feed = cls(_db, title, url, works, annotator)
 
         # Add URLs to change faceted views of the collection.
@@ -567,7 +568,7 @@ class AcquisitionFeed(OPDSFeed):
             # There are works in this list. Add a 'next' link.
             OPDSFeed.add_link_to_feed(feed=feed.feed, rel="next", href=annotator.feed_url(lane, facets, pagination.next_page))
 
-        if pagination.offset > 0:
+        if not pagination.is_first_page:
             OPDSFeed.add_link_to_feed(feed=feed.feed, rel="first", href=annotator.feed_url(lane, facets, pagination.first_page))
 
         previous_page = pagination.previous_page
@@ -363,14 +363,20 @@ class OverdriveAPI(object):
             for i in page_inventory:
                 yield i
 
-    def metadata_lookup(self, identifier):
+    def metadata_lookup(self, identifier, exception_on_401=False):
         """Look up metadata for an Overdrive identifier.
+
+        :param exception_on_401: Raise an exception if the Bearer Token
+        has expired, rather than refreshing it. Refreshing the token
+        uses the database.
         """
         url = self.METADATA_ENDPOINT % dict(
             collection_token=self.collection_token,
             item_id=identifier.identifier
         )
-        status_code, headers, content = self.get(url, {})
+        status_code, headers, content = self.get(
+            url, {}, exception_on_401=exception_on_401
+        )
         if isinstance(content, basestring):
             content = json.loads(content)
         return content
@@ -1083,6 +1089,14 @@ class OverdriveBibliographicCoverageProvider(BibliographicCoverageProvider):
 
     def process_item(self, identifier):
         info = self.api.metadata_lookup(identifier)
+        return self.process_fetched_item(identifier, info)
+
+    def fetch_item(self, identifier):
+        # If the Bearer Token has expired, the lookup fails and
+        # process_item() refreshes the token on the main thread.
+        return self.api.metadata_lookup(identifier, exception_on_401=True)
+
+    def process_fetched_item(self, identifier, info):
         error = None
         if info.get('errorCode') == 'NotFound':
             error = "ID not recognized by Overdrive: %s" % identifier.identifier
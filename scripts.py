@@ -18,7 +18,12 @@ import traceback
 import unicodedata
 
 from collections import defaultdict
-from external_search import ExternalSearchIndex
+from external_search import (
+    ExternalSearchIndex,
+    ExternalSearchIndexVersions,
+    SearchIndexCoverageProvider,
+    SearchIndexRebuild,
+)
 import json
 from nose.tools import set_trace
 from sqlalchemy import (
@@ -37,6 +42,7 @@ from sqlalchemy.orm.session import Session
 from app_server import ComplaintController
 from axis import Axis360BibliographicCoverageProvider
 from config import Configuration, CannotLoadConfiguration
+from coverage import CoverageScheduler
 from metadata_layer import ReplacementPolicy
 from model import (
     get_one,
@@ -57,6 +63,7 @@ from model import (
     LicensePool,
     LicensePoolDeliveryMechanism,
     Patron,
+    PresentationCalculationInputs,
     PresentationCalculationPolicy,
     SessionManager,
     Subject,
@@ -69,6 +76,7 @@ from model import (
 from monitor import (
     SubjectAssignmentMonitor,
     CollectionMonitor,
+    SweepMonitor,
 )
 from opds_import import (
     OPDSImportMonitor,
@@ -92,10 +100,16 @@ from bibliotheca import (
 
 class Script(object):
 
+    # Scripts that keep running for a long time should keep their
+    # full-table caches in sync with changes made by other processes.
+    LISTEN_FOR_CHANGES = False
+
     @property
     def _db(self):
         if not hasattr(self, "_session"):
-            self._session = production_session()
+            self._session = production_session(
+                listen_for_changes=self.LISTEN_FOR_CHANGES
+            )
         return self._session
 
     @property
@@ -163,6 +177,32 @@ class Script(object):
 
 class RunMonitorScript(Script):
 
+    LISTEN_FOR_CHANGES = True
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--shards',
+            help='Sweep the table in this many processes at once. Only works for sweep monitors.',
+            type=int, default=None
+        )
+        return parser
+
+    @classmethod
+    def run_monitor(cls, monitor, shards=None):
+        """Run a Monitor, in shards if that was asked for and the
+        Monitor supports it.
+        """
+        if shards:
+            if isinstance(monitor, SweepMonitor):
+                return monitor.run_sharded(shards)
+            logging.warn(
+                "%s is not a sweep monitor and can't be run in shards. Running it normally.",
+                monitor.service_name
+            )
+        return monitor.run()
+
     def __init__(self, monitor, _db=None, **kwargs):
         super(RunMonitorScript, self).__init__(_db)
         if issubclass(monitor, CollectionMonitor):
@@ -176,9 +216,10 @@ class RunMonitorScript(Script):
             self.monitor = monitor
             self.name = self.monitor.service_name
             
-    def do_run(self):
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
         if self.monitor:
-            self.monitor.run()
+            self.run_monitor(self.monitor, parsed.shards)
         elif self.collection_monitor:
             logging.warn(
                 "Running a CollectionMonitor by delegating to RunCollectionMonitorScript. "
@@ -186,20 +227,26 @@ class RunMonitorScript(Script):
             )
             RunCollectionMonitorScript(
                 self.collection_monitor, self._db, **self.collection_monitor_kwargs
-            ).run()
+            ).do_run(cmd_args=cmd_args)
 
 
 class RunCollectionMonitorScript(Script):
     """Run a CollectionMonitor on every Collection that comes through a
     certain protocol.
 
-    Currently the Monitors are run one at a time. It should be
-    possible to take a command-line argument that runs all the
-    Monitors in batches, each in its own thread. Unfortunately, it's
-    tough to know in a given situation that the system configuration
-    and the Collection protocol are tough enough to handle this, and
-    won't be overloaded.
+    The Monitors are run one at a time. A sweep monitor can split its
+    own work across several processes with the --shards option, but
+    it's tough to know in a given situation that the system
+    configuration and the Collection protocol are tough enough to
+    handle this, and won't be overloaded, so it's off by default.
     """
+
+    LISTEN_FOR_CHANGES = True
+
+    @classmethod
+    def arg_parser(cls):
+        return RunMonitorScript.arg_parser()
+
     def __init__(self, monitor_class, _db=None, **kwargs):
         """Constructor.
         
@@ -213,13 +260,14 @@ class RunCollectionMonitorScript(Script):
         self.name = self.monitor_class.SERVICE_NAME
         self.kwargs = kwargs
         
-    def do_run(self):
+    def do_run(self, cmd_args=None):
         """Instantiate a Monitor for every appropriate Collection,
         and run them, in order.
         """
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
         for monitor in self.monitor_class.all(self._db, **self.kwargs):
             try:
-                monitor.run()
+                RunMonitorScript.run_monitor(monitor, parsed.shards)
             except Exception, e:
                 # This is bad, but not so bad that we should give up trying
                 # to run the other Monitors.
@@ -232,6 +280,9 @@ class RunCollectionMonitorScript(Script):
 
 class RunCoverageProvidersScript(Script):
     """Alternate between multiple coverage providers."""
+
+    LISTEN_FOR_CHANGES = True
+
     def __init__(self, providers):
         self.providers = []
         for i in providers:
@@ -258,6 +309,21 @@ class RunCoverageProvidersScript(Script):
                 providers.remove(provider)
 
 
+class RunCoverageJobsScript(RunCoverageProvidersScript):
+    """Cover Identifiers through the shared queue of CoverageJobs,
+    rather than running each provider to completion in turn.
+
+    Since jobs are handed out one batch at a time, this script can run
+    in any number of processes, on any number of machines, at once.
+    Newly licensed books and books patrons are waiting for are covered
+    first.
+    """
+    def do_run(self):
+        scheduler = CoverageScheduler(self._db, self.providers)
+        scheduler.enqueue_items_that_need_coverage()
+        scheduler.run()
+
+
 class RunCollectionCoverageProviderScript(RunCoverageProvidersScript):
     """Run the same CoverageProvider code for all Collections that
     get their licenses from the appropriate place.
@@ -274,6 +340,206 @@ class RunCollectionCoverageProviderScript(RunCoverageProvidersScript):
         return list(provider_class.all(_db, **kwargs))
 
 
+class UpdateSearchIndexScript(RunCoverageProvidersScript):
+    """Update the search documents of every work that has been queued
+    for it, in batches.
+    """
+
+    name = "Update search index"
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--batch-size',
+            help='The number of works to send to the search index at once.',
+            type=int, default=SearchIndexCoverageProvider.DEFAULT_BATCH_SIZE
+        )
+        return parser
+
+    def __init__(self, _db=None, cmd_args=None, search_index_client=None):
+        Script.__init__(self, _db)
+        args = self.parse_command_line(self._db, cmd_args)
+        provider = SearchIndexCoverageProvider(
+            self._db, batch_size=args.batch_size,
+            search_index_client=search_index_client
+        )
+        super(UpdateSearchIndexScript, self).__init__([provider])
+
+
+class RebuildSearchIndexScript(Script):
+    """Create a new search index, upload a document for every
+    presentation-ready work, and move the -current alias to it.
+
+    If the rebuild is interrupted, running this script again picks up
+    where it left off.
+    """
+
+    name = "Rebuild search index"
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--version',
+            help='The version of the index to build. Defaults to the latest version.',
+            default=None
+        )
+        parser.add_argument(
+            '--batch-size',
+            help='The number of documents to upload at once.',
+            type=int, default=SearchIndexRebuild.DEFAULT_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--workers',
+            help='The number of threads uploading documents.',
+            type=int, default=SearchIndexRebuild.DEFAULT_WORKERS
+        )
+        parser.add_argument(
+            '--force',
+            help='Move the alias even if some documents could not be uploaded.',
+            action='store_true'
+        )
+        return parser
+
+    def __init__(self, _db=None, search=None):
+        super(RebuildSearchIndexScript, self).__init__(_db)
+        self.search = search or ExternalSearchIndex(self._db)
+
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        version = parsed.version or ExternalSearchIndexVersions.latest()
+        if not version.startswith('v'):
+            version = 'v%s' % version
+        base_index_name = self.search.base_index_name(self.search.works_index)
+        new_index = base_index_name + '-' + version
+        if ExternalSearchIndexVersions.create_new_version(
+                self.search, base_index_name, version):
+            self.log.info("Created index %s.", new_index)
+        rebuild = SearchIndexRebuild(
+            self._db, self.search, new_index,
+            batch_size=parsed.batch_size, workers=parsed.workers
+        )
+        rebuild.run(force=parsed.force)
+
+
+class MigrateSearchIndexScript(Script):
+    """Move the search index to a new version without downtime.
+
+    While the new index is being filled, every document written to
+    the current index is written to the new one as well. Once every
+    work has been uploaded, works that changed since the migration
+    started are uploaded again, in case the backfill overwrote them
+    with older documents. Once the two indexes agree, the -current
+    alias is moved to the new index.
+    """
+
+    name = "Migrate search index"
+
+    @classmethod
+    def migration_service_name(cls, new_index):
+        """The name of the Timestamp that records when the migration
+        to `new_index` started.
+        """
+        return "%s: %s" % (cls.name, new_index)
+
+    @classmethod
+    def arg_parser(cls):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--version',
+            help='The version of the index to migrate to. Defaults to the latest version.',
+            default=None
+        )
+        parser.add_argument(
+            '--batch-size',
+            help='The number of documents to upload at once.',
+            type=int, default=SearchIndexRebuild.DEFAULT_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--workers',
+            help='The number of threads uploading documents.',
+            type=int, default=SearchIndexRebuild.DEFAULT_WORKERS
+        )
+        parser.add_argument(
+            '--sample-size',
+            help='The number of documents to compare between the old and new indexes.',
+            type=int, default=100
+        )
+        parser.add_argument(
+            '--force',
+            help='Move the alias even if the old and new indexes disagree, or some documents could not be uploaded.',
+            action='store_true'
+        )
+        return parser
+
+    def __init__(self, _db=None, search=None):
+        super(MigrateSearchIndexScript, self).__init__(_db)
+        self.search = search or ExternalSearchIndex(self._db)
+
+    def do_run(self, cmd_args=None):
+        parsed = self.parse_command_line(self._db, cmd_args=cmd_args)
+        version = parsed.version or ExternalSearchIndexVersions.latest()
+        if not version.startswith('v'):
+            version = 'v%s' % version
+        base_index_name = self.search.base_index_name(self.search.works_index)
+        new_index = base_index_name + '-' + version
+        if new_index == self.search.works_index:
+            self.log.info("%s is already the current index.", new_index)
+            return
+
+        if self.search.migration_index != new_index:
+            self.log.info("Writing documents to %s as well as %s.",
+                          new_index, self.search.works_index)
+            Timestamp.stamp(
+                self._db, self.migration_service_name(new_index), None
+            )
+            self.search.start_migration(new_index)
+            self._db.commit()
+        started = get_one(
+            self._db, Timestamp,
+            service=self.migration_service_name(new_index), collection=None
+        )
+        since = None
+        if started:
+            since = started.timestamp
+        else:
+            self.log.warn(
+                "Don't know when the migration to %s started; every work that has been queued for the search index will be uploaded again.",
+                new_index
+            )
+
+        rebuild = SearchIndexRebuild(
+            self._db, self.search, new_index,
+            batch_size=parsed.batch_size, workers=parsed.workers
+        )
+        rebuild.run(transfer_alias=False)
+        refreshed = rebuild.refresh_changed_works(since)
+        self.log.info(
+            "Uploaded %d works to %s again, since they changed during the migration.",
+            refreshed, new_index
+        )
+        failed = rebuild.dead_letters().count()
+
+        problems = self.search.check_migration(parsed.sample_size)
+        if failed:
+            problems.append(
+                "%d works could not be uploaded to %s." % (failed, new_index)
+            )
+        for problem in problems:
+            self.log.warn(problem)
+        if problems and not parsed.force:
+            self.log.error(
+                "Not moving the alias to %s. Documents are still being written to both indexes.",
+                new_index
+            )
+            return
+
+        self.search.finish_migration()
+        self._db.commit()
+        self.log.info("%s is now the current index.", new_index)
+
+
 class InputScript(Script):
     @classmethod
     def read_stdin_lines(self, stdin):
@@ -581,6 +847,8 @@ class SubjectInputScript(Script):
 class RunCoverageProviderScript(IdentifierInputScript):
     """Run a single coverage provider."""
 
+    LISTEN_FOR_CHANGES = True
+
     @classmethod
     def arg_parser(cls):
         parser = IdentifierInputScript.arg_parser()
@@ -1355,12 +1623,15 @@ class WorkProcessingScript(IdentifierInputScript):
         offset = 0
         while works:
             works = self.query.offset(offset).limit(self.batch_size).all()
-            for work in works:
-                self.process_work(work)
+            self.process_batch(works)
             offset += self.batch_size
             self._db.commit()
         self._db.commit()
 
+    def process_batch(self, works):
+        for work in works:
+            self.process_work(work)
+
     def process_work(self, work):
         raise NotImplementedError()      
 
@@ -1413,8 +1684,15 @@ class WorkPresentationScript(WorkProcessingScript):
     # Do a complete recalculation of the presentation.
     policy = PresentationCalculationPolicy()
 
-    def process_work(self, work):
-        work.calculate_presentation(policy=self.policy)
+    def process_batch(self, works):
+        # Load the data that goes into each Work's presentation for
+        # the whole batch at once, rather than one Work at a time.
+        inputs = PresentationCalculationInputs(self._db, works, self.policy)
+        for work in works:
+            self.process_work(work, inputs)
+
+    def process_work(self, work, inputs=None):
+        work.calculate_presentation(policy=self.policy, inputs=inputs)
 
 
 class WorkClassificationScript(WorkPresentationScript):
@@ -1552,26 +1830,48 @@ class RefreshMaterializedViewsScript(Script):
             help="Provide this argument if you're on an older version of Postgres and can't refresh materialized views concurrently.",
             action='store_true',
         )
+        parser.add_argument(
+            '--incremental',
+            help="Replace the materialized views with tables that are updated incrementally, based on which works have changed since the last run. Once a view has been converted, it is always updated incrementally.",
+            action='store_true',
+        )
         return parser
 
     def do_run(self):
         args = self.parse_command_line()
-        if args.blocking_refresh:
-            concurrently = ''
-        else:
-            concurrently = 'CONCURRENTLY'
         # Initialize database
         from model import (
             MaterializedWork,
             MaterializedWorkWithGenre,
         )
         db = self._db
-        for i in (MaterializedWork, MaterializedWorkWithGenre):
-            view_name = i.__table__.name
-            a = time.time()
-            db.execute("REFRESH MATERIALIZED VIEW %s %s" % (concurrently, view_name))
-            b = time.time()
-            print "%s refreshed in %.2f sec." % (view_name, b-a)
+        view_names = [
+            i.__table__.name for i in (MaterializedWork, MaterializedWorkWithGenre)
+        ]
+        if args.incremental:
+            for view_name in view_names:
+                a = time.time()
+                SessionManager.convert_to_incremental(db, view_name)
+                b = time.time()
+                print "%s converted in %.2f sec." % (view_name, b-a)
+        incremental = all(
+            SessionManager.is_incremental(db, view_name)
+            for view_name in view_names
+        )
+
+        a = time.time()
+        changed = SessionManager.refresh_materialized_views(
+            db, concurrently=not args.blocking_refresh
+        )
+        b = time.time()
+        print "%s refreshed in %.2f sec (%d works changed)." % (
+            ", ".join(view_names), b-a, changed
+        )
+
+        if incremental:
+            # Only the changed rows were touched, so there's no need
+            # for a database-wide VACUUM.
+            return
 
         # Close out this session because we're about to create another one.
         db.commit()
@@ -14,6 +14,7 @@ from config import Configuration
 
 from model import (
     Base,
+    CachedFeed,
     Classification,
     IntegrationClient,
     Collection,
@@ -54,7 +55,10 @@ from coverage import (
     WorkCoverageProvider,
 )
 
-from external_search import DummyExternalSearchIndex
+from external_search import (
+    DummyExternalSearchIndex,
+    ExternalSearchIndex,
+)
 import external_search
 import mock
 import inspect
@@ -165,6 +169,7 @@ class DatabaseTest(object):
 
         # Remove any database objects cached in the model classes but
         # associated with the now-rolled-back session.
+        CachedFeed.reset_cache()
         Collection.reset_cache()
         ConfigurationSetting.reset_cache()
         DataSource.reset_cache()
@@ -172,12 +177,16 @@ class DatabaseTest(object):
         ExternalIntegration.reset_cache()
         Genre.reset_cache()
         Library.reset_cache()
-        
+
+        # Search results point to works that no longer exist.
+        ExternalSearchIndex.reset_search_result_cache()
+
         # Also roll back any record of those changes in the
         # Configuration instance.
         for key in [
                 Configuration.SITE_CONFIGURATION_LAST_UPDATE,
-                Configuration.LAST_CHECKED_FOR_SITE_CONFIGURATION_UPDATE
+                Configuration.LAST_CHECKED_FOR_SITE_CONFIGURATION_UPDATE,
+                Configuration.SITE_CONFIGURATION_WATCHED,
         ]:
             if key in Configuration.instance:
                 del(Configuration.instance[key])
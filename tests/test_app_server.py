@@ -18,7 +18,10 @@ from . import (
 
 from opds import TestAnnotator
 
-from model import Identifier
+from model import (
+    CachedFeed,
+    Identifier,
+)
 
 from lane import (
     Facets,
@@ -29,6 +32,7 @@ from app_server import (
     URNLookupController,
     ErrorHandler,
     ComplaintController,
+    feed_response,
     load_facets_from_request,
     load_pagination_from_request,
 )
@@ -266,6 +270,48 @@ class TestLoadMethods(DatabaseTest):
             eq_(0, pagination.offset)
 
 
+class TestFeedResponse(DatabaseTest):
+
+    def setup(self):
+        super(TestFeedResponse, self).setup()
+        self.app = Flask(__name__)
+        self.feed = CachedFeed(
+            type=CachedFeed.PAGE_TYPE, pagination=u"", content=u"<feed/>"
+        )
+
+    def test_cached_feed_response(self):
+        with self.app.test_request_context('/'):
+            response = feed_response(self.feed)
+            eq_(200, response.status_code)
+            eq_("<feed/>", response.data)
+            eq_('"%s"' % self.feed.etag, response.headers['ETag'])
+            eq_(None, response.headers.get('Content-Encoding'))
+
+    def test_cached_feed_response_gzip(self):
+        with self.app.test_request_context(
+                '/', headers={"Accept-Encoding": "gzip, deflate"}
+        ):
+            response = feed_response(self.feed)
+            eq_(200, response.status_code)
+            eq_("gzip", response.headers['Content-Encoding'])
+            eq_("<feed/>", CachedFeed.decompress(response.data))
+
+    def test_cached_feed_response_not_modified(self):
+        etag = '"%s"' % self.feed.etag
+        with self.app.test_request_context(
+                '/', headers={"If-None-Match": etag}
+        ):
+            response = feed_response(self.feed)
+            eq_(304, response.status_code)
+            eq_("", response.data)
+
+        with self.app.test_request_context(
+                '/', headers={"If-None-Match": '"some other etag"'}
+        ):
+            response = feed_response(self.feed)
+            eq_(200, response.status_code)
+
+
 class TestErrorHandler(object):
 
     def setup(self):
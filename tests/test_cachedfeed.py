@@ -1,3 +1,4 @@
+import datetime
 from nose.tools import (
     assert_raises,
     assert_raises_regexp,
@@ -13,6 +14,7 @@ from config import (
 from model import (
     get_one_or_create,
     CachedFeed,
+    ConfigurationSetting,
     WillNotGenerateExpensiveFeed,
 )
 
@@ -123,3 +125,206 @@ class TestCachedFeed(DatabaseTest):
             *args, max_age=AcquisitionFeed.CACHE_FOREVER
         )
         eq_("Cache this forever!", feed.content)
+
+    def test_fresh_feed_served_from_memory_cache(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = Lane(self._db, self._default_library, u"My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        feed.update(self._db, u"The content")
+        cache = CachedFeed.memory_cache()
+        eq_(0, len(cache))
+
+        # The first time a fresh feed is fetched, it goes into the
+        # in-memory cache.
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(True, fresh)
+        eq_(1, len(cache))
+
+        # Subsequent fetches are served from memory, even in a
+        # session that has never seen the feed.
+        self._db.expunge(feed)
+        feed2, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(True, fresh)
+        eq_(feed.id, feed2.id)
+        eq_(u"The content", feed2.content)
+        eq_(1, cache.hits)
+
+        # A snapshot that has gone stale is ignored and thrown out.
+        feed2, fresh = CachedFeed.fetch(*args, max_age=0)
+        eq_(False, fresh)
+        eq_(0, len(cache))
+
+        # Updating a feed removes any copy of it from memory.
+        CachedFeed.fetch(*args, max_age=1000)
+        eq_(1, len(cache))
+        feed2.update(self._db, u"New content")
+        eq_(0, len(cache))
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(u"New content", feed.content)
+
+    def test_memory_cache_expires_feeds_cached_forever(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = Lane(self._db, self._default_library, u"My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.GROUPS_TYPE, facets, pagination, None)
+        forever = AcquisitionFeed.CACHE_FOREVER
+
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+        feed.update(self._db, u"The content")
+        feed, fresh = CachedFeed.fetch(*args, max_age=forever)
+        cache = CachedFeed.memory_cache()
+        eq_(1, len(cache))
+
+        # Another process regenerates the feed. That doesn't touch
+        # the copy in this process's memory.
+        self._db.execute(
+            "update cachedfeeds set content='New content' where id=%d" % feed.id
+        )
+        self._db.expire(feed)
+        feed2, fresh = CachedFeed.fetch(*args, max_age=forever)
+        eq_(u"The content", feed2.content)
+
+        # But the copy in memory only lasts so long.
+        now = cache._now()
+        cache._now = lambda: now + CachedFeed.MEMORY_CACHE_TTL + 1
+        self._db.expire_all()
+        feed2, fresh = CachedFeed.fetch(*args, max_age=forever)
+        eq_(True, fresh)
+        eq_(u"New content", feed2.content)
+        eq_(1, cache.expirations)
+
+    def test_force_refresh_bypasses_memory_cache(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = Lane(self._db, self._default_library, u"My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        feed.update(self._db, u"The content")
+        CachedFeed.fetch(*args, max_age=1000)
+        eq_(1, len(CachedFeed.memory_cache()))
+
+        feed, fresh = CachedFeed.fetch(
+            *args, max_age=1000, force_refresh=True
+        )
+        eq_(False, fresh)
+        eq_(0, CachedFeed.memory_cache().hits)
+
+    def test_stale_feed_served_while_another_client_regenerates_it(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = Lane(self._db, self._default_library, u"My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+        feed.update(self._db, u"The content")
+        feed.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=60
+        )
+
+        # Some other client starts regenerating the feed. It takes the
+        # lock on a connection of its own; our session mustn't take
+        # the lock first, since it will hold it until the test ends.
+        other = self.engine.connect()
+        transaction = other.begin()
+        other.execute(
+            "select pg_advisory_xact_lock(%d, %d)" % (
+                CachedFeed.REGENERATION_LOCK_NAMESPACE, feed.id
+            )
+        )
+        try:
+            # The feed has expired, but it's within the grace period,
+            # so we're given the stale content instead of being told
+            # to regenerate the feed.
+            feed2, fresh = CachedFeed.fetch(*args, max_age=30)
+            eq_(True, fresh)
+            eq_(u"The content", feed2.content)
+
+            # But once the grace period is over, we must regenerate
+            # the feed no matter what.
+            grace = ConfigurationSetting.sitewide(
+                self._db, Configuration.NONGROUPED_STALE_GRACE_POLICY
+            )
+            grace.value = 10
+            feed2, fresh = CachedFeed.fetch(*args, max_age=30)
+            eq_(False, fresh)
+        finally:
+            transaction.rollback()
+            other.close()
+
+        # Once nobody else is regenerating the feed, it's our job to
+        # regenerate it, even within the grace period.
+        grace.value = None
+        feed2, fresh = CachedFeed.fetch(*args, max_age=30)
+        eq_(False, fresh)
+
+        # Having taken the lock, we hold it until our transaction ends.
+        other = self.engine.connect()
+        try:
+            [[acquired]] = other.execute(
+                "select pg_try_advisory_lock(%d, %d)" % (
+                    CachedFeed.REGENERATION_LOCK_NAMESPACE, feed.id
+                )
+            )
+            eq_(False, acquired)
+        finally:
+            other.close()
+
+    def test_stale_grace(self):
+        eq_(datetime.timedelta(seconds=CachedFeed.DEFAULT_STALE_GRACE),
+            CachedFeed.stale_grace(self._db, CachedFeed.PAGE_TYPE))
+
+        ConfigurationSetting.sitewide(
+            self._db, Configuration.GROUPED_STALE_GRACE_POLICY
+        ).value = 1000
+        eq_(datetime.timedelta(seconds=1000),
+            CachedFeed.stale_grace(self._db, CachedFeed.GROUPS_TYPE))
+        eq_(datetime.timedelta(seconds=CachedFeed.DEFAULT_STALE_GRACE),
+            CachedFeed.stale_grace(self._db, CachedFeed.PAGE_TYPE))
+
+    def test_compressed_storage(self):
+        facets = Facets.default(self._default_library)
+        pagination = Pagination.default()
+        lane = Lane(self._db, self._default_library, u"My Lane", languages=['eng', 'chi'])
+        args = (self._db, lane, CachedFeed.PAGE_TYPE, facets, pagination, None)
+        feed, fresh = CachedFeed.fetch(*args, max_age=0)
+
+        # By default, content is only stored as gzip.
+        content = u"Caf\u00e9 content"
+        feed.update(self._db, content)
+        eq_(None, feed._content)
+        eq_(content.encode("utf8"),
+            CachedFeed.decompress(feed.compressed_content))
+        eq_(content, feed.content)
+        eq_(feed.compressed_content, feed.gzipped_content())
+        eq_(len(content.encode("utf8")), feed.content_length)
+        assert feed.etag is not None
+
+        # The site can choose to store the text as well.
+        with temp_config() as config:
+            config[Configuration.CACHED_FEED_STORAGE] = CachedFeed.STORE_BOTH
+            feed.update(self._db, content)
+        eq_(content, feed._content)
+        eq_(content, feed.content)
+        eq_(feed.compressed_content, feed.gzipped_content())
+
+        # A compressed-only feed still counts as having content.
+        feed, fresh = CachedFeed.fetch(*args, max_age=1000)
+        eq_(True, fresh)
+        eq_(content, feed.content)
+
+        # Or it can store only the text.
+        with temp_config() as config:
+            config[Configuration.CACHED_FEED_STORAGE] = CachedFeed.STORE_TEXT
+            feed.update(self._db, content)
+        eq_(None, feed.compressed_content)
+        eq_(content.encode("utf8"),
+            CachedFeed.decompress(feed.gzipped_content()))
+
+        # Different content has a different ETag.
+        old_etag = feed.etag
+        feed.update(self._db, u"Other content")
+        assert feed.etag != old_etag
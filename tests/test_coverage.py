@@ -1,4 +1,5 @@
 import datetime
+import threading
 from nose.tools import (
     assert_raises,
     assert_raises_regexp,
@@ -25,6 +26,7 @@ from model import (
     Collection,
     CollectionMissing,
     Contributor,
+    CoverageJob,
     CoverageRecord,
     DataSource,
     DeliveryMechanism,
@@ -57,6 +59,7 @@ from coverage import (
     CatalogCoverageProvider,
     CollectionCoverageProvider,
     CoverageFailure,
+    CoverageScheduler,
     IdentifierCoverageProvider,
 )
 
@@ -302,6 +305,65 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         # successfully covered.
         assert covered in provider.attempts
 
+    def test_run_once_walks_items_in_id_order(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+        provider = AlwaysSuccessfulCoverageProvider(self._db, batch_size=2)
+
+        # run_once() covers one batch of items and returns the ID of
+        # the last one.
+        eq_(i2.id, provider.run_once(0))
+        eq_([i1, i2], provider.attempts)
+
+        # Pass that ID back in to get the next batch.
+        eq_(i3.id, provider.run_once(i2.id))
+        eq_([i1, i2, i3], provider.attempts)
+
+        # When there's nothing left, run_once() returns None.
+        eq_(None, provider.run_once(i3.id))
+
+    def test_run_once_and_update_timestamp_resumes(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        provider = AlwaysSuccessfulCoverageProvider(self._db, batch_size=1)
+
+        # A previous run crashed after covering everything up to i1.
+        timestamp = provider.timestamp()
+        timestamp.counter = i1.id
+
+        # This run picks up where that one left off. i1 doesn't even
+        # get looked at, though it has no coverage record.
+        provider.run_once_and_update_timestamp()
+        eq_([i2], provider.attempts)
+
+        # Once the run completes, the counter is reset so the next run
+        # will start from the beginning.
+        eq_(0, timestamp.counter)
+        provider.run_once_and_update_timestamp()
+        eq_([i2, i1], provider.attempts)
+
+    def test_run_once_and_update_timestamp_with_input_identifiers(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+
+        # A run over everything crashed after covering i1.
+        provider = AlwaysSuccessfulCoverageProvider(self._db, batch_size=1)
+        timestamp = provider.timestamp()
+        timestamp.counter = i1.id
+
+        # A run limited to certain identifiers covers them, even if
+        # the counter has moved past them...
+        provider = AlwaysSuccessfulCoverageProvider(
+            self._db, batch_size=1, input_identifiers=[i1]
+        )
+        provider.run_once_and_update_timestamp()
+        eq_([i1], provider.attempts)
+
+        # ...and leaves the counter alone, so the next full run still
+        # picks up where the crashed one left off.
+        eq_(i1.id, timestamp.counter)
+
     def test_process_batch_and_handle_results(self):
         """Test that process_batch_and_handle_results passes the identifiers
         its given into the appropriate BaseCoverageProvider, and deals
@@ -419,6 +481,55 @@ class TestBaseCoverageProvider(CoverageProviderTest):
         record.timestamp = cutoff
         eq_(False, provider.should_update(record))
 
+    def test_process_batch_fetches_items_concurrently(self):
+        class Fetching(AlwaysSuccessfulCoverageProvider):
+            def __init__(self, *args, **kwargs):
+                super(Fetching, self).__init__(*args, **kwargs)
+                self.fetch_threads = set()
+                self.process_threads = set()
+                self.fetched = []
+
+            def fetch_item(self, item):
+                self.fetch_threads.add(threading.current_thread())
+                if item.identifier == u'broken':
+                    raise Exception("Network trouble!")
+                return item.identifier.upper()
+
+            def process_fetched_item(self, item, fetched):
+                self.process_threads.add(threading.current_thread())
+                self.fetched.append(fetched)
+                return item
+
+        i1 = self._identifier(foreign_id=u'first')
+        i2 = self._identifier(foreign_id=u'second')
+        broken = self._identifier(foreign_id=u'broken')
+        batch = [i1, i2, broken]
+
+        # By default, items are processed one at a time on this thread.
+        provider = Fetching(self._db)
+        eq_(1, provider.concurrency)
+        eq_(batch, provider.process_batch(batch))
+        eq_(batch, provider.attempts)
+        eq_(set(), provider.fetch_threads)
+
+        # With more concurrency, the items are fetched in worker
+        # threads and processed on this one, in order.
+        provider = Fetching(self._db, concurrency=3)
+        eq_(batch, provider.process_batch(batch))
+        assert threading.current_thread() not in provider.fetch_threads
+        eq_(set([threading.current_thread()]), provider.process_threads)
+        eq_([u'FIRST', u'SECOND'], provider.fetched)
+
+        # The item that couldn't be fetched was given to process_item.
+        eq_([broken], provider.attempts)
+
+        # A provider that doesn't implement fetch_item() ignores
+        # the concurrency setting.
+        provider = AlwaysSuccessfulCoverageProvider(self._db, concurrency=3)
+        eq_(False, provider.fetches_items)
+        eq_({}, provider.fetch_batch(batch))
+        eq_(batch, provider.process_batch(batch))
+
     
 
 class TestIdentifierCoverageProvider(CoverageProviderTest):
@@ -855,6 +966,23 @@ class TestCollectionCoverageProvider(CoverageProviderTest):
         provider = AlwaysSuccessfulCollectionCoverageProvider(collection)
         eq_(provider.DATA_SOURCE_NAME, provider.data_source.name)
 
+    def test_concurrency_from_integration(self):
+        collection = self._collection(protocol=ExternalIntegration.OPDS_IMPORT)
+        provider = AlwaysSuccessfulCollectionCoverageProvider(collection)
+        eq_(1, provider.concurrency)
+
+        collection.external_integration.setting(
+            ExternalIntegration.COVERAGE_CONCURRENCY
+        ).value = u"5"
+        provider = AlwaysSuccessfulCollectionCoverageProvider(collection)
+        eq_(5, provider.concurrency)
+
+        # A value passed into the constructor takes precedence.
+        provider = AlwaysSuccessfulCollectionCoverageProvider(
+            collection, concurrency=2
+        )
+        eq_(2, provider.concurrency)
+
     def test_must_have_collection(self):
         assert_raises_regexp(
             CollectionMissing,
@@ -1447,3 +1575,56 @@ class TestWorkCoverageProvider(DatabaseTest):
         """TODO: We have coverage of code that calls this method,
         but not the method itself.
         """
+
+
+class TestCoverageScheduler(DatabaseTest):
+
+    def test_only_identifier_coverage_providers(self):
+        assert_raises(
+            ValueError, CoverageScheduler, self._db,
+            [AlwaysSuccessfulWorkCoverageProvider(self._db)]
+        )
+
+    def test_enqueue_items_that_need_coverage(self):
+        provider = AlwaysSuccessfulCoverageProvider(self._db)
+        covered = self._identifier()
+        self._coverage_record(covered, provider.data_source)
+        uncovered = self._identifier()
+
+        scheduler = CoverageScheduler(self._db, [provider])
+        scheduler.enqueue_items_that_need_coverage()
+
+        [job] = self._db.query(CoverageJob).all()
+        eq_(uncovered, job.identifier)
+        eq_(provider.service_name, job.service)
+        eq_(None, job.collection_id)
+
+    def test_run_once(self):
+        class FailingProvider(TransientFailureCoverageProvider):
+            OPERATION = "fail"
+        success = AlwaysSuccessfulCoverageProvider(self._db)
+        failure = FailingProvider(self._db)
+        i1 = self._identifier()
+        i2 = self._identifier()
+        CoverageScheduler.enqueue(success, [i1, i2])
+        CoverageScheduler.enqueue(failure, [i1])
+
+        # An Identifier that got covered some other way since its job
+        # was created won't be covered again.
+        self._coverage_record(i2, success.data_source)
+
+        scheduler = CoverageScheduler(self._db, [success, failure])
+        eq_(3, scheduler.run_once())
+        eq_([i1], success.attempts)
+        eq_([i1], failure.attempts)
+
+        # The job that ended in transient failure will be retried
+        # later. The others are done.
+        [job] = self._db.query(CoverageJob).all()
+        eq_(failure.service_name, job.service)
+        eq_(1, job.attempts)
+        assert job.available_at > datetime.datetime.utcnow()
+
+        # Until then, there's nothing to do.
+        eq_(0, scheduler.run_once())
+
@@ -3,6 +3,7 @@ from nose.tools import (
     eq_,
     set_trace,
 )
+import datetime
 import logging
 import time
 from psycopg2.extras import NumericRange
@@ -13,13 +14,20 @@ from . import (
 
 from lane import Lane
 from model import (
+    get_one,
     Edition,
     ExternalIntegration,
+    Timestamp,
+    WorkCoverageRecord,
 )
 from external_search import (
     ExternalSearchIndex,
     ExternalSearchIndexVersions,
     DummyExternalSearchIndex,
+    PostgresSearchIndex,
+    SearchIndexCoverageProvider,
+    SearchIndexRebuild,
+    SearchTimings,
 )
 from classifier import Classifier
 
@@ -179,107 +187,107 @@ class TestExternalSearchWithWorks(ExternalSearchTest):
             self.moby_dick.presentation_edition.series = "Classics"
             self.moby_dick.summary_text = "Ishmael"
             self.moby_dick.presentation_edition.publisher = "Project Gutenberg"
-            self.moby_dick.set_presentation_ready()
+            self.moby_dick.set_presentation_ready(search_index_client=self.search)
 
             self.moby_duck = self._work(title="Moby Duck", authors="Donovan Hohn", fiction=False)
             self.moby_duck.presentation_edition.subtitle = "The True Story of 28,800 Bath Toys Lost at Sea"
             self.moby_duck.summary_text = "A compulsively readable narrative"
             self.moby_duck.presentation_edition.publisher = "Penguin"
-            self.moby_duck.set_presentation_ready()
+            self.moby_duck.set_presentation_ready(search_index_client=self.search)
 
             self.title_match = self._work(title="Match")
-            self.title_match.set_presentation_ready()
+            self.title_match.set_presentation_ready(search_index_client=self.search)
 
             self.subtitle_match = self._work()
             self.subtitle_match.presentation_edition.subtitle = "Match"
-            self.subtitle_match.set_presentation_ready()
+            self.subtitle_match.set_presentation_ready(search_index_client=self.search)
 
             self.summary_match = self._work()
             self.summary_match.summary_text = "Match"
-            self.summary_match.set_presentation_ready()
+            self.summary_match.set_presentation_ready(search_index_client=self.search)
         
             self.publisher_match = self._work()
             self.publisher_match.presentation_edition.publisher = "Match"
-            self.publisher_match.set_presentation_ready()
+            self.publisher_match.set_presentation_ready(search_index_client=self.search)
 
             self.tess = self._work(title="Tess of the d'Urbervilles")
-            self.tess.set_presentation_ready()
+            self.tess.set_presentation_ready(search_index_client=self.search)
 
             self.tiffany = self._work(title="Breakfast at Tiffany's")
-            self.tiffany.set_presentation_ready()
+            self.tiffany.set_presentation_ready(search_index_client=self.search)
             
             self.les_mis = self._work()
             self.les_mis.presentation_edition.title = u"Les Mis\u00E9rables"
-            self.les_mis.set_presentation_ready()
+            self.les_mis.set_presentation_ready(search_index_client=self.search)
 
             self.lincoln = self._work(genre="Biography & Memoir", title="Abraham Lincoln")
-            self.lincoln.set_presentation_ready()
+            self.lincoln.set_presentation_ready(search_index_client=self.search)
 
             self.washington = self._work(genre="Biography", title="George Washington")
-            self.washington.set_presentation_ready()
+            self.washington.set_presentation_ready(search_index_client=self.search)
 
             self.lincoln_vampire = self._work(title="Abraham Lincoln: Vampire Hunter", genre="Fantasy")
-            self.lincoln_vampire.set_presentation_ready()
+            self.lincoln_vampire.set_presentation_ready(search_index_client=self.search)
 
             self.children_work = self._work(title="Alice in Wonderland", audience=Classifier.AUDIENCE_CHILDREN)
-            self.children_work.set_presentation_ready()
+            self.children_work.set_presentation_ready(search_index_client=self.search)
 
             self.ya_work = self._work(title="Go Ask Alice", audience=Classifier.AUDIENCE_YOUNG_ADULT)
-            self.ya_work.set_presentation_ready()
+            self.ya_work.set_presentation_ready(search_index_client=self.search)
 
             self.adult_work = self._work(title="Still Alice", audience=Classifier.AUDIENCE_ADULT)
-            self.adult_work.set_presentation_ready()
+            self.adult_work.set_presentation_ready(search_index_client=self.search)
 
             self.ya_romance = self._work(audience=Classifier.AUDIENCE_YOUNG_ADULT, genre="Romance")
-            self.ya_romance.set_presentation_ready()
+            self.ya_romance.set_presentation_ready(search_index_client=self.search)
 
             self.no_age = self._work()
             self.no_age.summary_text = "President Barack Obama's election in 2008 energized the United States"
-            self.no_age.set_presentation_ready()
+            self.no_age.set_presentation_ready(search_index_client=self.search)
 
             self.age_4_5 = self._work()
             self.age_4_5.target_age = NumericRange(4, 5, '[]')
             self.age_4_5.summary_text = "President Barack Obama's election in 2008 energized the United States"
-            self.age_4_5.set_presentation_ready()
+            self.age_4_5.set_presentation_ready(search_index_client=self.search)
 
             self.age_5_6 = self._work(fiction=False)
             self.age_5_6.target_age = NumericRange(5, 6, '[]')
-            self.age_5_6.set_presentation_ready()
+            self.age_5_6.set_presentation_ready(search_index_client=self.search)
 
             self.obama = self._work(genre="Biography & Memoir")
             self.obama.target_age = NumericRange(8, 8, '[]')
             self.obama.summary_text = "President Barack Obama's election in 2008 energized the United States"
-            self.obama.set_presentation_ready()
+            self.obama.set_presentation_ready(search_index_client=self.search)
 
             self.dodger = self._work()
             self.dodger.target_age = NumericRange(8, 8, '[]')
             self.dodger.summary_text = "Willie finds himself running for student council president"
-            self.dodger.set_presentation_ready()
+            self.dodger.set_presentation_ready(search_index_client=self.search)
 
             self.age_9_10 = self._work()
             self.age_9_10.target_age = NumericRange(9, 10, '[]')
             self.age_9_10.summary_text = "President Barack Obama's election in 2008 energized the United States"
-            self.age_9_10.set_presentation_ready()
+            self.age_9_10.set_presentation_ready(search_index_client=self.search)
 
             self.age_2_10 = self._work()
             self.age_2_10.target_age = NumericRange(2, 10, '[]')
-            self.age_2_10.set_presentation_ready()
+            self.age_2_10.set_presentation_ready(search_index_client=self.search)
 
             self.pride = self._work(title="Pride and Prejudice")
             self.pride.presentation_edition.medium = Edition.BOOK_MEDIUM
-            self.pride.set_presentation_ready()
+            self.pride.set_presentation_ready(search_index_client=self.search)
 
             self.pride_audio = self._work(title="Pride and Prejudice")
             self.pride_audio.presentation_edition.medium = Edition.AUDIO_MEDIUM
-            self.pride_audio.set_presentation_ready()
+            self.pride_audio.set_presentation_ready(search_index_client=self.search)
 
             self.sherlock = self._work(title="The Adventures of Sherlock Holmes")
             self.sherlock.presentation_edition.language = "en"
-            self.sherlock.set_presentation_ready()
+            self.sherlock.set_presentation_ready(search_index_client=self.search)
 
             self.sherlock_spanish = self._work(title="Las Aventuras de Sherlock Holmes")
             self.sherlock_spanish.presentation_edition.language = "es"
-            self.sherlock_spanish.set_presentation_ready()
+            self.sherlock_spanish.set_presentation_ready(search_index_client=self.search)
 
             time.sleep(2)
 
@@ -948,3 +956,667 @@ class TestSearchErrors(ExternalSearchTest):
         eq_(1, len(failures))
         eq_(failing_work, failures[0][0])
         eq_("There was an error!", failures[0][1])
+
+
+class TestSearchIndexCoverageProvider(DatabaseTest):
+
+    def test_process_batch(self):
+        search = DummyExternalSearchIndex()
+        provider = SearchIndexCoverageProvider(
+            self._db, search_index_client=search
+        )
+
+        # One work is queued to be indexed, the other to be removed
+        # from the index.
+        ready = self._work(with_license_pool=True)
+        ready.set_presentation_ready()
+        not_ready = self._work(with_license_pool=True)
+        not_ready.presentation_ready = False
+        not_ready.external_index_needs_updating()
+        search.index(search.works_index, search.work_document_type,
+                     not_ready.id, {})
+
+        record = WorkCoverageRecord.lookup(
+            ready, WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        )
+        record.timestamp = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=60
+        )
+
+        provider.run_once_and_update_timestamp()
+
+        # The ready work was indexed; the other work was removed.
+        eq_([(search.works_index, search.work_document_type, ready.id)],
+            search.docs.keys())
+
+        # Both works are now covered.
+        for work in (ready, not_ready):
+            record = WorkCoverageRecord.lookup(work, provider.operation)
+            eq_(WorkCoverageRecord.SUCCESS, record.status)
+
+        # The provider noted how long the oldest work had been waiting.
+        assert provider.lag >= 60
+
+    def test_process_batch_dead_letters_works_that_keep_failing(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+
+        class MockSearchIndex(DummyExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                # The first work's document always fails.
+                errors = []
+                for doc in docs:
+                    if doc['_id'] == w1.id:
+                        errors.append(dict(index=dict(
+                            _index=doc['_index'], _id=unicode(doc['_id']),
+                            status=400, error="Mapping error"
+                        )))
+                    else:
+                        self.index(doc['_index'], doc['_type'], doc['_id'], doc)
+                return len(docs) - len(errors), errors
+
+        search = MockSearchIndex()
+        provider = SearchIndexCoverageProvider(
+            self._db, search_index_client=search
+        )
+        w1.set_presentation_ready()
+        w2.set_presentation_ready()
+        provider.run_once_and_update_timestamp()
+
+        # Since the other work went through, the problem is with the
+        # failed work, and it won't be tried again until it changes.
+        record = WorkCoverageRecord.lookup(w1, provider.operation)
+        eq_(WorkCoverageRecord.PERSISTENT_FAILURE, record.status)
+        eq_("Mapping error", record.exception)
+        record = WorkCoverageRecord.lookup(w2, provider.operation)
+        eq_(WorkCoverageRecord.SUCCESS, record.status)
+
+        w1.external_index_needs_updating()
+        record = WorkCoverageRecord.lookup(w1, provider.operation)
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+
+    def test_work_queued_during_batch_stays_queued(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        w1.set_presentation_ready()
+        w2.set_presentation_ready()
+
+        class MockSearchIndex(DummyExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                # While the documents are being uploaded, someone
+                # changes the first work and queues it again.
+                w1.external_index_needs_updating()
+                self_db.flush()
+                return super(MockSearchIndex, self).bulk(docs, **kwargs)
+
+        self_db = self._db
+        provider = SearchIndexCoverageProvider(
+            self._db, search_index_client=MockSearchIndex()
+        )
+        provider.run_once_and_update_timestamp()
+
+        # The document that was uploaded for the first work may not
+        # reflect the change, so the work is left in the queue.
+        self._db.expire_all()
+        record = WorkCoverageRecord.lookup(w1, provider.operation)
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+        record = WorkCoverageRecord.lookup(w2, provider.operation)
+        eq_(WorkCoverageRecord.SUCCESS, record.status)
+
+
+class TestSearchIndexRebuild(DatabaseTest):
+
+    def test_run(self):
+        search = DummyExternalSearchIndex()
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        w3 = self._work(with_license_pool=True)
+        for work in (w1, w2, w3):
+            work.presentation_ready = True
+
+        rebuild = SearchIndexRebuild(
+            self._db, search, "works-v3", batch_size=1, workers=2
+        )
+        rebuild.run()
+
+        # Every work was uploaded into the new index, which is now
+        # the current index.
+        eq_(3, rebuild.uploaded)
+        eq_(0, rebuild.failures)
+        eq_(set([("works-v3", search.work_document_type, w.id)
+                 for w in (w1, w2, w3)]),
+            set(search.docs.keys()))
+        eq_("works-v3", search.works_index)
+
+        # Progress was checkpointed.
+        checkpoint = get_one(self._db, Timestamp, service=rebuild.service_name)
+        eq_(w3.id, checkpoint.counter)
+
+        # Running the rebuild again only uploads works that weren't
+        # uploaded the first time.
+        w4 = self._work(with_license_pool=True)
+        w4.presentation_ready = True
+        rebuild = SearchIndexRebuild(self._db, search, "works-v3")
+        rebuild.run()
+        eq_(1, rebuild.uploaded)
+        eq_(w4.id, checkpoint.counter)
+
+    def test_run_with_failed_documents(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        for work in (w1, w2):
+            work.presentation_ready = True
+        w1.external_index_needs_updating()
+        queued = WorkCoverageRecord.lookup(
+            w1, WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        )
+
+        class MockSearchIndex(DummyExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                # The first work's document always fails.
+                errors = []
+                for doc in docs:
+                    if doc['_id'] == w1.id:
+                        errors.append(dict(index=dict(
+                            _index=doc['_index'], _id=unicode(doc['_id']),
+                            status=400, error="Mapping error"
+                        )))
+                    else:
+                        self.index(doc['_index'], doc['_type'], doc['_id'], doc)
+                return len(docs) - len(errors), errors
+
+        search = MockSearchIndex()
+        rebuild = SearchIndexRebuild(self._db, search, "works-v3")
+        eq_(1, rebuild.run())
+
+        # The failure was recorded for the new index, without touching
+        # the work's place in the search index coverage provider's
+        # queue.
+        [record] = rebuild.dead_letters().all()
+        eq_(w1, record.work)
+        eq_("Mapping error", record.exception)
+        eq_(WorkCoverageRecord.REGISTERED, queued.status)
+
+        # Since the new index is missing a work, the alias wasn't
+        # moved to it...
+        eq_("works", search.works_index)
+
+        # ...unless that's forced. Failures from earlier runs count
+        # even though those works aren't tried again.
+        rebuild = SearchIndexRebuild(self._db, search, "works-v3")
+        eq_(1, rebuild.run(force=True))
+        eq_("works-v3", search.works_index)
+
+    def test_refresh_changed_works(self):
+        search = DummyExternalSearchIndex()
+        rebuild = SearchIndexRebuild(self._db, search, "works-v3")
+        doc_type = search.work_document_type
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        long_ago = since - datetime.timedelta(days=1)
+
+        # This work changed since the migration started, but the new
+        # index has an older version of its document.
+        changed = self._work(with_license_pool=True)
+        changed.set_presentation_ready()
+        search.index("works-v3", doc_type, changed.id, dict(title="old"))
+
+        # This work was taken out of the index since the migration
+        # started.
+        removed = self._work(with_license_pool=True)
+        removed.presentation_ready = False
+        removed.external_index_needs_updating()
+        search.index("works-v3", doc_type, removed.id, dict(title="old"))
+
+        # This work hasn't changed since the migration started.
+        unchanged = self._work(with_license_pool=True)
+        unchanged.set_presentation_ready()
+        WorkCoverageRecord.lookup(
+            unchanged, WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+        ).timestamp = long_ago
+        search.index("works-v3", doc_type, unchanged.id, dict(title="old"))
+
+        eq_(2, rebuild.refresh_changed_works(since))
+        new_doc = search.docs[("works-v3", doc_type, changed.id)]
+        eq_(changed.title, new_doc['title'])
+        assert ("works-v3", doc_type, removed.id) not in search.docs
+        eq_(dict(title="old"),
+            search.docs[("works-v3", doc_type, unchanged.id)])
+
+        # With no start time, every queued work is refreshed.
+        eq_(3, rebuild.refresh_changed_works())
+        eq_(unchanged.title,
+            search.docs[("works-v3", doc_type, unchanged.id)]['title'])
+
+    def test_run_stops_on_upload_error(self):
+        class BrokenIndex(DummyExternalSearchIndex):
+            def bulk(self, docs, **kwargs):
+                raise Exception("Elasticsearch is down.")
+
+        search = BrokenIndex()
+        work = self._work(with_license_pool=True)
+        work.presentation_ready = True
+
+        rebuild = SearchIndexRebuild(self._db, search, "works-v3")
+        assert_raises(Exception, rebuild.run)
+
+        # The checkpoint didn't move, and the alias wasn't transferred.
+        checkpoint = get_one(self._db, Timestamp, service=rebuild.service_name)
+        eq_(0, checkpoint.counter)
+        eq_("works", search.works_index)
+
+
+class TestSearchResultCache(object):
+
+    def setup(self):
+        ExternalSearchIndex.reset_search_result_cache()
+
+    def teardown(self):
+        ExternalSearchIndex.reset_search_result_cache()
+
+    def test_query_works_caches_work_ids(self):
+        class MockSearchIndex(DummyExternalSearchIndex):
+            queries = []
+            def search(self, **kwargs):
+                self.queries.append(kwargs)
+                return dict(hits=dict(hits=[
+                    dict(_id=u"1", _source=dict(title="Moby Dick"),
+                         fields=dict(title=["Moby Dick"])),
+                    dict(_id=u"2", _source=dict(title="Moby Duck"),
+                         fields=dict(title=["Moby Duck"])),
+                ]))
+
+        search = MockSearchIndex()
+        search.works_index = "works-v2"
+        def query(query_string, **kwargs):
+            return ExternalSearchIndex.query_works(
+                search, query_string, None, None, None, None, None, None,
+                **kwargs
+            )
+
+        results = query("Moby Dick")
+        eq_(1, len(search.queries))
+        eq_("Moby Dick", results['hits']['hits'][0]['_source']['title'])
+
+        # The same search, modulo case and whitespace, is answered
+        # from the cache. Only the work IDs are kept.
+        results = query("  moby   DICK ")
+        eq_(1, len(search.queries))
+        eq_([dict(_id=u"1"), dict(_id=u"2")], results['hits']['hits'])
+
+        # Different pagination is a different search.
+        query("moby dick", size=1, offset=1)
+        eq_(2, len(search.queries))
+
+        # Asking for specific fields is a different search, and the
+        # cached results keep those fields.
+        query("moby dick", fields=["title"])
+        eq_(3, len(search.queries))
+        results = query("moby dick", fields=["title"])
+        eq_(3, len(search.queries))
+        eq_([dict(_id=u"1", fields=dict(title=["Moby Dick"])),
+             dict(_id=u"2", fields=dict(title=["Moby Duck"]))],
+            results['hits']['hits'])
+
+        # Once the alias points to a new version of the index, old
+        # results aren't used.
+        search.works_index = "works-v3"
+        query("moby dick")
+        eq_(4, len(search.queries))
+
+        stats = ExternalSearchIndex.search_result_cache_stats()
+        eq_(2, stats['hits'])
+        eq_(4, stats['misses'])
+        eq_(2/6.0, stats['hit_rate'])
+
+
+class TestSearchTimings(object):
+
+    def test_record(self):
+        timings = SearchTimings()
+        timings.record("Fiction", 0.07)
+        timings.record("Fiction", 0.08)
+        timings.record("Fiction", 30)
+        timings.record("Nonfiction", 0.01)
+        summary = timings.summary()
+        eq_({0.1: 2, SearchTimings.OVERFLOW: 1},
+            summary["Fiction"]["histogram"])
+        eq_({0.05: 1}, summary["Nonfiction"]["histogram"])
+
+    def test_record_profile(self):
+        timings = SearchTimings()
+
+        # Each clause is charged for the time not spent in its
+        # children. Times may be given as strings or in nanoseconds.
+        profile = dict(shards=[dict(searches=[dict(query=[
+            dict(query_type="BooleanQuery", time="3ms", children=[
+                dict(query_type="TermQuery", time_in_nanos=1000000),
+                dict(query_type="FuzzyQuery", time="1500micros"),
+            ])
+        ])])])
+        timings.record("Fiction", 0.01, profile)
+        clauses = timings.summary()["Fiction"]["clauses"]
+        eq_(0.0005, round(clauses["BooleanQuery"], 6))
+        eq_(0.001, round(clauses["TermQuery"], 6))
+        eq_(0.0015, round(clauses["FuzzyQuery"], 6))
+
+
+class TestSearchProfiling(object):
+
+    def teardown(self):
+        ExternalSearchIndex.reset()
+
+    def test_can_profile(self):
+        class MockSearchIndex(DummyExternalSearchIndex):
+            number = None
+            def info(self):
+                return dict(version=dict(number=self.number))
+
+        # Elasticsearch 2.1 can't profile queries.
+        search = MockSearchIndex()
+        search.number = "2.1.0"
+        eq_((2, 1, 0), search.server_version())
+        eq_(False, search.can_profile())
+
+        # The version is only looked up once.
+        search.number = "2.2.0"
+        eq_(False, search.can_profile())
+
+        # Elasticsearch 2.2 and later can.
+        ExternalSearchIndex.reset()
+        eq_(True, search.can_profile())
+        ExternalSearchIndex.reset()
+        search.number = "5.0.0-alpha1"
+        eq_((5, 0, 0), search.server_version())
+        eq_(True, search.can_profile())
+
+
+class TestSlowQueryLog(object):
+
+    def test_record_search_timing(self):
+        class MockLog(object):
+            def __init__(self):
+                self.warnings = []
+            def warn(self, *args):
+                self.warnings.append(args)
+
+        search = DummyExternalSearchIndex()
+        search.log = MockLog()
+        body = dict(query=dict(match_all={}))
+        threshold = search.slow_query_threshold()
+
+        search.record_search_timing("Fiction", threshold / 2.0, body)
+        eq_([], search.log.warnings)
+
+        search.record_search_timing("Fiction", threshold, body)
+        [warning] = search.log.warnings
+        assert "Fiction" in warning
+        assert '"match_all": {}' in warning[-1]
+
+
+class TestBulkUpload(object):
+
+    class MockSearchIndex(DummyExternalSearchIndex):
+        """Fails to upload documents according to a script."""
+        def __init__(self, statuses):
+            super(TestBulkUpload.MockSearchIndex, self).__init__()
+            # Maps document IDs to a list of the statuses to fail with
+            # on successive attempts.
+            self.statuses = statuses
+            self.attempts = []
+            self.sleeps = []
+
+        def bulk(self, docs, **kwargs):
+            self.attempts.append([doc['_id'] for doc in docs])
+            errors = []
+            for doc in docs:
+                statuses = self.statuses.get(doc['_id'])
+                if statuses:
+                    status = statuses.pop(0)
+                    # Elasticsearch reports IDs as strings.
+                    errors.append(dict(index=dict(
+                        _index=doc['_index'], _id=unicode(doc['_id']),
+                        status=status, error="Status %s" % status
+                    )))
+            return len(docs) - len(errors), errors
+
+        def _sleep(self, seconds):
+            self.sleeps.append(seconds)
+
+    def docs(self, *ids, **kwargs):
+        index = kwargs.get('index', 'works')
+        return [dict(_index=index, _id=x) for x in ids]
+
+    def test_only_failed_documents_are_retried(self):
+        search = self.MockSearchIndex({2: [429, 503], 3: [400]})
+        success_count, errors = search.bulk_upload(self.docs(1, 2, 3))
+
+        # Document 2 was retried until it went through. Document 3
+        # failed for a reason that won't go away, so it wasn't retried.
+        eq_([[1, 2, 3], [2], [2]], search.attempts)
+        eq_(2, success_count)
+        eq_([u"3"], [search.bulk_error_id(e) for e in errors])
+
+        # There was a longer potential wait before each retry.
+        eq_(2, len(search.sleeps))
+        assert search.sleeps[0] <= search.BULK_BACKOFF
+        assert search.sleeps[1] <= search.BULK_BACKOFF * 2
+
+    def test_errors_are_matched_by_index(self):
+        # While an index is being migrated, each document is uploaded
+        # to two indices. Only the upload that failed is retried.
+        class MockSearchIndex(self.MockSearchIndex):
+            def bulk(self, docs, **kwargs):
+                self.attempts.append(
+                    [(doc['_index'], doc['_id']) for doc in docs]
+                )
+                errors = []
+                for doc in docs:
+                    if doc['_index'] == 'works-v2' and len(self.attempts) == 1:
+                        errors.append(dict(index=dict(
+                            _index=doc['_index'], _id=unicode(doc['_id']),
+                            status=503, error="Status 503"
+                        )))
+                return len(docs) - len(errors), errors
+
+        search = MockSearchIndex({})
+        docs = self.docs(1) + self.docs(1, index='works-v2')
+        success_count, errors = search.bulk_upload(docs)
+        eq_([[('works', 1), ('works-v2', 1)], [('works-v2', 1)]],
+            search.attempts)
+        eq_(2, success_count)
+        eq_([], errors)
+
+    def test_retries_give_up_eventually(self):
+        search = self.MockSearchIndex({1: [503] * 10})
+        success_count, errors = search.bulk_upload(self.docs(1, 2))
+        eq_(search.BULK_RETRIES + 1, len(search.attempts))
+        eq_(1, success_count)
+        eq_("Status 503", errors[0]['index']['error'])
+
+    def test_chunk_size_adapts(self):
+        search = self.MockSearchIndex({})
+        search.bulk_chunk_size = 100
+
+        # Slow uploads make the chunks smaller.
+        search.adapt_bulk_chunk_size(100, search.TARGET_BULK_SECONDS + 1)
+        eq_(50, search.bulk_chunk_size)
+        search.adapt_bulk_chunk_size(50, search.TARGET_BULK_SECONDS + 1)
+        eq_(search.MIN_BULK_CHUNK_SIZE, search.bulk_chunk_size)
+
+        # Fast uploads of full chunks make them bigger.
+        search.adapt_bulk_chunk_size(50, 0)
+        eq_(75, search.bulk_chunk_size)
+
+        # A small chunk going through quickly doesn't mean much.
+        search.adapt_bulk_chunk_size(10, 0)
+        eq_(75, search.bulk_chunk_size)
+
+        # The documents are uploaded in chunks of the current size.
+        search.bulk_upload(self.docs(*range(100)))
+        eq_([75, 25], [len(x) for x in search.attempts])
+
+
+class TestIndexMigration(DatabaseTest):
+
+    def setup(self):
+        super(TestIndexMigration, self).setup()
+
+        class MockIndices(object):
+            def __init__(self):
+                self.created = []
+            def exists(self, index):
+                return index in self.created
+            def create(self, index, body):
+                self.created.append(index)
+
+        integration = self._external_integration(
+            ExternalIntegration.ELASTICSEARCH,
+            goal=ExternalIntegration.SEARCH_GOAL
+        )
+        self.search = DummyExternalSearchIndex()
+        self.search.works_index = "works-v2"
+        self.search.indices = MockIndices()
+        self.search._db = self._db
+        self.search.integration_id = integration.id
+
+    def test_migration(self):
+        search = self.search
+        eq_(None, search.migration_index)
+        eq_(["works-v2"], search.write_indices)
+
+        search.start_migration("works-v3")
+        eq_(["works-v3"], search.indices.created)
+        eq_("works-v3", search.migration_index)
+        eq_(["works-v2", "works-v3"], search.write_indices)
+
+        # While the migration is going on, documents are written to
+        # both indexes.
+        w1 = self._work(with_license_pool=True)
+        w1.set_presentation_ready(search_index_client=search)
+        w2 = self._work(with_license_pool=True)
+        w2.presentation_ready = True
+        search.bulk_update([w2])
+        for index in ("works-v2", "works-v3"):
+            eq_(set([(index, search.work_document_type, w.id)
+                     for w in (w1, w2)]),
+                set(k for k in search.docs if k[0] == index))
+
+        # And deleted from both.
+        w2.presentation_ready = False
+        w2.update_external_index(search)
+        eq_(set([("works-v2", search.work_document_type, w1.id),
+                 ("works-v3", search.work_document_type, w1.id)]),
+            set(search.docs.keys()))
+
+        eq_([], search.check_migration())
+
+        search.finish_migration()
+        eq_("works-v3", search.works_index)
+        eq_(None, search.migration_index)
+        eq_(["works-v3"], search.write_indices)
+
+    def test_check_migration(self):
+        search = self.search
+        eq_(["No index migration is in progress."], search.check_migration())
+
+        work = self._work(with_license_pool=True)
+        work.presentation_ready = True
+        search.index("works-v2", search.work_document_type, work.id,
+                     dict(title="Old title"))
+        search.start_migration("works-v3")
+
+        # The new index is missing a document.
+        eq_(["works-v2 has 1 documents, but works-v3 has 0.",
+             "Document for work %d differs between works-v2 and works-v3." % work.id],
+            search.check_migration())
+
+        # The new index has the document, but it's different.
+        search.index("works-v3", search.work_document_type, work.id,
+                     dict(title="New title"))
+        eq_(["Document for work %d differs between works-v2 and works-v3." % work.id],
+            search.check_migration())
+
+        search.index("works-v3", search.work_document_type, work.id,
+                     dict(title="Old title"))
+        eq_([], search.check_migration())
+
+
+class TestPostgresSearchIndex(DatabaseTest):
+
+    def setup(self):
+        super(TestPostgresSearchIndex, self).setup(mock_search=False)
+        self.integration = self._external_integration(
+            ExternalIntegration.POSTGRES_SEARCH,
+            goal=ExternalIntegration.SEARCH_GOAL
+        )
+
+    def test_constructor(self):
+        # When the site searches its own database, asking for an
+        # ExternalSearchIndex gets you a PostgresSearchIndex.
+        search = ExternalSearchIndex(self._db)
+        assert isinstance(search, PostgresSearchIndex)
+        eq_(ExternalSearchIndex.DEFAULT_WORKS_INDEX, search.works_index)
+        eq_(search.works_index, search.works_alias)
+
+    def test_query_works(self):
+        search = PostgresSearchIndex(self._db)
+
+        moby_dick = self._work(title=u"Moby Dick", authors=u"Herman Melville",
+                               fiction=True, with_license_pool=True)
+        moby_dick.presentation_edition.subtitle = u"The Whale"
+        moby_dick.summary_text = u"Ishmael goes to sea."
+        moby_duck = self._work(title=u"Moby Duck", authors=u"Donovan Hohn",
+                               fiction=False, with_license_pool=True)
+        moby_duck.summary_text = u"Bath toys lost at sea, and a whale of a tale."
+        spanish = self._work(title=u"Moby Dick", language="spa",
+                             with_license_pool=True)
+        children = self._work(title=u"Moby Dick for kids",
+                              audience=Classifier.AUDIENCE_CHILDREN,
+                              with_license_pool=True)
+        children.target_age = NumericRange(6, 8, '[]')
+        works = [moby_dick, moby_duck, spanish, children]
+        for work in works:
+            work.set_presentation_ready(search_index_client=search)
+
+        def query(query_string, **kwargs):
+            args = dict(media=None, languages=None, exclude_languages=None,
+                        fiction=None, audience=None, age_range=None)
+            args.update(kwargs)
+            results = search.query_works(
+                query_string, args['media'], args['languages'],
+                args['exclude_languages'], args['fiction'],
+                args['audience'], args['age_range'],
+                args.get('in_any_of_these_genres', []),
+                size=args.get('size', 30), offset=args.get('offset', 0)
+            )
+            return [int(hit['_id']) for hit in results['hits']['hits']]
+
+        # Title matches count for more than summary matches.
+        eq_(moby_dick.id, query("whale")[0])
+        eq_(set([moby_duck.id, moby_dick.id]), set(query("whale")))
+
+        # Author matches.
+        eq_([moby_dick.id], query("melville"))
+
+        # Filters.
+        eq_([spanish.id], query("moby", languages=["spa"]))
+        assert spanish.id not in query("moby", exclude_languages=["spa"])
+        eq_([moby_duck.id], query("moby", fiction=False, languages=["eng"]))
+        eq_([children.id],
+            query("moby", audience=[Classifier.AUDIENCE_CHILDREN]))
+        eq_([children.id], query("moby", age_range=[7, 9],
+                                 audience=[Classifier.AUDIENCE_CHILDREN]))
+        eq_([], query("moby", age_range=[10, 12],
+                      audience=[Classifier.AUDIENCE_CHILDREN]))
+
+        # Pagination.
+        eq_(2, len(query("moby", languages=["eng"], size=2)))
+        eq_(1, len(query("moby", languages=["eng"], size=2, offset=2)))
+
+        # When a work stops being presentation-ready, it's removed from
+        # the index.
+        moby_duck.presentation_ready = False
+        moby_duck.update_external_index(search)
+        eq_([], query("duck"))
+        eq_(3, search.count(index=search.works_index,
+                            doc_type=search.work_document_type)['count'])
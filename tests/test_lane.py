@@ -20,6 +20,7 @@ from classifier import (
 
 from lane import (
     Facets,
+    KeysetPagination,
     Pagination,
     Lane,
     LaneList,
@@ -471,6 +472,55 @@ class TestLanes(DatabaseTest):
         # lane size, nothing is returned.
         _assert_featured_works(10, expected_length=0)
 
+    def test_sublane_samples_batches_featured_works(self):
+        english = Lane(self._db, self._default_library, "English",
+                       languages=["eng"])
+        spanish = Lane(self._db, self._default_library, "Spanish",
+                       languages=["spa"])
+
+        class CustomLane(Lane):
+            def featured_works(self, use_materialized_works=True):
+                return ["custom"]
+        custom = CustomLane(self._db, self._default_library, "Custom")
+
+        lane = Lane(self._db, self._default_library, "Everything",
+                    sublanes=[english, spanish, custom])
+
+        works = {}
+        for language in ("eng", "spa"):
+            works[language] = [
+                self._work(language=language, quality=1,
+                           with_open_access_download=True)
+                for i in range(2)
+            ]
+        self._db.commit()
+        SessionManager.refresh_materialized_views(self._db)
+
+        library = self._default_library
+        library.setting(library.FEATURED_LANE_SIZE).value = 2
+
+        # The samples for both ordinary lanes are found at once. The
+        # lane that does its own thing is left out.
+        batched = lane.batch_featured_works(lane.visible_sublanes)
+        eq_([0, 1], sorted(batched.keys()))
+        eq_(sorted(w.id for w in works["eng"]),
+            sorted(mw.works_id for mw in batched[0]))
+        eq_(sorted(w.id for w in works["spa"]),
+            sorted(mw.works_id for mw in batched[1]))
+
+        samples = lane.sublane_samples()
+        eq_([english]*2 + [spanish]*2 + [custom],
+            [sublane for work, sublane in samples])
+        eq_("custom", samples[-1][0])
+
+        # If a lane can't be filled from its most restrictive
+        # sample, it's left for featured_works to handle.
+        library.setting(library.FEATURED_LANE_SIZE).value = 3
+        eq_({}, lane.batch_featured_works(lane.visible_sublanes))
+        samples = lane.sublane_samples()
+        eq_([english]*2 + [spanish]*2 + [custom],
+            [sublane for work, sublane in samples])
+
     def test_gather_matching_genres(self):
         self.fantasy, ig = Genre.lookup(self._db, classifier.Fantasy)
         self.urban_fantasy, ig = Genre.lookup(
@@ -540,6 +590,32 @@ class TestLanes(DatabaseTest):
         assert all([x.age_range==[15, 16] for x in sublanes])
         assert all([x.audiences==set(['Young Adult']) for x in sublanes])
 
+    def test_works_for_search_results(self):
+        lane = Lane(self._db, self._default_library, "Everything")
+        w1 = self._work(with_open_access_download=True)
+        w2 = self._work(with_open_access_download=True)
+        w3 = self._work(with_open_access_download=True)
+        not_ready = self._work(with_open_access_download=True)
+        not_ready.presentation_ready = False
+        self._db.commit()
+        SessionManager.refresh_materialized_views(self._db)
+
+        # The works come back in the order they were ranked. Works
+        # that can't be shown are left out.
+        ranked = [w3.id, not_ready.id, w1.id, w2.id]
+        results = lane.works_for_search_results(ranked)
+        eq_([w3.id, w1.id, w2.id], [mw.works_id for mw in results])
+
+        # Each work's LicensePool was loaded along with it.
+        for mw in results:
+            assert 'license_pool' in mw.__dict__
+
+        # A work that was ranked more than once only shows up once,
+        # in its best-ranked position.
+        ranked = [w3.id, w1.id, w3.id, w2.id, w1.id]
+        results = lane.works_for_search_results(ranked)
+        eq_([w3.id, w1.id, w2.id], [mw.works_id for mw in results])
+
     def test_get_search_target(self):
         fantasy, ig = Genre.lookup(self._db, classifier.Fantasy)
         lane = Lane(
@@ -717,6 +793,41 @@ class TestLanes(DatabaseTest):
         assert visible_sublane in lane.visible_sublanes
         assert visible_grandchild in lane.visible_sublanes
 
+    def test_randomized_sample_works(self):
+        class MockLane(Lane):
+            start = 0.5
+            def random_sample_start(self):
+                return self.start
+
+        lane = MockLane(self._db, self._default_library, "Everything")
+        works = {}
+        for value in (0.1, 0.5, 0.9, None):
+            work = self._work(with_license_pool=True)
+            work.random = value
+            works[value] = work
+        query = lane.works()
+
+        # The sample starts at the chosen point in Work.random.
+        sample = lane.randomized_sample_works(query, target_size=2)
+        eq_(set([works[0.5], works[0.9]]), set(sample))
+
+        # If there aren't enough works after that point, the sample
+        # wraps around to the start of the range...
+        lane.start = 0.7
+        sample = lane.randomized_sample_works(query, target_size=3)
+        eq_(set([works[0.9], works[0.1], works[0.5]]), set(sample))
+
+        # ...and works with no random value at all come last.
+        sample = lane.randomized_sample_works(query, target_size=10)
+        eq_(set(works.values()), set(sample))
+
+        # If the sample is too small, nothing is returned.
+        eq_([], lane.randomized_sample_works(query, target_size=10,
+                                            use_min_size=True))
+        lane.MINIMUM_SAMPLE_SIZE = 4
+        eq_(4, len(lane.randomized_sample_works(query, target_size=10,
+                                               use_min_size=True)))
+
 
 class TestLanesQuery(DatabaseTest):
 
@@ -1249,6 +1360,135 @@ class TestFilters(DatabaseTest):
         eq_(2, len(subclass_work.license_pools))
 
 
+class TestKeysetPagination(DatabaseTest):
+
+    def setup(self):
+        super(TestKeysetPagination, self).setup()
+        self.lane = Lane(self._db, self._default_library, "Everything")
+        now = datetime.datetime.utcnow()
+        for i, (title, author, random) in enumerate((
+                ("A", "Zebra", 0.5), ("B", "Yak", 0.25), ("C", "Yak", 0.75),
+                ("D", "Walrus", 0.125), ("E", "Vole", 0.5)
+        )):
+            work = self._work(
+                title=title, authors=[author], with_license_pool=True
+            )
+            # Give every sortable field a value, with some ties.
+            work.random = random
+            work.last_update_time = now - datetime.timedelta(days=i % 3)
+            work.presentation_edition.series_position = 5 - i
+            [pool] = work.license_pools
+            pool.availability_time = now - datetime.timedelta(days=i // 2)
+        self._db.flush()
+        # Load the values back the way they'll be found in a real
+        # query -- Work.random, for instance, comes back as a Decimal.
+        self._db.expire_all()
+
+    def _all_pages(self, facets, pagination):
+        """Page through the lane, and return the titles on every page."""
+        pages = []
+        while pagination:
+            works = self.lane.works(facets, pagination).all()
+            pagination.page_loaded(works)
+            pages.append([w.title for w in works])
+            if not pagination.has_next_page:
+                break
+            # Go to the next page the way a client would, through the
+            # token in its URL.
+            [after] = [v for k, v in pagination.next_page.items()
+                       if k == 'after']
+            pagination = KeysetPagination.from_token(after, pagination.size)
+        return pages
+
+    def test_pages_match_offset_pagination(self):
+        orders = [
+            Facets.ORDER_TITLE, Facets.ORDER_AUTHOR,
+            Facets.ORDER_LAST_UPDATE, Facets.ORDER_ADDED_TO_COLLECTION,
+            Facets.ORDER_SERIES_POSITION, Facets.ORDER_WORK_ID,
+            Facets.ORDER_RANDOM,
+        ]
+        for order in orders:
+            for ascending in (True, False):
+                facets = Facets(
+                    self._default_library, Facets.COLLECTION_FULL,
+                    Facets.AVAILABLE_ALL, order, order_ascending=ascending
+                )
+                expect = [
+                    w.title for w in self.lane.works(facets).all()
+                ]
+                pages = self._all_pages(facets, KeysetPagination(2))
+                eq_([expect[0:2], expect[2:4], expect[4:]], pages)
+
+    def test_license_pools_outside_the_lane_are_ignored(self):
+        # Work "E" also has a LicensePool in a collection the library
+        # doesn't have. It became available long before any of the
+        # others, but it has nothing to do with where E shows up in
+        # this lane.
+        [e] = [w for w in self.lane.works(Facets.default(
+            self._default_library)).all() if w.title == "E"]
+        other_pool = self._licensepool(
+            e.presentation_edition, collection=self._collection()
+        )
+        other_pool.work = e
+        other_pool.availability_time = (
+            datetime.datetime.utcnow() - datetime.timedelta(days=365)
+        )
+        self._db.flush()
+
+        for ascending in (True, False):
+            facets = Facets(
+                self._default_library, Facets.COLLECTION_FULL,
+                Facets.AVAILABLE_ALL, Facets.ORDER_ADDED_TO_COLLECTION,
+                order_ascending=ascending
+            )
+            expect = [w.title for w in self.lane.works(facets).all()]
+            pages = self._all_pages(facets, KeysetPagination(2))
+            eq_([expect[0:2], expect[2:4], expect[4:]], pages)
+
+    def test_token_round_trip(self):
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_AUTHOR
+        )
+        pagination = KeysetPagination(2)
+
+        # The first page looks just like the first page of
+        # offset-based pagination.
+        eq_(Pagination(0, 2).query_string, pagination.query_string)
+        eq_(True, pagination.is_first_page)
+
+        works = self.lane.works(facets, pagination).all()
+        pagination.page_loaded(works)
+        next_page = pagination.next_page
+        eq_(False, next_page.is_first_page)
+        eq_(None, next_page.previous_page)
+
+        [after] = [v for k, v in next_page.items() if k == 'after']
+        restored = KeysetPagination.from_token(after, 2)
+        eq_(next_page.last_item, restored.last_item)
+        eq_(next_page.query_string, restored.query_string)
+
+        assert_raises(ValueError, KeysetPagination.from_token, "not a token")
+
+    def test_seek_handles_null_values(self):
+        facets = Facets(
+            self._default_library, Facets.COLLECTION_FULL,
+            Facets.AVAILABLE_ALL, Facets.ORDER_AUTHOR
+        )
+        for work in self.lane.works(facets).all():
+            if work.title in ("B", "C"):
+                work.presentation_edition.sort_author = None
+        self._db.flush()
+
+        # Works with no author sort last, in title order.
+        expect = ["E", "D", "A", "B", "C"]
+        eq_(expect, [w.title for w in self.lane.works(facets).all()])
+
+        # Keyset pagination finds them all the same.
+        pages = self._all_pages(facets, KeysetPagination(2))
+        eq_([["E", "D"], ["A", "B"], ["C"]], pages)
+
+
 class TestPagination(DatabaseTest):
 
     def test_has_next_page(self):
@@ -1,5 +1,6 @@
 # encoding: utf-8
 from StringIO import StringIO
+from collections import Counter
 import base64
 import datetime
 import os
@@ -8,6 +9,8 @@ import site
 import random
 import re
 import tempfile
+import threading
+import time
 
 from nose.tools import (
     assert_raises,
@@ -20,6 +23,13 @@ from nose.tools import (
 from psycopg2.extras import NumericRange
 
 from sqlalchemy import not_
+from sqlalchemy.sql.expression import (
+    literal_column,
+    select,
+    table,
+    text,
+)
+from sqlalchemy.sql.functions import func
 
 from sqlalchemy.exc import (
     IntegrityError,
@@ -48,6 +58,7 @@ from model import (
     Complaint,
     ConfigurationSetting,
     Contributor,
+    CoverageJob,
     CoverageRecord,
     Credential,
     CustomList,
@@ -69,9 +80,13 @@ from model import (
     Patron,
     PatronProfileStorage,
     PolicyException,
+    PresentationCalculationInputs,
+    PresentationCalculationPolicy,
     Representation,
     Resource,
     RightsStatus,
+    SearchDocument,
+    Session,
     SessionManager,
     Subject,
     Timestamp,
@@ -172,8 +187,8 @@ class TestDataSource(DatabaseTest):
         eq_(key, new_source.name)
         eq_(True, new_source.offers_licenses)
 
-        # The cache was reset when the data source was created.
-        eq_(HasFullTableCache.RESET, DataSource._cache)
+        # Creating the data source didn't reset the whole cache.
+        assert DataSource._cache != HasFullTableCache.RESET
 
         eq_((new_source, False), DataSource.by_cache_key(self._db, key, None))
         
@@ -531,6 +546,136 @@ class TestIdentifier(DatabaseTest):
                  level_3_equivalent.id]),
             set(equivalent_ids))
 
+    def test_equivalents_closure_is_kept_up_to_date(self):
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        a = self._identifier()
+        b = self._identifier()
+        c = self._identifier()
+        ab = a.equivalent_to(data_source, b, 0.9)
+        bc = b.equivalent_to(data_source, c, 0.8)
+        self._db.flush()
+
+        def closure():
+            return self._db.execute(
+                select(
+                    [literal_column(x) for x in ('equivalent_id', 'depth', 'strength')]
+                ).select_from(
+                    table(SessionManager.EQUIVALENTS_CLOSURE_TABLE)
+                ).where(
+                    literal_column('identifier_id')==a.id
+                ).order_by(literal_column('equivalent_id'))
+            ).fetchall()
+
+        def equivalents(levels=5):
+            ids = Identifier.recursively_equivalent_identifier_ids(
+                self._db, [a.id], levels=levels, threshold=0.5)
+            return set(ids[a.id])
+
+        # The strongest path from one identifier to another is
+        # recorded, along with the number of equivalencies in it.
+        [(b_id, b_depth, b_strength), (c_id, c_depth, c_strength)] = closure()
+        eq_((b.id, 1), (b_id, b_depth))
+        eq_((c.id, 2), (c_id, c_depth))
+        eq_(0.9, round(b_strength, 3))
+        eq_(0.72, round(c_strength, 3))
+        eq_(set([a.id, b.id, c.id]), equivalents())
+        eq_(set([a.id, b.id]), equivalents(levels=1))
+
+        # A direct equivalency that's stronger than the existing path
+        # gets a row of its own.
+        a.equivalent_to(data_source, c, 0.95)
+        self._db.flush()
+        eq_([(b.id, 1), (c.id, 1)],
+            [(x[0], x[1]) for x in closure()])
+        eq_(set([a.id, b.id, c.id]), equivalents(levels=1))
+
+        # Weakening or deleting an equivalency updates the closure
+        # for everything on the other side of it.
+        ab.strength = 0.1
+        self._db.flush()
+        eq_([(c.id, 1), (b.id, 2)],
+            sorted([(x[0], x[1]) for x in closure()], key=lambda x: x[1]))
+        self._db.delete(bc)
+        self._db.flush()
+        eq_([c.id], [x[0] for x in closure()])
+        eq_(set([a.id, c.id]), equivalents())
+
+        # The closure table gives the same answers as the recursive
+        # function it replaces.
+        for levels in range(1, 6):
+            query = select([func.fn_recursive_equivalents(a.id, levels, 0.5)])
+            expect = set([r[0] for r in self._db.execute(query)])
+            eq_(expect, equivalents(levels))
+
+    def test_equivalents_closure_around_a_hub(self):
+        # Every identifier in this group is equivalent to every other.
+        # There are a huge number of paths through the group, but only
+        # the direct equivalencies end up in the closure, since no
+        # longer path is any stronger.
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        identifiers = [self._identifier() for i in range(8)]
+        for i, x in enumerate(identifiers):
+            for y in identifiers[i+1:]:
+                x.equivalent_to(data_source, y, 1)
+        self._db.flush()
+
+        hub = identifiers[0]
+        rows = self._db.execute(
+            text("select equivalent_id, depth from equivalents_closure "
+                 "where identifier_id = :id"), dict(id=hub.id)
+        ).fetchall()
+        eq_(sorted((x.id, 1) for x in identifiers[1:]), sorted(rows))
+
+        # Recalculating the closure from scratch, as the migration
+        # that fills it in does, gives the same result.
+        self._db.execute(
+            text("delete from equivalents_closure where identifier_id = :id"),
+            dict(id=hub.id)
+        )
+        self._db.execute(
+            text("select fn_refresh_equivalents_closure(array[:id])"),
+            dict(id=hub.id)
+        )
+        eq_(sorted(rows), sorted(self._db.execute(
+            text("select equivalent_id, depth from equivalents_closure "
+                 "where identifier_id = :id"), dict(id=hub.id)
+        ).fetchall()))
+
+    def test_equivalents_closure_after_a_statement_that_changes_many_rows(self):
+        data_source = DataSource.lookup(self._db, DataSource.MANUAL)
+        a, b, c, d = [self._identifier() for i in range(4)]
+        self._db.flush()
+
+        # A single statement creates a chain of equivalencies. The
+        # closure is refreshed once, after all of them are in place.
+        self._db.execute(
+            text("insert into equivalents "
+                 "(data_source_id, input_id, output_id, strength) values "
+                 "(:ds, :a, :b, 1), (:ds, :b, :c, 1), (:ds, :c, :d, 1)"),
+            dict(ds=data_source.id, a=a.id, b=b.id, c=c.id, d=d.id)
+        )
+        rows = self._db.execute(
+            text("select equivalent_id, depth from equivalents_closure "
+                 "where identifier_id = :id"), dict(id=a.id)
+        ).fetchall()
+        eq_(sorted([(b.id, 1), (c.id, 2), (d.id, 3)]), sorted(rows))
+
+        # The changes that were noted along the way have been dealt
+        # with.
+        eq_(0, self._db.execute(
+            "select count(*) from equivalency_changes"
+        ).scalar())
+
+        # Likewise for a statement that deletes many rows.
+        self._db.execute(
+            text("delete from equivalents where input_id in (:b, :c)"),
+            dict(b=b.id, c=c.id)
+        )
+        rows = self._db.execute(
+            text("select equivalent_id, depth from equivalents_closure "
+                 "where identifier_id = :id"), dict(id=a.id)
+        ).fetchall()
+        eq_([(b.id, 1)], rows)
 
     def test_missing_coverage_from(self):
         gutenberg = DataSource.lookup(self._db, DataSource.GUTENBERG)
@@ -647,6 +792,151 @@ class TestGenre(DatabaseTest):
         drama2 = Genre.by_id(self._db, drama.id)
         eq_(drama2, drama)
 
+    def test_invalidate_cache(self):
+        Genre.populate_cache(self._db)
+        drama = Genre.by_id(self._db, get_one(self._db, Genre, name="Drama").id)
+        comedy = Genre.by_id(self._db, get_one(self._db, Genre, name="Humorous Fiction").id)
+        generation = Genre._cache_generation
+
+        # Changing a genre doesn't affect the cache until the change
+        # is committed...
+        drama.name = u"Drama!"
+        self._db.flush()
+        assert drama.id in Genre._id_cache
+        eq_(generation, Genre._cache_generation)
+
+        # ...and then it drops that genre from the cache, and nothing else.
+        self._db.commit()
+        assert drama.id not in Genre._id_cache
+        assert "Drama" not in Genre._cache
+        assert comedy.id in Genre._id_cache
+        assert Genre._cache_generation > generation
+
+        # The next lookup reloads just that genre.
+        eq_(drama, Genre.by_id(self._db, drama.id))
+        eq_(drama, Genre._id_cache[drama.id])
+
+    def test_rolled_back_change_is_invalidated(self):
+        Genre.populate_cache(self._db)
+        drama = get_one(self._db, Genre, name="Drama")
+
+        # A new genre is looked up, and cached, before it's committed.
+        self._db.begin_nested()
+        new_genre, ignore = Genre.by_cache_key(
+            self._db, u"Not a real genre",
+            lambda: create(self._db, Genre, name=u"Not a real genre")
+        )
+        self._db.flush()
+        eq_(new_genre, Genre._id_cache[new_genre.id])
+        new_genre_id = new_genre.id
+
+        # When the change is rolled back, it's dropped from the cache
+        # rather than lingering there.
+        self._db.rollback()
+        assert new_genre_id not in Genre._id_cache
+        assert drama.id in Genre._id_cache
+
+    def test_handle_notification_reloads_row(self):
+        Genre.populate_cache(self._db)
+        drama = get_one(self._db, Genre, name="Drama")
+
+        # If a database session is provided, a row invalidated by
+        # another process is reloaded right away.
+        other_session = Session(bind=self._db.get_bind())
+        HasFullTableCache.handle_notification(
+            "%s Genre %s" % (os.getpid()+1, drama.id), other_session
+        )
+        reloaded = Genre._id_cache[drama.id]
+        assert reloaded not in other_session
+        eq_("Drama", reloaded.name)
+
+    def test_listener_reloads_row_changed_by_another_process(self):
+        url = Configuration.database_url(test=True)
+        stop = threading.Event()
+        listener = threading.Thread(
+            target=HasFullTableCache._listen, args=(url, 0.1, stop)
+        )
+        listener.daemon = True
+        listener.start()
+        try:
+            # Wait for the listener to start listening. It resets the
+            # caches when it does, since it may have missed changes.
+            for i in range(100):
+                if Configuration.instance.get(
+                        Configuration.SITE_CONFIGURATION_WATCHED):
+                    break
+                time.sleep(0.1)
+            eq_(True, Configuration.instance.get(
+                Configuration.SITE_CONFIGURATION_WATCHED))
+
+            drama = get_one(self._db, Genre, name="Drama")
+            Genre.populate_cache(self._db)
+            cached = Genre._id_cache[drama.id]
+
+            # Another process changes the row and announces it.
+            connection = self.engine.connect()
+            try:
+                transaction = connection.begin()
+                connection.execute(
+                    text("select pg_notify(:channel, :payload)"),
+                    channel=HasFullTableCache.NOTIFY_CHANNEL,
+                    payload="%s Genre %s" % (os.getpid()+1, drama.id)
+                )
+                transaction.commit()
+            finally:
+                connection.close()
+
+            # The listener drops the old object and reloads the row.
+            for i in range(100):
+                reloaded = Genre._id_cache.get(drama.id)
+                if reloaded is not None and reloaded is not cached:
+                    break
+                time.sleep(0.1)
+            assert reloaded is not cached
+            eq_(drama.id, reloaded.id)
+            eq_("Drama", reloaded.name)
+        finally:
+            stop.set()
+            listener.join()
+
+    def test_cache_stats(self):
+        Genre.reset_cache()
+        stats = Genre.cache_stats()
+        before = Counter(stats)
+        drama = get_one(self._db, Genre, name="Drama")
+        Genre.by_id(self._db, drama.id)
+        Genre.by_id(self._db, drama.id)
+        Genre.by_id(self._db, -1)
+        eq_(1, stats['loads'] - before['loads'])
+        eq_(2, stats['hits'] - before['hits'])
+        eq_(1, stats['misses'] - before['misses'])
+
+        # Each class keeps its own statistics.
+        assert DataSource.cache_stats() is not stats
+
+    def test_handle_notification(self):
+        Genre.populate_cache(self._db)
+        drama = get_one(self._db, Genre, name="Drama")
+        comedy = get_one(self._db, Genre, name="Humorous Fiction")
+
+        # Notifications sent by this process are ignored, since the
+        # change has already been handled.
+        HasFullTableCache.handle_notification(
+            "%s Genre %s" % (os.getpid(), drama.id)
+        )
+        assert drama.id in Genre._id_cache
+
+        # Notifications from other processes invalidate the row.
+        HasFullTableCache.handle_notification(
+            "%s Genre %s" % (os.getpid()+1, drama.id)
+        )
+        assert drama.id not in Genre._id_cache
+        assert comedy.id in Genre._id_cache
+
+        # Garbage is ignored.
+        HasFullTableCache.handle_notification("garbage")
+        assert comedy.id in Genre._id_cache
+
     def test_by_id(self):
 
         # Get a genre to test with.
@@ -2018,6 +2308,78 @@ class TestWork(DatabaseTest):
         # Because the work's license_pool isn't suppressed, it isn't returned.
         eq_([], result)
 
+    def test_calculate_presentation_with_inputs(self):
+        overdrive = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+        oclc = DataSource.lookup(self._db, DataSource.OCLC)
+
+        # Here are two works. The first one's identifier is equivalent
+        # to another identifier which has a classification, a
+        # measurement and a description.
+        work1 = self._work(with_license_pool=True)
+        work2 = self._work(with_license_pool=True)
+        [pool1] = work1.license_pools
+        [pool2] = work2.license_pools
+        equivalent = self._identifier()
+        pool1.identifier.equivalent_to(oclc, equivalent, 1)
+        classification = equivalent.classify(
+            oclc, Subject.TAG, u"Science Fiction", weight=100
+        )
+        measurement = equivalent.add_measurement(
+            oclc, Measurement.POPULARITY, 2000
+        )
+        link, ignore = equivalent.add_link(
+            Hyperlink.DESCRIPTION, None, oclc, "text/plain",
+            u"A book about space."
+        )
+        pool2.add_link(
+            Hyperlink.DESCRIPTION, None, overdrive, "text/plain",
+            u"A book about the sea."
+        )
+        self._db.flush()
+
+        # PresentationCalculationInputs loads everything relevant to
+        # both works at once.
+        inputs = PresentationCalculationInputs(self._db, [work1, work2])
+        ids1 = inputs.identifier_ids_for(work1)
+        eq_(set([pool1.identifier.id, equivalent.id]), ids1)
+        eq_(set([pool2.identifier.id]), inputs.identifier_ids_for(work2))
+        eq_([classification], inputs.classifications_for(ids1))
+        eq_([measurement], inputs.measurements_for(ids1))
+        eq_([link], inputs.links_for(ids1, [Hyperlink.DESCRIPTION]))
+
+        # Data about identifiers outside the batch, or data that
+        # wasn't loaded, is not available.
+        outsider = self._identifier()
+        eq_(None, inputs.classifications_for([outsider.id]))
+        eq_(None, inputs.links_for(ids1, [Hyperlink.SAMPLE]))
+
+        # The policy decides what gets loaded.
+        policy = PresentationCalculationPolicy(
+            classify=False, choose_summary=False, choose_cover=False
+        )
+        quality_only = PresentationCalculationInputs(
+            self._db, [work1], policy
+        )
+        eq_(None, quality_only.classifications_for(ids1))
+        eq_(None, quality_only.links_for(ids1, [Hyperlink.DESCRIPTION]))
+        eq_([measurement], quality_only.measurements_for(ids1))
+
+        # Calculating presentation from the inputs gives the same
+        # results as looking everything up one work at a time.
+        work1.calculate_presentation(inputs=inputs)
+        work2.calculate_presentation(inputs=inputs)
+        results = [(w.summary, w.quality, w.fiction,
+                    sorted(g.name for g in w.genres))
+                   for w in (work1, work2)]
+        eq_(link.resource, work1.summary)
+
+        work1.calculate_presentation()
+        work2.calculate_presentation()
+        eq_(results,
+            [(w.summary, w.quality, w.fiction,
+              sorted(g.name for g in w.genres))
+             for w in (work1, work2)])
+
     def test_calculate_presentation(self):
         # Test that:
         # - work coverage records are made on work creation and primary edition selection.
@@ -2236,6 +2598,50 @@ class TestWork(DatabaseTest):
         eq_(True, work.presentation_ready)
         eq_([index_key], search.docs.keys())
 
+    def test_set_presentation_ready_queues_search_index_update(self):
+        work = self._work(with_license_pool=True)
+        operation = WorkCoverageRecord.UPDATE_SEARCH_INDEX_OPERATION
+
+        # With no search index client, the work isn't indexed right
+        # away -- it's queued for SearchIndexCoverageProvider.
+        work.set_presentation_ready()
+        record = WorkCoverageRecord.lookup(work, operation)
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+
+        # Queueing the work again gives the record a new timestamp,
+        # so a batch that was already indexing the work can tell its
+        # document is out of date.
+        queued_at = datetime.datetime(2016, 1, 1)
+        record.timestamp = queued_at
+        work.set_presentation_ready()
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+        assert record.timestamp > queued_at
+
+        # Once the work has been indexed, a later change queues it
+        # again.
+        record.status = WorkCoverageRecord.SUCCESS
+        work.external_index_needs_updating()
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+
+        # If the search index coverage provider indexed the work
+        # behind this session's back, the work is queued again even
+        # though the session still thinks it's queued.
+        self._db.flush()
+        self._db.execute(
+            text("update workcoveragerecords set status = :status "
+                 "where id = :id"),
+            dict(status=WorkCoverageRecord.SUCCESS, id=record.id)
+        )
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+        work.external_index_needs_updating()
+        eq_(WorkCoverageRecord.REGISTERED, record.status)
+        self._db.flush()
+        [[status]] = self._db.execute(
+            text("select status from workcoveragerecords where id = :id"),
+            dict(id=record.id)
+        )
+        eq_(WorkCoverageRecord.REGISTERED, status)
+
     def test_assign_genres_from_weights(self):
         work = self._work()
 
@@ -2717,6 +3123,28 @@ class TestWork(DatabaseTest):
         eq_(work.target_age.lower, target_age_doc['lower'])
         eq_(work.target_age.upper, target_age_doc['upper'])
 
+    def test_stream_search_documents(self):
+        w1 = self._work(with_license_pool=True)
+        w2 = self._work(with_license_pool=True)
+        w3 = self._work(with_license_pool=True)
+        for work in (w1, w2, w3):
+            work.presentation_ready = True
+        not_ready = self._work(with_license_pool=True)
+        not_ready.presentation_ready = False
+        self._db.flush()
+
+        connection = self._db.connection()
+
+        # Documents come out in order by work ID, and only for
+        # presentation-ready works.
+        docs = list(Work.stream_search_documents(connection))
+        eq_([w1.id, w2.id, w3.id], [doc['_id'] for doc in docs])
+        eq_(w1.title, docs[0]['title'])
+
+        # Documents can be picked up after a given work.
+        docs = list(Work.stream_search_documents(connection, after=w1.id))
+        eq_([w2.id, w3.id], [doc['_id'] for doc in docs])
+
     def test_target_age_string(self):
         work = self._work()
         work.target_age = NumericRange(7, 8, '[]')
@@ -3518,6 +3946,11 @@ class TestWorkConsolidation(DatabaseTest):
         )
         wcr, wcr_is_new = WorkCoverageRecord.add_for(work1, "test")
 
+        # And a search document, for sites that search the database.
+        self._db.flush()
+        create(self._db, SearchDocument, index_name=u"works",
+               work_id=work1.id)
+
         # Here's another work with an open-access LicensePool for the
         # same book.
         work2 = self._work(with_license_pool=True, 
@@ -3536,6 +3969,12 @@ class TestWorkConsolidation(DatabaseTest):
             WorkCoverageRecord.work_id==work1.id).all()
         )
 
+        # Its search document was deleted by the database.
+        self._db.expire_all()
+        eq_([], self._db.query(SearchDocument).filter(
+            SearchDocument.work_id==work1.id).all()
+        )
+
     def test_open_access_for_permanent_work_id_fixes_mismatched_works_incidentally(self):
 
         # Here's a work with two open-access LicensePools for the book "abcd".
@@ -5175,6 +5614,43 @@ class TestCoverageRecord(DatabaseTest):
         eq_(record5, record)
         eq_(CoverageRecord.PERSISTENT_FAILURE, record.status)
 
+    def test_bulk_add(self):
+        source = DataSource.lookup(self._db, DataSource.OCLC)
+        collection = self._default_collection
+        edition = self._edition()
+        identifier = self._identifier()
+        existing, ignore = CoverageRecord.add_for(identifier, source)
+        a_week_ago = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+
+        records = CoverageRecord.bulk_add(self._db, [
+            (edition, source, 'foo', None,
+             CoverageRecord.SUCCESS, None, a_week_ago),
+            (identifier, source, None, None,
+             CoverageRecord.TRANSIENT_FAILURE, u"Oops", None),
+            (identifier, source, None, collection,
+             CoverageRecord.PERSISTENT_FAILURE, u"Gone", None),
+        ])
+
+        # A new record was created for the Edition's primary identifier.
+        [new, updated, with_collection] = records
+        eq_(CoverageRecord.lookup(edition, source, 'foo'), new)
+        eq_(a_week_ago, new.timestamp)
+        eq_(CoverageRecord.SUCCESS, new.status)
+
+        # The record with no operation and no collection was updated
+        # in place rather than duplicated.
+        eq_(existing, updated)
+        eq_(CoverageRecord.TRANSIENT_FAILURE, existing.status)
+        eq_(u"Oops", existing.exception)
+
+        # The record for the collection is a separate record.
+        assert with_collection != existing
+        eq_(collection, with_collection.collection)
+        eq_(CoverageRecord.PERSISTENT_FAILURE, with_collection.status)
+
+        eq_(2, self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier==identifier).count())
+
 class TestWorkCoverageRecord(DatabaseTest):
 
     def test_lookup(self):
@@ -5226,6 +5702,145 @@ class TestWorkCoverageRecord(DatabaseTest):
         eq_(record5, record)
         eq_(WorkCoverageRecord.PERSISTENT_FAILURE, record.status)
 
+    def test_bulk_add(self):
+        work = self._work()
+        existing, ignore = WorkCoverageRecord.add_for(work, None)
+        other_work = self._work()
+
+        [updated, new] = WorkCoverageRecord.bulk_add(self._db, [
+            (work, None, WorkCoverageRecord.TRANSIENT_FAILURE, u"Oops", None),
+            (other_work, 'foo', WorkCoverageRecord.SUCCESS, None, None),
+        ])
+
+        # The record with no operation was updated in place.
+        eq_(existing, updated)
+        eq_(WorkCoverageRecord.TRANSIENT_FAILURE, existing.status)
+        eq_(u"Oops", existing.exception)
+
+        eq_(WorkCoverageRecord.lookup(other_work, 'foo'), new)
+        eq_(WorkCoverageRecord.SUCCESS, new.status)
+
+
+class TestCoverageJob(DatabaseTest):
+
+    def test_priorities(self):
+        # An identifier nobody has shown any interest in.
+        old = self._identifier()
+
+        # A book that was licensed just now.
+        new_edition, new_pool = self._edition(with_license_pool=True)
+
+        # A book that was licensed a long time ago, but that a patron
+        # is waiting for.
+        held_edition, held_pool = self._edition(with_license_pool=True)
+        held_pool.availability_time = datetime.datetime(2010, 1, 1)
+        held_pool.on_hold_to(self._patron())
+
+        priorities = CoverageJob.priorities(
+            self._db, [old.id, new_pool.identifier.id,
+                       held_pool.identifier.id]
+        )
+        eq_(CoverageJob.DEFAULT_PRIORITY, priorities[old.id])
+        eq_(CoverageJob.NEW_LICENSE_PRIORITY,
+            priorities[new_pool.identifier.id])
+        eq_(CoverageJob.PATRON_REQUEST_PRIORITY,
+            priorities[held_pool.identifier.id])
+
+    def test_enqueue(self):
+        identifier = self._identifier()
+        CoverageJob.enqueue(
+            self._db, "service", None, [identifier.id],
+            priority=CoverageJob.NEW_LICENSE_PRIORITY
+        )
+        [job] = self._db.query(CoverageJob).all()
+        eq_("service", job.service)
+        eq_(None, job.collection_id)
+        eq_(identifier, job.identifier)
+        eq_(CoverageJob.NEW_LICENSE_PRIORITY, job.priority)
+
+        # Enqueueing the same job again with a lower priority changes
+        # nothing -- not even when the job will be retried.
+        job.reschedule()
+        retry_at = job.available_at
+        CoverageJob.enqueue(
+            self._db, "service", None, [identifier.id],
+            priority=CoverageJob.DEFAULT_PRIORITY
+        )
+        self._db.refresh(job)
+        eq_(CoverageJob.NEW_LICENSE_PRIORITY, job.priority)
+        eq_(retry_at, job.available_at)
+
+        # A higher priority makes the job available right away.
+        CoverageJob.enqueue(
+            self._db, "service", None, [identifier.id],
+            priority=CoverageJob.PATRON_REQUEST_PRIORITY
+        )
+        self._db.refresh(job)
+        eq_(CoverageJob.PATRON_REQUEST_PRIORITY, job.priority)
+        assert job.available_at < retry_at
+
+        # A job for the same Identifier in a Collection is a
+        # different job.
+        collection = self._default_collection
+        CoverageJob.enqueue(self._db, "service", collection, [identifier.id])
+        eq_(2, self._db.query(CoverageJob).count())
+
+    def test_claim(self):
+        i1 = self._identifier()
+        i2 = self._identifier()
+        i3 = self._identifier()
+        collection = self._default_collection
+        CoverageJob.enqueue(self._db, "service", None, [i1.id], priority=0)
+        CoverageJob.enqueue(self._db, "service", None, [i2.id], priority=10)
+        CoverageJob.enqueue(self._db, "service", collection, [i3.id])
+        CoverageJob.enqueue(self._db, "other service", None, [i3.id])
+
+        # The most urgent job for the service is claimed first.
+        [job] = CoverageJob.claim(self._db, [("service", None)], 1)
+        eq_(i2, job.identifier)
+        assert job.available_at > datetime.datetime.utcnow()
+
+        # Now that it's been claimed, it's not available anymore.
+        [job] = CoverageJob.claim(self._db, [("service", None)], 10)
+        eq_(i1, job.identifier)
+        eq_([], CoverageJob.claim(self._db, [("service", None)], 10))
+
+        # Jobs for other services, or for the same service in a
+        # Collection, are only handed out on request.
+        [job] = CoverageJob.claim(
+            self._db, [("service", collection.id)], 10
+        )
+        eq_(i3, job.identifier)
+        eq_(collection.id, job.collection_id)
+        eq_(
+            ["other service"],
+            [x.service for x in CoverageJob.claim(
+                self._db, [("other service", None)], 10
+            )]
+        )
+
+    def test_reschedule(self):
+        identifier = self._identifier()
+        CoverageJob.enqueue(self._db, "service", None, [identifier.id])
+        [job] = self._db.query(CoverageJob).all()
+
+        now = datetime.datetime.utcnow()
+        job.reschedule()
+        eq_(1, job.attempts)
+        first_wait = job.available_at - now
+        assert first_wait >= CoverageJob.BACKOFF
+
+        # Each failure doubles the wait, up to a point.
+        job.reschedule()
+        eq_(2, job.attempts)
+        assert job.available_at - now >= CoverageJob.BACKOFF * 2
+
+        job.attempts = 1000
+        job.reschedule()
+        assert job.available_at - now <= (
+            CoverageJob.MAX_BACKOFF + datetime.timedelta(minutes=1)
+        )
+
 class TestComplaint(DatabaseTest):
 
     def setup(self):
@@ -6233,6 +6848,37 @@ class TestSiteConfigurationHasChanged(DatabaseTest):
         # to modify anything?
         eq_(newer_update, Configuration.site_configuration_last_update(self._db))
 
+    def test_site_configuration_watched(self):
+        """When a background thread is listening for site configuration
+        changes, nobody needs to ask the database about them.
+        """
+        last_update = Configuration.site_configuration_last_update(
+            self._db, timeout=0
+        )
+        Configuration.instance[Configuration.SITE_CONFIGURATION_WATCHED] = True
+
+        # A change made without telling us goes unnoticed, no matter
+        # what the timeout is.
+        Timestamp.stamp(self._db, Configuration.SITE_CONFIGURATION_CHANGED, None)
+        eq_(last_update, Configuration.site_configuration_last_update(
+            self._db, timeout=0
+        ))
+
+        # But when another process announces a change, we take note.
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        format = Configuration.SITE_CONFIGURATION_TIMESTAMP_FORMAT
+        Configuration.site_configuration_changed_elsewhere(
+            later.strftime(format)
+        )
+        eq_(later, Configuration.site_configuration_last_update(self._db))
+
+        # Announcements of older changes, and garbage, are ignored.
+        Configuration.site_configuration_changed_elsewhere(
+            last_update.strftime(format)
+        )
+        Configuration.site_configuration_changed_elsewhere("garbage")
+        eq_(later, Configuration.site_configuration_last_update(self._db))
+
     # We don't test every event listener, but we do test one of each type.
     def test_configuration_relevant_lifecycle_event_updates_configuration(self):
         """When you create or modify a relevant item such as a
@@ -6282,9 +6928,9 @@ class TestCollection(DatabaseTest):
         )
         eq_(True, is_new)
 
-        # Cache was populated and then reset because we created a new
-        # Collection.
-        eq_(HasFullTableCache.RESET, Collection._cache)
+        # Cache was populated, and creating a new Collection didn't
+        # reset it.
+        assert Collection._cache != HasFullTableCache.RESET
         
         collection2, is_new = Collection.by_name_and_protocol(
             self._db, name, ExternalIntegration.OVERDRIVE
@@ -6649,6 +7295,109 @@ class TestMaterializedViews(DatabaseTest):
         eq_(pool2.id, mw.license_pool_id)
         eq_(pool2.id, mwg.license_pool_id)
 
+    def test_incremental_maintenance(self):
+        work = self._work(with_license_pool=True)
+        work.presentation_ready = True
+        work.simple_opds_entry = '<entry>'
+        work.assign_genres_from_weights({classifier.Fantasy : 1})
+        SessionManager.refresh_materialized_views(self._db)
+
+        from model import (
+            MaterializedWork as mwc,
+            MaterializedWorkWithGenre as mwgc,
+        )
+        for view in (mwc, mwgc):
+            SessionManager.convert_to_incremental(
+                self._db, view.__table__.name
+            )
+            eq_(True, SessionManager.is_incremental(
+                self._db, view.__table__.name
+            ))
+
+        # The converted tables start out with the same rows as the
+        # views did.
+        [mw] = self._db.query(mwc).all()
+        eq_(work.id, mw.works_id)
+
+        # Changing the work's presentation edition is tracked, and the
+        # next refresh only needs to touch that work.
+        work.presentation_edition.sort_title = u"new sort title"
+        self._db.flush()
+        eq_(1, SessionManager.refresh_materialized_views(self._db))
+        self._db.expire_all()
+        [mw] = self._db.query(mwc).all()
+        [mwg] = self._db.query(mwgc).all()
+        eq_(u"new sort title", mw.sort_title)
+        eq_(u"new sort title", mwg.sort_title)
+
+        # Once the changes are applied, they're forgotten.
+        eq_(0, SessionManager.refresh_materialized_views(self._db))
+
+        # A work that stops being presentation-ready is removed.
+        work.presentation_ready = False
+        self._db.flush()
+        eq_(1, SessionManager.refresh_materialized_views(self._db))
+        eq_([], self._db.query(mwc).all())
+        eq_([], self._db.query(mwgc).all())
+
+        # Changes are applied a chunk at a time until they run out.
+        others = []
+        for i in range(3):
+            other = self._work(with_license_pool=True)
+            other.presentation_ready = True
+            other.simple_opds_entry = '<entry>'
+            others.append(other)
+        self._db.flush()
+        eq_(3, SessionManager.refresh_materialized_views(
+            self._db, chunk_size=1
+        ))
+        eq_(sorted(x.id for x in others),
+            sorted(x.works_id for x in self._db.query(mwc)))
+        [[remaining]] = self._db.execute(
+            "select count(*) from %s" %
+            SessionManager.MATERIALIZED_VIEW_CHANGES_TABLE
+        )
+        eq_(0, remaining)
+
+    def test_change_recorded_during_refresh_is_kept(self):
+        work = self._work(with_license_pool=True)
+        work.presentation_ready = True
+        work.simple_opds_entry = '<entry>'
+        work.assign_genres_from_weights({classifier.Fantasy : 1})
+        SessionManager.refresh_materialized_views(self._db)
+
+        from model import MaterializedWork as mwc
+        SessionManager.convert_to_incremental(self._db, mwc.__table__.name)
+        work.presentation_edition.sort_title = u"first title"
+        self._db.flush()
+
+        # Simulate a change that comes in after the refresh has
+        # claimed the outstanding changes but before it finishes.
+        original = SessionManager.__dict__['_apply_changes']
+        apply_changes = SessionManager._apply_changes
+        def apply_and_change(cls, _db, view_name):
+            if view_name == mwc.__table__.name:
+                work.presentation_edition.sort_title = u"second title"
+                _db.flush()
+            return apply_changes(_db, view_name)
+        SessionManager._apply_changes = classmethod(apply_and_change)
+        try:
+            eq_(1, SessionManager.refresh_materialized_views(self._db))
+        finally:
+            SessionManager._apply_changes = original
+
+        # The refresh only forgot about the change it claimed; the
+        # later one is picked up next time.
+        [[remaining]] = self._db.execute(
+            "select count(*) from %s" %
+            SessionManager.MATERIALIZED_VIEW_CHANGES_TABLE
+        )
+        eq_(1, remaining)
+        eq_(1, SessionManager.refresh_materialized_views(self._db))
+        self._db.expire_all()
+        [mw] = self._db.query(mwc).all()
+        eq_(u"second title", mw.sort_title)
+
     def test_license_data_source_is_stored_in_views(self):
         """Verify that the data_source_name stored in the materialized views
         is the DataSource associated with the LicensePool, not the
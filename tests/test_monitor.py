@@ -15,17 +15,29 @@ from testing import (
 )
 
 from model import (
+    get_one_or_create,
+    CachedFeed,
     Collection,
     CollectionMissing,
     DataSource,
     ExternalIntegration,
+    HasFullTableCache,
     Identifier,
+    SessionManager,
     Subject,
     Timestamp,
     Work,
 )
 
+from lane import (
+    Lane,
+    LaneList,
+)
+
+from opds import TestAnnotatorWithGroup
+
 from monitor import (
+    CachedFeedPrewarmMonitor,
     CollectionMonitor,
     CoverageProvidersFailed,
     CustomListEntrySweepMonitor,
@@ -43,6 +55,7 @@ from monitor import (
     SweepMonitor,
     WorkRandomnessUpdateMonitor,
     WorkSweepMonitor,
+    _init_sweep_worker,
 )
 
 class MockMonitor(Monitor):
@@ -365,6 +378,88 @@ class TestSweepMonitor(DatabaseTest):
         # cleanup() is only called when the sweep completes successfully.
         eq_([], monitor.cleanup_called)
 
+    def test_shard_bounds(self):
+        i1, i2 = [self._identifier() for i in range(2)]
+        top = i2.id
+        bounds = self.monitor.shard_bounds(3)
+        eq_([(0, top // 3), (top // 3, top * 2 // 3), (top * 2 // 3, None)],
+            bounds)
+
+        # The bounds are kept for the rest of the sweep, even if more
+        # items show up. The last shard will get those.
+        self._identifier()
+        eq_(bounds, self.monitor.shard_bounds(3))
+
+    def test_run_shard(self):
+        i1, i2, i3, i4 = [self._identifier() for i in range(4)]
+
+        # This shard covers i2 and i3.
+        eq_(True, self.monitor.run_shard(0, 2, i1.id, i3.id))
+        eq_([i2, i3], self.monitor.processed)
+
+        # Only the shard's own Timestamp was touched, and it says the
+        # shard is done.
+        eq_(0, self.monitor.timestamp().counter)
+        eq_(i3.id, self.monitor.shard_timestamp(0, 2).counter)
+        self.monitor.run_shard(0, 2, i1.id, i3.id)
+        eq_([i2, i3], self.monitor.processed)
+
+        # The last shard has no upper bound. When it's done, its
+        # counter stays at the last item it covered.
+        eq_(True, self.monitor.run_shard(1, 2, i3.id, None))
+        eq_([i2, i3, i4], self.monitor.processed)
+        eq_(i4.id, self.monitor.shard_timestamp(1, 2).counter)
+
+    def test_run_sharded(self):
+        i1, i2, i3 = [self._identifier() for i in range(3)]
+
+        class InProcess(MockSweepMonitor):
+            """Runs every shard in this process instead of a pool."""
+            def run_shards(self, shard_args):
+                return [self.run_shard(*args[3:]) for args in shard_args]
+
+        monitor = InProcess(self._db)
+        monitor.run_sharded(2)
+        eq_(set([i1, i2, i3]), set(monitor.processed))
+
+        # The sweep is over, so the next one will start from scratch.
+        eq_(0, monitor.sharded_sweep_timestamp().counter)
+        eq_([0, 0], [monitor.shard_timestamp(shard, 2).counter
+                     for shard in range(2)])
+        eq_([True], monitor.cleanup_called)
+
+        # If a shard fails, the sweep isn't over.
+        class IHateI3(InProcess):
+            def process_item(self, item):
+                if item is i3:
+                    raise Exception("HOW DARE YOU")
+                super(IHateI3, self).process_item(item)
+        monitor = IHateI3(self._db)
+        monitor.run_sharded(2)
+        eq_(i3.id, monitor.sharded_sweep_timestamp().counter)
+        eq_([], monitor.cleanup_called)
+
+    def test_init_sweep_worker(self):
+        # Put something in a full-table cache.
+        DataSource.lookup(self._db, DataSource.GUTENBERG)
+        assert DataSource._cache != HasFullTableCache.RESET
+
+        old_engines = dict(SessionManager.engine_for_url)
+        assert old_engines
+        try:
+            _init_sweep_worker()
+
+            # A worker won't reuse the engines it inherited, so it
+            # won't share connections with the process that forked it.
+            eq_({}, SessionManager.engine_for_url)
+
+            # Nor will it use objects from the old process's sessions.
+            for cls in HasFullTableCache.cached_classes():
+                eq_(HasFullTableCache.RESET, cls._cache)
+                eq_(HasFullTableCache.RESET, cls._id_cache)
+        finally:
+            SessionManager.engine_for_url.update(old_engines)
+
 
 class TestIdentifierSweepMonitor(DatabaseTest):
 
@@ -699,3 +794,109 @@ class TestCustomListEntryWorkUpdateMonitor(DatabaseTest):
         monitor = CustomListEntryWorkUpdateMonitor(self._db)
         monitor.process_item(entry)
         eq_(old_work, entry.work)
+
+
+class MockCachedFeedPrewarmMonitor(CachedFeedPrewarmMonitor):
+
+    def __init__(self, *args, **kwargs):
+        super(MockCachedFeedPrewarmMonitor, self).__init__(*args, **kwargs)
+        self.rebuilt = []
+
+    def make_lanes(self, _db):
+        library = self.library(_db)
+        parent = Lane(_db, library, u"Parent", languages=['eng'])
+        child = Lane(
+            _db, library, u"Child", parent=parent, languages=['eng']
+        )
+        parent.sublanes.add(child)
+        lanes = LaneList()
+        lanes.add(parent)
+        return lanes
+
+    def annotator(self, lane):
+        return TestAnnotatorWithGroup()
+
+    def rebuild(self, _db, lane, type):
+        self.rebuilt.append((lane.name, type))
+        return super(MockCachedFeedPrewarmMonitor, self).rebuild(
+            _db, lane, type
+        )
+
+
+class TestCachedFeedPrewarmMonitor(DatabaseTest):
+
+    def test_all_lanes(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db, self._default_library)
+        eq_([u"Parent", u"Child"],
+            [x.name for x in monitor.all_lanes(self._db)])
+
+    def test_each_library_has_its_own_timestamp(self):
+        other_library = self._library()
+        m1 = MockCachedFeedPrewarmMonitor(self._db, self._default_library)
+        m2 = MockCachedFeedPrewarmMonitor(self._db, other_library)
+        assert m1.service_name != m2.service_name
+        assert self._default_library.short_name in m1.service_name
+        assert m1.timestamp() != m2.timestamp()
+
+    def test_missing_feeds_are_rebuilt_first(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db, self._default_library)
+        now = datetime.datetime.utcnow()
+        lanes = list(monitor.all_lanes(self._db))
+        jobs = monitor.prioritize(lanes, now)
+
+        # Nothing has been built yet. The groups feed is the most
+        # important; only the parent lane gets one, since the child
+        # has no sublanes.
+        eq_([(u"Parent", CachedFeed.GROUPS_TYPE),
+             (u"Parent", CachedFeed.PAGE_TYPE),
+             (u"Child", CachedFeed.PAGE_TYPE)],
+            [(lane.name, type) for lane, type in jobs])
+
+        # max_feeds limits the number of feeds rebuilt in one run.
+        monitor.max_feeds = 1
+        eq_(1, len(monitor.prioritize(lanes, now)))
+
+    def test_run_once_rebuilds_feeds(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db, self._default_library)
+        monitor.run_once(None, datetime.datetime.utcnow())
+        eq_(3, len(monitor.rebuilt))
+
+        feeds = self._db.query(CachedFeed).filter(
+            CachedFeed.content != None
+        ).all()
+        eq_(set([(u"Parent", CachedFeed.GROUPS_TYPE),
+                 (u"Parent", CachedFeed.PAGE_TYPE),
+                 (u"Child", CachedFeed.PAGE_TYPE)]),
+            set([(x.lane_name, x.type) for x in feeds]))
+
+        # Now that every feed is fresh, there's nothing to do.
+        monitor.rebuilt = []
+        monitor.run_once(None, datetime.datetime.utcnow())
+        eq_([], monitor.rebuilt)
+
+    def test_stale_feeds_prioritized_by_demand(self):
+        monitor = MockCachedFeedPrewarmMonitor(self._db, self._default_library)
+        monitor.run_once(None, datetime.datetime.utcnow())
+
+        # Both page feeds are now a little stale.
+        page_feeds = self._db.query(CachedFeed).filter(
+            CachedFeed.type==CachedFeed.PAGE_TYPE
+        )
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+        for feed in page_feeds:
+            feed.timestamp = long_ago
+
+        # But patrons have been browsing the child lane.
+        for i in range(3):
+            feed, ignore = get_one_or_create(
+                self._db, CachedFeed, library=self._default_library,
+                lane_name=u"Child", languages=u"eng",
+                type=CachedFeed.PAGE_TYPE, facets=u"", pagination=unicode(i)
+            )
+            feed.update(self._db, u"content")
+
+        lanes = list(monitor.all_lanes(self._db))
+        jobs = monitor.prioritize(lanes, datetime.datetime.utcnow())
+        eq_([(u"Child", CachedFeed.PAGE_TYPE),
+             (u"Parent", CachedFeed.PAGE_TYPE)],
+            [(lane.name, type) for lane, type in jobs])
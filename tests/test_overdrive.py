@@ -544,3 +544,20 @@ class TestOverdriveBibliographicCoverageProvider(OverdriveTest):
         eq_("Agile Documentation", pool.work.title)
         eq_(True, pool.work.presentation_ready)
        
+
+    def test_fetch_item(self):
+        identifier = self._identifier(identifier_type=Identifier.OVERDRIVE_ID)
+        identifier.identifier = '3896665d-9d81-4cac-bd43-ffc5066de1f5'
+        raw, info = self.sample_json("overdrive_metadata.json")
+        self.api.queue_response(200, content=raw)
+        eq_(info, self.provider.fetch_item(identifier))
+
+        # fetch_item() may run in a worker thread, so it won't refresh
+        # an expired Bearer Token, since that means using the database.
+        # It raises an exception instead, and the item will be handed
+        # to process_item().
+        self.api.queue_response(401)
+        assert_raises_regexp(
+            BadResponseException, "Bearer Token",
+            self.provider.fetch_item, identifier
+        )
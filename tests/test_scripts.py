@@ -20,7 +20,11 @@ from config import (
     Configuration, 
     temp_config,
 )
-from external_search import DummyExternalSearchIndex
+from external_search import (
+    DummyExternalSearchIndex,
+    ExternalSearchIndex,
+    PostgresSearchIndex,
+)
 
 from model import (
     create,
@@ -57,11 +61,14 @@ from scripts import (
     IdentifierInputScript,
     FixInvisibleWorksScript,
     LibraryInputScript,
+    MigrateSearchIndexScript,
     MockStdin,
     OPDSImportScript,
     PatronInputScript,
+    RebuildSearchIndexScript,
     RunCollectionMonitorScript,
     RunCoverageProviderScript,
+    RunCoverageProvidersScript,
     RunMonitorScript,
     Script,
     ShowCollectionsScript,
@@ -75,6 +82,8 @@ from testing import(
 )
 from monitor import (
     CollectionMonitor,
+    Monitor,
+    SweepMonitor,
 )
 from util.opds_writer import (
     OPDSFeed,
@@ -96,6 +105,27 @@ class TestScript(DatabaseTest):
 
         assert_raises(ValueError, Script.parse_time, "201601-01")
 
+    def test_long_running_scripts_listen_for_changes(self):
+        import scripts
+        listening = []
+        def production_session(listen_for_changes=False):
+            listening.append(listen_for_changes)
+            return self._db
+        old_production_session = scripts.production_session
+        scripts.production_session = production_session
+        try:
+            # A one-off script doesn't need to hear about changes
+            # made elsewhere...
+            Script()._db
+
+            # ...but scripts that run monitors and coverage providers
+            # keep going long enough that their caches would go stale.
+            RunCollectionMonitorScript(OPDSCollectionMonitor)._db
+            RunCoverageProvidersScript([])._db
+        finally:
+            scripts.production_session = old_production_session
+        eq_([False, True, True], listening)
+
 
 class TestCheckContributorNamesInDB(DatabaseTest):
     def test_process_contribution_local(self):
@@ -298,6 +328,38 @@ class TestRunCollectionMonitorScript(DatabaseTest):
         # Nothing happened to the Bibliotheca collection.
         assert not hasattr(b1, 'ran_with_argument')
 
+    def test_shards(self):
+        class MockSweep(SweepMonitor):
+            SERVICE_NAME = "Mock sweep"
+            PROTOCOL = ExternalIntegration.OPDS_IMPORT
+            MODEL_CLASS = Identifier
+
+            def run(self):
+                self.collection.ran_with = "run"
+
+            def run_sharded(self, shards=None):
+                self.collection.ran_with = shards
+
+        # With --shards, every sweep monitor is run in shards...
+        o1 = self._collection()
+        o2 = self._collection()
+        script = RunCollectionMonitorScript(MockSweep, self._db)
+        script.do_run(cmd_args=["--shards", "3"])
+        eq_([3, 3], [o1.ran_with, o2.ran_with])
+
+        # ...and without it, they're run normally.
+        script.do_run(cmd_args=[])
+        eq_(["run", "run"], [o1.ran_with, o2.ran_with])
+
+        # A Monitor that can't be run in shards is run normally.
+        class MockMonitor(Monitor):
+            SERVICE_NAME = "Mock monitor"
+            def run(self):
+                self.ran_with = "run"
+        monitor = MockMonitor(self._db)
+        RunMonitorScript.run_monitor(monitor, 3)
+        eq_("run", monitor.ran_with)
+
     def test_keep_going_on_failure(self):
         # Here we have two Collections that are going to be run
         # through a CollectionMonitor that always fails.
@@ -1753,6 +1815,68 @@ class TestBibliographicRefreshScript(DatabaseTest):
         eq_(False, script.refresh_metadata(identifier))
 
 
+class PostgresSearchIndexScriptTest(DatabaseTest):
+    """Run the search index maintenance scripts against a site that
+    searches its own database.
+    """
+
+    def setup(self):
+        super(PostgresSearchIndexScriptTest, self).setup()
+        self.integration = self._external_integration(
+            ExternalIntegration.POSTGRES_SEARCH,
+            goal=ExternalIntegration.SEARCH_GOAL
+        )
+        self.search = PostgresSearchIndex(self._db)
+        self.works = [self._work(with_license_pool=True) for i in range(2)]
+        for work in self.works:
+            work.presentation_ready = True
+
+    def count(self, index):
+        return self.search.count(
+            index=index, doc_type=self.search.work_document_type
+        )['count']
+
+    def current_index(self):
+        return self.integration.setting(
+            ExternalSearchIndex.WORKS_INDEX_KEY
+        ).value
+
+
+class TestRebuildSearchIndexScript(PostgresSearchIndexScriptTest):
+
+    def test_do_run(self):
+        script = RebuildSearchIndexScript(self._db, search=self.search)
+        script.do_run(cmd_args=[])
+
+        # Every work was uploaded into the new index, and the switch
+        # to the new index was saved.
+        eq_(2, self.count(u"works-v2"))
+        eq_(u"works-v2", self.search.works_index)
+        eq_(u"works-v2", self.current_index())
+        eq_(u"works-v2", PostgresSearchIndex(self._db).works_index)
+
+
+class TestMigrateSearchIndexScript(PostgresSearchIndexScriptTest):
+
+    def test_do_run(self):
+        self.search.bulk_update(self.works)
+        eq_(2, self.count(u"works"))
+
+        script = MigrateSearchIndexScript(self._db, search=self.search)
+        script.do_run(cmd_args=[])
+
+        # The new index was filled, checked against the old one and
+        # made the current index.
+        eq_(2, self.count(u"works-v2"))
+        eq_(u"works-v2", self.search.works_index)
+        eq_(u"works-v2", self.current_index())
+        eq_(None, self.search.migration_index)
+
+        # Running the script again does nothing.
+        script.do_run(cmd_args=[])
+        eq_(u"works-v2", self.current_index())
+
+
 class TestWorkConsolidationScript(object):
     """TODO"""
     pass
@@ -26,6 +26,7 @@ from util import (
     fast_query_count,
     slugify
 )
+from util.lru import LRUCache
 from util.median import median
 
 class TestLanguageCodes(object):
@@ -441,6 +442,69 @@ class TestMedian(object):
         eq_(290, median(test_set))
 
 
+class TestLRUCache(object):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        eq_(1, cache.get("a"))
+        cache.set("c", 3)
+        eq_(None, cache.get("b"))
+        eq_(1, cache.get("a"))
+        eq_(3, cache.get("c"))
+        eq_(1, cache.evictions)
+
+    def test_eviction_by_size(self):
+        cache = LRUCache(max_entries=10, max_size=10, sizeof=len)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        eq_(10, cache.size)
+        cache.set("c", "123")
+        eq_(False, "a" in cache)
+        eq_(8, cache.size)
+
+        # A value too big for the cache is not cached at all.
+        eq_(False, cache.set("d", "12345678901"))
+        eq_(False, "d" in cache)
+
+    def test_stats(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        stats = cache.stats
+        eq_(1, stats['hits'])
+        eq_(1, stats['misses'])
+        eq_(1, stats['entries'])
+
+        cache.remove("a")
+        eq_(0, len(cache))
+
+    def test_zero_entries_disables_cache(self):
+        cache = LRUCache(max_entries=0)
+        eq_(False, cache.set("a", 1))
+        eq_(None, cache.get("a"))
+
+    def test_ttl(self):
+        class MockLRUCache(LRUCache):
+            now = 100
+            def _now(self):
+                return self.now
+
+        cache = MockLRUCache(max_entries=2, ttl=10)
+        cache.set("a", 1)
+        cache.now = 109
+        eq_(1, cache.get("a"))
+
+        # Once the entry's time to live is up, it's gone.
+        cache.now = 110
+        eq_(None, cache.get("a"))
+        eq_(False, "a" in cache)
+        eq_(1, cache.stats['expirations'])
+        eq_(1, cache.stats['misses'])
+
+
 class TestFastQueryCount(DatabaseTest):
 
     def test_no_distinct(self):
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded least-recently-used cache.
+
+    The cache is bounded both by the number of entries it holds and by
+    the total size of those entries. When either limit is exceeded, the
+    least recently used entries are evicted until the cache fits
+    again. Entries may also be given a time to live, after which they
+    are treated as missing.
+    """
+
+    def __init__(self, max_entries=1000, max_size=None, sizeof=None,
+                 ttl=None):
+        """Constructor.
+
+        :param max_entries: The maximum number of entries to hold. If
+        this is zero, nothing will ever be cached.
+
+        :param max_size: The maximum total size of all entries, as
+        measured by `sizeof`. If this is None, entries are only
+        evicted based on `max_entries`.
+
+        :param sizeof: A function that measures the size of a value.
+        By default, sys.getsizeof is used.
+
+        :param ttl: The number of seconds an entry stays valid. If
+        this is None, entries never expire.
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof or sys.getsizeof
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Remove every entry from the cache and reset the statistics."""
+        with self.lock:
+            self._entries = OrderedDict()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Look up a value and mark it as recently used."""
+        with self.lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            value, size, expires = self._entries.pop(key)
+            if expires is not None and expires <= self._now():
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Put a value in the cache, evicting older values if necessary.
+
+        :return: True if the value was cached, False if it was too big
+        to be cached at all.
+        """
+        size = self.sizeof(value)
+        expires = None
+        if self.ttl is not None:
+            expires = self._now() + self.ttl
+        with self.lock:
+            self.remove(key)
+            if (self.max_entries <= 0
+                or (self.max_size is not None and size > self.max_size)):
+                return False
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            self._evict()
+            return True
+
+    def remove(self, key):
+        """Remove a value from the cache, if it's present."""
+        with self.lock:
+            if key in self._entries:
+                value, size, expires = self._entries.pop(key)
+                self.size -= size
+
+    def _evict(self):
+        """Evict least recently used entries until the cache is within
+        its limits.
+        """
+        while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_size is not None and self.size > self.max_size)
+        ):
+            key, (value, size, expires) = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        """Summarize the performance of this cache."""
+        with self.lock:
+            return dict(
+                entries=len(self._entries),
+                size=self.size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+            )
+
+    def _now(self):
+        return time.time()